@@ -0,0 +1,195 @@
+#
+
+# asyncio adapters for the KCS codec
+# - decode_stream(): async iterator of decoded bytes from a StreamReader of PCM
+# - KCSStreamWriter: encodes data and writes the audio to a StreamWriter
+# - chunk work runs in an executor so the event loop stays responsive while
+#   many streams are served from one process
+#
+# Run as a script to accept PCM streams on a TCP port or unix socket and
+# decode each connection into its own output file.
+
+import sys
+import asyncio
+import optparse
+
+from kcs_codec import KCSConfig, KCSEncoder, KCSDecoder
+
+CHUNK = 16384  # bytes of PCM read per executor job
+
+
+# Decode PCM arriving on an asyncio.StreamReader, yielding chunks of
+# decoded bytes as they complete. Each stream has its own KCSDecoder, and
+# feeds are awaited in order, so streams never share or reorder state.
+async def decode_stream(reader, config, chunk_size=CHUNK, executor=None):
+    decoder = KCSDecoder(config)
+    loop = asyncio.get_running_loop()
+    while True:
+        pcm = await reader.read(chunk_size)
+        if not pcm:
+            return
+        data = await loop.run_in_executor(executor, decoder.feed, pcm)
+        if data:
+            yield data
+
+
+# Encode data and write the resulting audio to an asyncio.StreamWriter,
+# honouring flow control (drain) after every block.
+class KCSStreamWriter:
+    def __init__(self, writer, config, chunk_size=1024, executor=None):
+        self.writer = writer
+        self.encoder = KCSEncoder(config)
+        self.chunk_size = chunk_size  # data bytes encoded per executor job
+        self.executor = executor
+
+    async def _send(self, pcm):
+        self.writer.write(pcm)
+        await self.writer.drain()
+
+    async def leader(self, seconds):
+        await self._send(self.encoder.leader(seconds))
+
+    async def trailer(self, seconds):
+        await self._send(self.encoder.trailer(seconds))
+
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        data = memoryview(data).cast("B")
+        for i in range(0, len(data), self.chunk_size):
+            block = data[i : i + self.chunk_size]
+            pcm = await loop.run_in_executor(self.executor, self.encoder.encode, block)
+            await self._send(pcm)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def write_flush(outf, data):
+    outf.write(data)
+    outf.flush()
+
+
+# Decode each connection into its own output file; the files are opened,
+# written and closed in the executor too, so a slow disk doesn't stall the
+# other connections, and the connection is closed however decoding ends
+async def serve(opts, config, executor=None):
+    count = 0
+
+    async def handle(reader, writer):
+        nonlocal count
+        count += 1
+        filename = "%s%d.bin" % (opts.output_prefix, count)
+        print("decoding connection %d to %s" % (count, filename), file=sys.stderr)
+        loop = asyncio.get_running_loop()
+        outf = None
+        try:
+            outf = await loop.run_in_executor(executor, open, filename, "wb")
+            async for data in decode_stream(reader, config, executor=executor):
+                await loop.run_in_executor(executor, write_flush, outf, data)
+        finally:
+            if outf:
+                await loop.run_in_executor(executor, outf.close)
+            writer.close()
+            await writer.wait_closed()
+
+    if opts.unix_socket:
+        server = await asyncio.start_unix_server(handle, path=opts.unix_socket)
+    else:
+        server = await asyncio.start_server(handle, opts.host, opts.port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-H",
+        "--host",
+        dest="host",
+        default="127.0.0.1",
+        help="address to listen on",
+    )
+    parser.add_option(
+        "-p",
+        "--port",
+        dest="port",
+        type="int",
+        default=8300,
+        help="TCP port to listen on",
+    )
+    parser.add_option(
+        "-u",
+        "--unix-socket",
+        dest="unix_socket",
+        help="listen on a unix socket instead of TCP",
+    )
+    parser.add_option(
+        "-r",
+        "--rate",
+        dest="framerate",
+        type="int",
+        default=44100,
+        help="PCM sample rate",
+    )
+    parser.add_option(
+        "-w",
+        "--sample-width",
+        dest="samplewidth",
+        type="int",
+        default=2,
+        help="PCM bytes per sample (1 = unsigned 8-bit, 2 = signed 16-bit)",
+    )
+    parser.add_option(
+        "-C",
+        "--nchannels",
+        dest="nchannels",
+        type="int",
+        default=1,
+        help="PCM channel count",
+    )
+    parser.add_option(
+        "-f",
+        "--kcs-base-adj",
+        dest="kcs_base_adj",
+        type="int",
+        default=0,
+        help="KCS base frequency adjustment",
+    )
+    parser.add_option(
+        "-s",
+        "--speed",
+        type="int",
+        default=0,
+        dest="speed_mode",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
+    )
+    parser.add_option(
+        "-a",
+        "--ascii",
+        action="store_true",
+        default=False,
+        dest="cuts",
+        help="ASCII only w/CUTS encoding (7 data bits, 3 stop bits)",
+    )
+    parser.add_option(
+        "-o",
+        "--output-prefix",
+        dest="output_prefix",
+        default="kcs-stream-",
+        help="prefix of per-connection output files",
+    )
+    opts, args = parser.parse_args()
+
+    config = KCSConfig(
+        framerate=opts.framerate,
+        speed_mode=opts.speed_mode,
+        cuts=opts.cuts,
+        kcs_base_adj=opts.kcs_base_adj,
+        samplewidth=opts.samplewidth,
+        nchannels=opts.nchannels,
+    )
+    try:
+        asyncio.run(serve(opts, config))
+    except KeyboardInterrupt:
+        pass
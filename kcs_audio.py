@@ -0,0 +1,412 @@
+#
+
+# Audio backends for the live scripts
+# - PyAudioBackend: sound cards, through PyAudio
+# - FakeBackend: deterministic in-process stand-in, so the live capture,
+#   playback, monitor and threading paths can run on a headless box; input
+#   comes from a WAV file or is looped back from output, output goes to WAV
+#   files (or nowhere), paced in real time or as fast as possible, with
+#   injected input overflows and output underflows
+# - RawPCMReader: raw PCM streams (standard input, FIFOs) for the decoders
+#   that read WAV files
+#
+# Backends open streams of interleaved PCM in one of the sample formats
+# below. Input streams have read(nframes), which returns b"" at the end of
+# the input (never, for a sound card), output streams have write(frames),
+# and both have close().
+
+import sys
+import time
+import wave
+import threading
+from collections import deque
+
+UINT8, INT16, FLOAT32 = "uint8", "int16", "float32"
+SAMPLE_SIZES = {UINT8: 1, INT16: 2, FLOAT32: 4}
+SILENCE = {UINT8: b"\x80", INT16: b"\0\0", FLOAT32: b"\0\0\0\0"}
+FORMATS = {"u8": UINT8, "s16": INT16, "float": FLOAT32}  # command line names
+
+
+# Sound cards through PyAudio
+class PyAudioBackend:
+    def __init__(self):
+        import pyaudio  # only needed for sound cards
+
+        self._pa = pyaudio.PyAudio()
+        self._formats = {
+            UINT8: pyaudio.paUInt8,
+            INT16: pyaudio.paInt16,
+            FLOAT32: pyaudio.paFloat32,
+        }
+
+    # (device id, name, has input, has output) for every device
+    def list_devices(self):
+        info = self._pa.get_host_api_info_by_index(0)
+        devices = []
+        for i in range(info.get("deviceCount")):
+            d = self._pa.get_device_info_by_host_api_device_index(0, i)
+            devices.append(
+                (i, d["name"], d["maxInputChannels"] > 0, d["maxOutputChannels"] > 0)
+            )
+        return devices
+
+    def default_input(self):
+        return self._pa.get_default_input_device_info()["index"]
+
+    def default_output(self):
+        return self._pa.get_default_output_device_info()["index"]
+
+    def open_input(self, device, rate, fmt, channels, block_size):
+        stream = self._pa.open(
+            format=self._formats[fmt],
+            channels=channels,
+            rate=rate,
+            input=True,
+            input_device_index=device,
+            frames_per_buffer=block_size,
+        )
+        return _PyAudioInput(stream)
+
+    # with raise_underflow, a write after the device ran dry raises IOError
+    def open_output(
+        self, device, rate, fmt, channels, block_size, raise_underflow=False
+    ):
+        stream = self._pa.open(
+            format=self._formats[fmt],
+            channels=channels,
+            rate=rate,
+            output=True,
+            output_device_index=device,
+            frames_per_buffer=block_size,
+        )
+        return _PyAudioOutput(stream, raise_underflow)
+
+
+class _PyAudioInput:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, nframes):
+        return self.stream.read(nframes, exception_on_overflow=False)
+
+    def close(self):
+        self.stream.close()
+
+
+class _PyAudioOutput:
+    def __init__(self, stream, raise_underflow):
+        self.stream = stream
+        self.raise_underflow = raise_underflow
+
+    def write(self, frames):
+        self.stream.write(frames, exception_on_underflow=self.raise_underflow)
+
+    def close(self):
+        self.stream.close()
+
+
+# Convert interleaved PCM between sample formats (numpy is only needed when
+# they differ)
+def convert_frames(frames, src_fmt, dst_fmt):
+    if src_fmt == dst_fmt:
+        return frames
+    from kcs_dsp import convert_pcm  # numpy is only needed for conversions
+
+    return convert_pcm(frames, src_fmt, dst_fmt)
+
+
+# Raw (headerless) interleaved PCM from a binary file object, e.g. standard
+# input or a FIFO, read through the part of the wave.Wave_read interface the
+# decoders use, so they can decode a recording while it is being made
+# - the length isn't known up front: getnframes() is sys.maxsize, and reads
+#   just end at the end of the stream
+# - setpos() can only skip forward, by reading
+# - float samples are converted to 16-bit (numpy is needed for that)
+class RawPCMReader:
+    def __init__(self, f, framerate, fmt=INT16, nchannels=1):
+        if fmt not in SAMPLE_SIZES:
+            raise ValueError("unknown sample format %r" % (fmt,))
+        self._f = f
+        self._framerate = framerate
+        self._fmt = fmt
+        self._out_fmt = INT16 if fmt == FLOAT32 else fmt
+        self._nchannels = nchannels
+        self._frame_size = SAMPLE_SIZES[fmt] * nchannels
+        self._pos = 0  # frames read so far
+
+    def getnchannels(self):
+        return self._nchannels
+
+    def getsampwidth(self):
+        return SAMPLE_SIZES[self._out_fmt]
+
+    def getframerate(self):
+        return self._framerate
+
+    def getnframes(self):
+        return sys.maxsize
+
+    def tell(self):
+        return self._pos
+
+    # blocks until nframes have arrived or the stream ends
+    def readframes(self, nframes):
+        frames = self._f.read(nframes * self._frame_size)
+        frames = frames[: len(frames) - len(frames) % self._frame_size]
+        self._pos += len(frames) // self._frame_size
+        return convert_frames(frames, self._fmt, self._out_fmt)
+
+    def setpos(self, pos):
+        if pos < self._pos:
+            raise ValueError("can't seek back in a stream")
+        while pos > self._pos and self.readframes(min(pos - self._pos, 8192)):
+            pass
+
+    def close(self):
+        self._f.close()
+
+
+# Deterministic stand-in for a sound card
+# - infile: WAV file read by input streams (same rate and channel count as
+#   requested; 8/16-bit samples are converted to the requested format)
+# - outfile: WAV file written by output streams to the default output
+#   device; a "%d" in the name is replaced by the device id, so every
+#   output device gets its own file
+# - loopback: input streams read what output streams write (instead of
+#   infile); the input ends once all output streams are closed
+# - realtime: pace reads and writes at the stream's sample rate, rather
+#   than running as fast as possible
+# - overflow_every/underflow_every: every nth input read loses a block of
+#   samples ahead of it, every nth output write is preceded by a block of
+#   silence (the device ran dry); counted in overflows/underflows
+# - slow_device: this output device plays at half real time speed (even
+#   without realtime), e.g. to test that it doesn't hold up the others
+class FakeBackend:
+    INPUT = 0  # device ids: one input, then noutputs output devices
+
+    def __init__(
+        self,
+        infile=None,
+        outfile=None,
+        loopback=False,
+        realtime=False,
+        overflow_every=0,
+        underflow_every=0,
+        noutputs=4,
+        slow_device=None,
+    ):
+        self.infile = infile
+        self.outfile = outfile
+        self.loopback = loopback
+        self.realtime = realtime
+        self.overflow_every = overflow_every
+        self.underflow_every = underflow_every
+        self.noutputs = noutputs
+        self.slow_device = slow_device
+        self.overflows = 0
+        self.underflows = 0
+        self._loop = deque()  # (frames, fmt) written to the loopback
+        self._loop_writers = 0
+        self._loop_used = False
+        self._loop_cond = threading.Condition()
+
+    def list_devices(self):
+        devices = [(self.INPUT, "fake input", True, False)]
+        for i in range(1, self.noutputs + 1):
+            devices.append((i, "fake output %d" % i, False, True))
+        return devices
+
+    def default_input(self):
+        return self.INPUT
+
+    def default_output(self):
+        return 1
+
+    def open_input(self, device, rate, fmt, channels, block_size):
+        if self.loopback:
+            return _FakeLoopInput(self, rate, fmt, channels)
+        if not self.infile:
+            raise ValueError("fake backend has no input (set infile or loopback)")
+        return _FakeWavInput(self, rate, fmt, channels)
+
+    def open_output(
+        self, device, rate, fmt, channels, block_size, raise_underflow=False
+    ):
+        filename = None
+        if self.outfile and "%d" in self.outfile:
+            filename = self.outfile % device
+        elif self.outfile and device == self.default_output():
+            filename = self.outfile
+        stream = _FakeOutput(self, filename, rate, fmt, channels, raise_underflow)
+        if device == self.slow_device:
+            stream.speed = 0.5
+        return stream
+
+
+class _FakeStream:
+    def __init__(self, backend, rate, fmt, channels):
+        self.backend = backend
+        self.rate = rate
+        self.fmt = fmt
+        self.frame_size = SAMPLE_SIZES[fmt] * channels
+        self.frames = 0  # frames passed so far
+        self.count = 0  # reads/writes so far
+        self.t0 = time.monotonic()
+        self.speed = 1.0  # of playback relative to real time
+
+    # in real time mode (or at another speed), wait until the frames so far
+    # would have played
+    def pace(self):
+        if self.backend.realtime or self.speed != 1.0:
+            delay = self.t0 + self.frames / (self.rate * self.speed) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class _FakeWavInput(_FakeStream):
+    def __init__(self, backend, rate, fmt, channels):
+        _FakeStream.__init__(self, backend, rate, fmt, channels)
+        self.wavefile = wave.open(backend.infile, "rb")
+        if self.wavefile.getframerate() != rate:
+            raise ValueError(
+                "%s: rate %d, expected %d"
+                % (backend.infile, self.wavefile.getframerate(), rate)
+            )
+        if self.wavefile.getnchannels() != channels:
+            raise ValueError(
+                "%s: %d channels, expected %d"
+                % (backend.infile, self.wavefile.getnchannels(), channels)
+            )
+        self.src_fmt = {1: UINT8, 2: INT16}[self.wavefile.getsampwidth()]
+        self.src_frame_size = self.wavefile.getsampwidth() * channels
+
+    def read(self, nframes):
+        self.count += 1
+        every = self.backend.overflow_every
+        if every and self.count % every == 0:  # samples lost in an overflow
+            self.backend.overflows += 1
+            lost = self.wavefile.readframes(nframes)
+            self.frames += len(lost) // self.src_frame_size
+        frames = self.wavefile.readframes(nframes)
+        self.frames += len(frames) // self.src_frame_size
+        self.pace()
+        return convert_frames(frames, self.src_fmt, self.fmt)
+
+    def close(self):
+        self.wavefile.close()
+
+
+class _FakeLoopInput(_FakeStream):
+    def read(self, nframes):
+        self.count += 1
+        every = self.backend.overflow_every
+        if every and self.count % every == 0:
+            self.backend.overflows += 1
+            self._take(nframes)
+        frames = self._take(nframes)
+        self.frames += len(frames) // self.frame_size
+        self.pace()
+        return frames
+
+    # up to nframes from the loopback, waiting for output to be written
+    def _take(self, nframes):
+        backend = self.backend
+        want = nframes * self.frame_size
+        out = bytearray()
+        with backend._loop_cond:
+            while len(out) < want:
+                if not backend._loop:
+                    if backend._loop_used and not backend._loop_writers:
+                        break  # all output closed
+                    backend._loop_cond.wait()
+                    continue
+                frames, fmt = backend._loop.popleft()
+                frames = convert_frames(frames, fmt, self.fmt)
+                need = want - len(out)
+                out += frames[:need]
+                if len(frames) > need:  # keep the rest for the next read
+                    backend._loop.appendleft((frames[need:], self.fmt))
+        return bytes(out)
+
+    def close(self):
+        pass
+
+
+class _FakeOutput(_FakeStream):
+    def __init__(self, backend, filename, rate, fmt, channels, raise_underflow):
+        _FakeStream.__init__(self, backend, rate, fmt, channels)
+        self.raise_underflow = raise_underflow
+        self.wavefile = None
+        if filename:
+            self.wavefile = wave.open(filename, "wb")
+            self.wavefile.setnchannels(channels)
+            self.wavefile.setsampwidth(SAMPLE_SIZES[fmt])
+            self.wavefile.setframerate(rate)
+        if backend.loopback:
+            with backend._loop_cond:
+                backend._loop_writers += 1
+                backend._loop_used = True
+
+    def write(self, frames):
+        self.count += 1
+        underflow = False
+        every = self.backend.underflow_every
+        if every and self.count % every == 0:
+            self.backend.underflows += 1
+            underflow = True
+            nsamples = max(len(frames), self.frame_size) // SAMPLE_SIZES[self.fmt]
+            self._play(SILENCE[self.fmt] * nsamples)
+        self._play(frames)
+        if underflow and self.raise_underflow:
+            raise IOError("output underflowed")
+
+    def _play(self, frames):
+        if self.wavefile:
+            self.wavefile.writeframes(frames)
+        if self.backend.loopback:
+            with self.backend._loop_cond:
+                self.backend._loop.append((bytes(frames), self.fmt))
+                self.backend._loop_cond.notify_all()
+        self.frames += len(frames) // self.frame_size
+        self.pace()
+
+    def close(self):
+        if self.wavefile:
+            self.wavefile.close()
+            self.wavefile = None
+        if self.backend.loopback:
+            with self.backend._loop_cond:
+                self.backend._loop_writers -= 1
+                self.backend._loop_cond.notify_all()
+
+
+# Backend from a command line spec: "pyaudio" (the default), or "fake"
+# with options, e.g. "fake:in=tape.wav,realtime,overflow=100"
+# (options: in, out, loopback, realtime, overflow, underflow, outputs, slow)
+def make_backend(spec="pyaudio"):
+    name, _, options = spec.partition(":")
+    if name == "pyaudio" and not options:
+        return PyAudioBackend()
+    if name != "fake":
+        raise ValueError("unknown audio backend %r" % name)
+    kwargs = {}
+    keys = dict(
+        loopback=("loopback", bool),
+        realtime=("realtime", bool),
+        overflow=("overflow_every", int),
+        underflow=("underflow_every", int),
+        outputs=("noutputs", int),
+        slow=("slow_device", int),
+    )
+    keys["in"] = ("infile", str)
+    keys["out"] = ("outfile", str)
+    for option in filter(None, options.split(",")):
+        key, sep, value = option.partition("=")
+        if key not in keys:
+            raise ValueError("unknown fake backend option %r" % key)
+        arg, kind = keys[key]
+        if kind is bool:
+            kwargs[arg] = value in ("", "1", "yes", "true") if sep else True
+        else:
+            kwargs[arg] = kind(value)
+    return FakeBackend(**kwargs)
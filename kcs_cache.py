@@ -0,0 +1,117 @@
+#
+
+# On-disk cache of front-end sign-change bit streams
+# - the front end (WAV parsing + sign-change extraction) doesn't depend on
+#   the framing options (speed, ASCII, base frequency adjustment), so runs
+#   that only vary those can replay the cached stream and skip straight to
+#   framing
+# - streams are stored with np.packbits (one bit per sample), written and
+#   replayed as numpy arrays of bits (for kcs_dsp.frame_bit_blocks)
+# - entries are keyed by the file's size and modification time, a hash of
+#   its first and last MiB and the front-end parameters; hashing all of a
+#   long recording costs about as much as the front end it saves
+# - least recently used entries are evicted to keep the cache under a size
+#   limit
+
+import os
+import json
+import struct
+import hashlib
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+BLOCK_BITS = 1 << 16  # bits unpacked per block
+HASH_BYTES = 1 << 20  # hashed at each end of a file for its key
+
+
+class BitCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    # cache key for a file and the front-end parameters used on it
+    def key(self, filename, **params):
+        st = os.stat(filename)
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            h.update(f.read(HASH_BYTES))
+            f.seek(max(HASH_BYTES, st.st_size - HASH_BYTES))
+            h.update(f.read(HASH_BYTES))
+        meta = [st.st_size, st.st_mtime_ns, params]
+        h.update(json.dumps(meta, sort_keys=True).encode("ascii"))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".bits")
+
+    # Return a generator of numpy arrays (uint8, one element per bit) that
+    # hold the cached bits [start, start + nbits), or None if key isn't
+    # cached. A hit marks the entry as recently used.
+    def get(self, key, start=0, nbits=None):
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return self._generate(f, start, nbits)
+
+    def _generate(self, f, start, nbits):
+        with f:
+            (total,) = struct.unpack("<Q", f.read(8))
+            end = total if nbits is None else min(total, start + nbits)
+            pos = start - start % 8
+            f.seek(8 + pos // 8)
+            while pos < end:
+                block = np.frombuffer(f.read(BLOCK_BITS // 8), dtype=np.uint8)
+                if not len(block):
+                    break
+                bits = np.unpackbits(block)
+                lo = max(start - pos, 0)
+                hi = min(end - pos, len(bits))
+                yield bits[lo:hi]
+                pos += len(bits)
+
+    # Store the bits of blocks (numpy arrays of 0s and 1s, any lengths)
+    # under key. The entry only becomes visible once all are stored.
+    def put(self, key, blocks):
+        path = self.path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        total = 0
+        complete = False
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(struct.pack("<Q", 0))
+                rest = np.zeros(0, dtype=np.uint8)  # bits short of a byte
+                for block in blocks:
+                    bits = np.concatenate([rest, np.asarray(block, dtype=np.uint8)])
+                    n = len(bits) - len(bits) % 8
+                    f.write(np.packbits(bits[:n]).tobytes())
+                    rest = bits[n:]
+                    total += len(block)
+                f.write(np.packbits(rest).tobytes())
+                f.seek(0)
+                f.write(struct.pack("<Q", total))
+            os.replace(tmp_path, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    # drop least recently used entries until the cache fits max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bits"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        for _, entry_size, name in entries[:-1]:  # always keep the newest
+            if size <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            size -= entry_size
@@ -0,0 +1,267 @@
+#
+
+# Synthetic tape channel simulator and decoder benchmark
+# - passes encoder output through configurable tape-like impairments
+# - runs the sign-change decoder (kcs_codec.generate_bytes, as used by
+#   kcs_decode.py/kcs_decode_live.py), with the plain or AGC front end, and
+#   the FFT decoder (kcs_fft) over a parameter grid, reporting bit error
+#   rate against decode throughput
+#
+# Example: sweep noise and wow at 300 and 1200 baud
+#
+#   python3 kcs_channel_sim.py -s 0,1 -g "noise=0,0.2,0.5;wow=0,0.01"
+
+import sys
+import time
+import optparse
+from difflib import SequenceMatcher
+from itertools import product
+
+import numpy as np
+
+from kcs_codec import KCSConfig, KCSEncoder, generate_bytes as sc_generate_bytes
+from kcs_fft import generate_freqs, generate_bytes as fft_generate_bytes
+from kcs_fft import get_fft_params
+from kcs_dsp import AGCFrontEnd
+
+# default impairment settings, all of which leave the signal untouched
+IMPAIRMENTS = dict(
+    noise=0.0,  # white noise RMS, relative to the tone amplitude
+    hum=0.0,  # mains hum amplitude
+    hum_freq=50.0,  # Hz
+    dc=0.0,  # DC offset
+    clip=0.0,  # clip at this amplitude (0 for no clipping)
+    wow=0.0,  # slow speed deviation (fraction of nominal speed)
+    wow_freq=0.5,  # Hz
+    flutter=0.0,  # fast speed deviation (fraction of nominal speed)
+    flutter_freq=12.0,  # Hz
+    dropouts=0.0,  # dropouts per second
+    dropout_len=0.01,  # seconds
+    dropout_depth=0.9,  # fraction of signal lost in a dropout
+    invert=0,  # 1 to invert polarity
+)
+
+
+# Apply tape channel impairments to a float signal in [-1, 1]
+def simulate_channel(signal, framerate, seed=0, **params):
+    p = dict(IMPAIRMENTS, **params)
+    rng = np.random.default_rng(seed)
+    n = len(signal)
+    t = np.arange(n) / framerate
+
+    # wow/flutter: read the tape at a time-varying speed
+    if p["wow"] or p["flutter"]:
+        pos = t.copy()
+        if p["wow"]:
+            w = 2 * np.pi * p["wow_freq"]
+            pos += p["wow"] * (1 - np.cos(w * t)) / w
+        if p["flutter"]:
+            w = 2 * np.pi * p["flutter_freq"]
+            pos += p["flutter"] * (1 - np.cos(w * t)) / w
+        signal = np.interp(pos, t, signal)
+
+    out = signal.astype(np.float64)
+    if p["dropouts"]:
+        count = rng.poisson(p["dropouts"] * n / framerate)
+        length = int(p["dropout_len"] * framerate)
+        for start in rng.integers(0, max(n - length, 1), count):
+            out[start : start + length] *= 1 - p["dropout_depth"]
+    if p["hum"]:
+        out += p["hum"] * np.sin(2 * np.pi * p["hum_freq"] * t)
+    if p["noise"]:
+        out += rng.normal(0, p["noise"], n)
+    out += p["dc"]
+    if p["clip"]:
+        out = out.clip(-p["clip"], p["clip"])
+    if p["invert"]:
+        out = -out
+    return out.clip(-1, 1)
+
+
+# Render data as a float signal (leader, data, trailer) at a base framerate
+def make_signal(data, speed_mode, framerate, leader=1):
+    encoder = KCSEncoder(KCSConfig(framerate=framerate, speed_mode=speed_mode))
+    pcm = encoder.leader(leader) + encoder.encode(data) + encoder.trailer(leader)
+    signal = (np.frombuffer(pcm, dtype=np.uint8).astype(np.float64) - 128) / 128
+    return signal, encoder.framerate
+
+
+# sign-change decoder on 16-bit samples, with kcs_decode.py's front end
+def decode_sign_change(signal, framerate, speed_mode):
+    negative = (signal * 32767).astype(np.int16) < 0
+    bits = np.empty(len(negative), dtype=np.uint8)
+    bits[0] = negative[0]
+    bits[1:] = negative[1:] ^ negative[:-1]
+    byte_stream = sc_generate_bytes(
+        iter(bits.tolist()), framerate, 0, speed_mode, False
+    )
+    return bytes(byte_stream)
+
+
+# sign-change decoder with the AGC/adaptive hysteresis front end
+def decode_agc(signal, framerate, speed_mode, chunk=8192):
+    front_end = AGCFrontEnd(framerate)
+    bits = np.concatenate(
+        [front_end.process(signal[i : i + chunk]) for i in range(0, len(signal), chunk)]
+    )
+    byte_stream = sc_generate_bytes(
+        iter(bits.tolist()), framerate, 0, speed_mode, False
+    )
+    return bytes(byte_stream)
+
+
+# FFT decoder on float32 samples, fed in live-sized chunks
+def decode_fft(signal, framerate, speed_mode, chunk=1024):
+    window_len, symbol_len = get_fft_params(framerate, speed_mode)
+    samples = signal.astype(np.float32)
+    chunks = (samples[i : i + chunk] for i in range(0, len(samples), chunk))
+    freq_it = generate_freqs(chunks, window_len, chunk)
+    return bytes(int(b) for b in fft_generate_bytes(freq_it, symbol_len))
+
+
+DECODERS = dict(signchange=decode_sign_change, agc=decode_agc, fft=decode_fft)
+
+
+# Estimate bit errors between sent and received bytes. The streams are
+# aligned first, so lost or spurious bytes count as 8 bit errors each
+# rather than shifting every later byte (so a decoder emitting lots of
+# spurious bytes can score a BER above 1).
+def count_bit_errors(sent, received):
+    errors = 0
+    matcher = SequenceMatcher(None, sent, received, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "replace":
+            for a, b in zip(sent[i1:i2], received[j1:j2]):
+                errors += bin(a ^ b).count("1")
+            errors += 8 * abs((i2 - i1) - (j2 - j1))
+        elif op in ("delete", "insert"):
+            errors += 8 * ((i2 - i1) + (j2 - j1))
+    return errors
+
+
+# Run every decoder over every grid point, yielding one result dict each
+def run_benchmark(grid, speed_modes, decoders, nbytes, framerate, seed=0):
+    data = np.random.default_rng(seed).integers(0, 256, nbytes, dtype=np.uint8)
+    data = data.tobytes()
+    names = sorted(grid)
+    for speed_mode in speed_modes:
+        clean, rate = make_signal(data, speed_mode, framerate)
+        for values in product(*(grid[name] for name in names)):
+            params = dict(zip(names, values))
+            signal = simulate_channel(clean, rate, seed, **params)
+            for decoder in decoders:
+                t0 = time.perf_counter()
+                received = DECODERS[decoder](signal, rate, speed_mode)
+                elapsed = time.perf_counter() - t0
+                yield dict(
+                    decoder=decoder,
+                    speed_mode=speed_mode,
+                    params=params,
+                    ber=count_bit_errors(data, received) / (8.0 * len(data)),
+                    realtime=(len(signal) / rate) / elapsed,
+                )
+
+
+# Parse a grid spec such as "noise=0,0.1;wow=0,0.01"
+def parse_grid(spec):
+    grid = {}
+    for axis in filter(None, spec.split(";")):
+        name, _, values = axis.partition("=")
+        name = name.strip()
+        if name not in IMPAIRMENTS:
+            raise ValueError("unknown impairment %r" % name)
+        grid[name] = [float(v) for v in values.split(",")]
+    return grid
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-g",
+        "--grid",
+        dest="grid",
+        default="noise=0,0.1,0.3,0.6",
+        help="impairment grid, e.g. 'noise=0,0.1;wow=0,0.01' (impairments: %s)"
+        % ", ".join(IMPAIRMENTS),
+    )
+    parser.add_option(
+        "-s",
+        "--speeds",
+        dest="speeds",
+        default="0,1",
+        help="comma-separated speed modes (0: 300, 1: 1200, 2: 2400, 3: 4800 baud)",
+    )
+    parser.add_option(
+        "-D",
+        "--decoders",
+        dest="decoders",
+        default=",".join(DECODERS),
+        help="comma-separated decoders (%s)" % ", ".join(DECODERS),
+    )
+    parser.add_option(
+        "-n",
+        "--bytes",
+        dest="nbytes",
+        type="int",
+        default=200,
+        help="random payload bytes per run",
+    )
+    parser.add_option(
+        "-r",
+        "--rate",
+        dest="framerate",
+        type="int",
+        default=44100,
+        help="base sample rate of the simulated recording",
+    )
+    parser.add_option(
+        "--csv",
+        action="store_true",
+        default=False,
+        dest="csv",
+        help="output CSV instead of a table",
+    )
+    opts, args = parser.parse_args()
+
+    try:
+        grid = parse_grid(opts.grid)
+    except ValueError as e:
+        print("Invalid --grid: %s" % e, file=sys.stderr)
+        raise SystemExit(1)
+    speed_modes = [int(s) for s in opts.speeds.split(",")]
+    decoders = opts.decoders.split(",")
+    for decoder in decoders:
+        if decoder not in DECODERS:
+            print("Unknown decoder %r" % decoder, file=sys.stderr)
+            raise SystemExit(1)
+
+    names = sorted(grid)
+    if opts.csv:
+        print(",".join(["decoder", "speed"] + names + ["ber", "x_realtime"]))
+    else:
+        print(
+            "%-10s %5s %s %10s %10s"
+            % ("decoder", "speed", " ".join("%8s" % n[:8] for n in names), "BER", "xRT")
+        )
+    for r in run_benchmark(grid, speed_modes, decoders, opts.nbytes, opts.framerate):
+        values = [r["params"][n] for n in names]
+        if opts.csv:
+            print(
+                ",".join(
+                    [r["decoder"], str(r["speed_mode"])]
+                    + [str(v) for v in values]
+                    + ["%.6f" % r["ber"], "%.2f" % r["realtime"]]
+                )
+            )
+        else:
+            print(
+                "%-10s %5d %s %10.6f %10.2f"
+                % (
+                    r["decoder"],
+                    r["speed_mode"],
+                    " ".join("%8g" % v for v in values),
+                    r["ber"],
+                    r["realtime"],
+                )
+            )
+        sys.stdout.flush()
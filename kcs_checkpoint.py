@@ -0,0 +1,80 @@
+#
+
+# Checkpoints for long-running decodes
+# - a decoder saves its state every so often: how far into the input it
+#   got, its framing state, how many bytes it has written out and its
+#   front-end calibration
+# - a decoder restarted with --resume loads the last checkpoint, cuts its
+#   output file back to the bytes written by then and carries on from there
+# - checkpoints are small JSON files, replaced atomically, so an
+#   interrupted run always leaves a complete one behind
+#
+# Used by kcs_decode.py and the live decoders; what goes in the state is up
+# to each of them.
+
+import os
+import json
+import time
+
+VERSION = 3
+INTERVAL = 10.0  # s (wall time) between checkpoints
+
+
+class Checkpointer:
+    # params: decoding parameters (JSON-compatible) that a resumed run must
+    # share with the run that saved the checkpoint
+    def __init__(self, filename, params, interval=INTERVAL):
+        self.filename = filename
+        self.params = json.loads(json.dumps(params))
+        self.interval = interval
+        self._last = time.monotonic()
+
+    # Load the state to resume from. Raises ValueError if the checkpoint
+    # was saved with different parameters.
+    def load(self):
+        with open(self.filename) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("version") != VERSION:
+            raise ValueError("%s: unsupported checkpoint version" % self.filename)
+        params = checkpoint.get("params", {})
+        changed = sorted(
+            k
+            for k in set(params) | set(self.params)
+            if params.get(k) != self.params.get(k)
+        )
+        if changed:
+            raise ValueError(
+                "%s: saved with different %s" % (self.filename, ", ".join(changed))
+            )
+        return checkpoint["state"]
+
+    # whether the interval since the last save has passed
+    def due(self):
+        return time.monotonic() - self._last >= self.interval
+
+    # Save state. Sync the output it counts bytes of (os.fsync) first, so
+    # a crash can't leave a checkpoint ahead of the output.
+    def save(self, state):
+        tmp_path = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(dict(version=VERSION, params=self.params, state=state), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.filename)
+        self._last = time.monotonic()
+
+
+# Open an output file to carry on writing after its first nbytes, dropping
+# whatever was written after the checkpoint was saved
+def open_resumed_output(filename, nbytes):
+    f = open(filename, "r+b")
+    size = f.seek(0, os.SEEK_END)
+    if size < nbytes:
+        f.close()
+        raise ValueError(
+            "%s: %d bytes, but %d were written at the checkpoint"
+            % (filename, size, nbytes)
+        )
+    f.truncate(nbytes)
+    f.seek(nbytes)
+    return f
@@ -0,0 +1,499 @@
+#
+
+# Kansas City Standard (KCS) codec core, usable as a library
+# - no audio device access and no module-level state; every encoder and
+#   decoder instance keeps its own state, so many can coexist in a process
+# - the scripts (kcs_encode*.py, kcs_decode*.py) are built on top of this
+
+"""
+Incremental KCS encoder/decoder objects:
+
+    enc = KCSEncoder(KCSConfig(speed_mode=1))
+    pcm = enc.leader(1) + enc.encode(b"HELLO") + enc.trailer(1)
+
+    dec = KCSDecoder(KCSConfig(framerate=enc.framerate, speed_mode=1))
+    data = dec.feed(pcm)
+
+Both accept any object supporting the buffer protocol (bytes, bytearray,
+memoryview, array, numpy arrays, ...) and read it without copying.
+"""
+
+import math
+import struct
+from collections import deque
+from itertools import chain, islice
+
+KCS_BASE_FREQ = 2400  # Hz (per KCS, frequency of a one bit)
+ALGN_FRAC = 0.45  # fraction by which to advance sample on start bit
+AMPLITUDE = 120  # Amplitude of generated waves
+CENTER = 128  # Center point of generated waves
+BITMASKS = [0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80]
+SAMPLE_CODES = {"uint8": "B", "int16": "h", "float32": "f"}  # encoder formats
+MAX_TONE_ERROR = 0.04  # max frequency error of whole-sample tone cycles
+
+
+# Modulation profile: tones and framing for one speed mode
+# - one_freq/zero_freq: mark/space tone frequencies (Hz)
+# - one_cycles/zero_cycles: tone cycles per one/zero bit (equal lengths)
+# - start_bits/stop_bits: framing around the 8 data bits
+# - thres_0_hi/thres_1_lo: max sign changes in a one-bit window for a zero
+#   (start bit detection), min sign changes for a one bit
+# - min_framerate: lowest encoder output rate; a lower configured rate is
+#   doubled until it reaches this
+class KCSProfile:
+    def __init__(
+        self,
+        one_freq,
+        zero_freq,
+        one_cycles,
+        zero_cycles,
+        thres_0_hi,
+        thres_1_lo,
+        start_bits=1,
+        stop_bits=2,
+        min_framerate=0,
+    ):
+        self.one_freq = one_freq
+        self.zero_freq = zero_freq
+        self.one_cycles = one_cycles
+        self.zero_cycles = zero_cycles
+        self.thres_0_hi = thres_0_hi
+        self.thres_1_lo = thres_1_lo
+        self.start_bits = start_bits
+        self.stop_bits = stop_bits
+        self.min_framerate = min_framerate
+
+    @property
+    def baud(self):
+        return self.one_freq / self.one_cycles
+
+    def __repr__(self):
+        return "KCSProfile(%s)" % ", ".join(
+            "%s=%r" % item for item in self.__dict__.items()
+        )
+
+
+# Profiles by speed mode. 2400 baud doubles the scripts' 9600 Hz output
+# rate, as they have always done, and 4800 baud quadruples it. Add entries
+# here (or pass a KCSProfile as the speed mode) for custom speeds.
+PROFILES = {
+    0: KCSProfile(KCS_BASE_FREQ, KCS_BASE_FREQ // 2, 8, 4, 11, 13),  # 300 baud
+    1: KCSProfile(KCS_BASE_FREQ, KCS_BASE_FREQ // 2, 2, 1, 2, 3),  # 1200 baud
+    2: KCSProfile(  # 2400 baud
+        KCS_BASE_FREQ * 2, KCS_BASE_FREQ, 2, 1, 2, 3, min_framerate=19200
+    ),
+    3: KCSProfile(  # 4800 baud
+        KCS_BASE_FREQ * 4, KCS_BASE_FREQ * 2, 2, 1, 2, 3, min_framerate=38400
+    ),
+}
+
+
+# profile for a speed mode (a PROFILES key, or a KCSProfile itself)
+def get_profile(speed_mode):
+    if isinstance(speed_mode, KCSProfile):
+        return speed_mode
+    try:
+        return PROFILES[speed_mode]
+    except KeyError:
+        raise ValueError("unknown speed mode %r" % (speed_mode,)) from None
+
+
+# Codec settings shared by encoder and decoder
+# - framerate: decoder input rate; for the encoder, the base output rate
+#   (doubled up to the profile's min_framerate, e.g. in 2400 baud mode)
+# - speed_mode: a PROFILES key or a KCSProfile
+# - samplewidth/nchannels/channel: decoder PCM layout (1 = unsigned 8-bit,
+#   2 = signed 16-bit little endian, ...)
+# - out_format/out_channels: encoder PCM layout, a SAMPLE_CODES format
+#   ("uint8", "int16" little endian or "float32") and the number of channels
+#   (all carrying the same signal)
+# - exact_freq: encoder tones at their exact frequencies, phase-continuous,
+#   instead of whole-sample cycles (kcs_dsp.NCOSynth, needs numpy)
+class KCSConfig:
+    def __init__(
+        self,
+        framerate=9600,
+        speed_mode=0,
+        cuts=False,
+        kcs_base_adj=0,
+        samplewidth=1,
+        nchannels=1,
+        channel=0,
+        out_format="uint8",
+        out_channels=1,
+        exact_freq=False,
+    ):
+        self.framerate = framerate
+        self.speed_mode = speed_mode
+        self.cuts = cuts
+        self.kcs_base_adj = kcs_base_adj
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        self.channel = channel
+        self.out_format = out_format
+        self.out_channels = out_channels
+        self.exact_freq = exact_freq
+
+    def __repr__(self):
+        return "KCSConfig(%s)" % ", ".join(
+            "%s=%r" % item for item in self.__dict__.items()
+        )
+
+
+# Decoder parameters for a speed mode: (base freq, cycles per one bit,
+# max sign changes for a zero window, min sign changes for a one bit)
+def get_speed_params(speed_mode, kcs_base_adj=0):
+    profile = get_profile(speed_mode)
+    return (
+        profile.one_freq + kcs_base_adj,
+        profile.one_cycles,
+        profile.thres_0_hi,
+        profile.thres_1_lo,
+    )
+
+
+# create a single sine wave cycle of a given frequency, as PCM in one of
+# the SAMPLE_CODES formats (at the same level in each), repeated in every
+# one of nchannels channels
+def make_sin_wave(freq, framerate, sample_format="uint8", nchannels=1):
+    n = int(round(framerate / freq))
+    y = [math.sin(2 * math.pi * e / n) for e in range(n)]
+    if sample_format == "uint8":
+        samples = [int((CENTER + AMPLITUDE * e)) for e in y]
+    elif sample_format == "int16":
+        samples = [int(AMPLITUDE * 256 * e) for e in y]
+    elif sample_format == "float32":
+        samples = [AMPLITUDE / CENTER * e for e in y]
+    else:
+        raise ValueError("unknown sample format %r" % (sample_format,))
+    frames = [v for v in samples for _ in range(nchannels)]
+    return struct.pack("<%d%s" % (len(frames), SAMPLE_CODES[sample_format]), *frames)
+
+
+# whether make_sin_wave's whole-sample cycles come within MAX_TONE_ERROR of
+# a profile's tone frequencies at a given rate; further off, one and zero
+# bits differ so much in length that the output can't be decoded
+def whole_cycles_fit(profile, framerate):
+    for freq in (profile.one_freq, profile.zero_freq):
+        n = round(framerate / freq)
+        if abs(n * freq / framerate - 1) > MAX_TONE_ERROR:
+            return False
+    return True
+
+
+# Take a single byte value and turn it into the list of bits sent for it,
+# along with the required start and stop bits.
+def kcs_byte_bits(byteval, cuts, start_bits=1, stop_bits=2):
+    # The start bit (0)
+    bits = [0] * start_bits
+    # 8 data bits
+    for mask in BITMASKS:
+        if cuts and (mask == 0x80):
+            bits.append(1)  # CUTS encoding uses 3 stop bits
+        else:
+            bits.append(1 if (byteval & mask) else 0)
+    # Stop bits (1), two by default
+    return bits + [1] * stop_bits
+
+
+# Take a single byte value and turn it into a bytearray representing
+# the associated waveform along with the required start and stop bits.
+def kcs_encode_byte(byteval, one_pulse, zero_pulse, cuts, start_bits=1, stop_bits=2):
+    bits = kcs_byte_bits(byteval, cuts, start_bits, stop_bits)
+    return b"".join([one_pulse if bit else zero_pulse for bit in bits])
+
+
+# Generate a sequence of data bytes by sampling the stream of sign change bits
+# - if index is a list, a (start sample, byte value, accepted) tuple is
+#   appended to it for every framed byte, including those rejected for a
+#   missing stop bit; sample positions count from the start of bitstream
+# - if state is a dict, it is updated after every emitted byte with "pos"
+#   (samples consumed from bitstream) and "window" (the sign-change window,
+#   as a string of 0s and 1s); passing a saved window back in as window
+#   resumes decoding exactly where it stopped, on the bits following pos
+def generate_bytes(
+    bitstream,
+    framerate,
+    kcs_base_adj,
+    speed_mode,
+    cuts,
+    index=None,
+    window=None,
+    state=None,
+):
+    bitmasks = list(BITMASKS)
+    if cuts:  # CUTS encoding (1-7-3), ignore the highest bit in the byte
+        bitmasks[-1] = 0x0
+
+    # calculate adjusted KCS base frequency and speed mode thresholds
+    kcs_base_freq, fpb_mult, thres_0_hi, thres_1_lo = get_speed_params(
+        speed_mode, kcs_base_adj
+    )
+    extra_start_bits = get_profile(speed_mode).start_bits - 1
+
+    # Compute the number of audio frames used to encode a single data bit
+    frames_per_bit_real = float(framerate) * fpb_mult / kcs_base_freq
+    frames_per_bit = int(round(frames_per_bit_real))  # rounded int
+    frames_per_bit_d = frames_per_bit_real - frames_per_bit  # abs(diff)<0.5
+
+    # Queue of sampled sign bits
+    sample = deque(maxlen=frames_per_bit)
+
+    # Fill the sample buffer with an initial set of data (or the saved one)
+    if window is not None:
+        sample.extend(int(c) for c in window)
+        pos = 0
+    else:
+        sample.extend(islice(bitstream, frames_per_bit - 1))
+        pos = len(sample)  # samples consumed so far
+    sign_changes = sum(sample)
+
+    # Look for the start bit
+    prev_changes = sign_changes
+    for val in bitstream:
+        pos += 1
+        if val:
+            sign_changes += 1
+        if sample.popleft():
+            sign_changes -= 1
+        sample.append(val)
+
+        # If a start bit is detected, sample the next 8 data bits
+        # NOTE: enforce start bit to be 1-to-0; also re-aligns byte position
+        if (sign_changes < prev_changes) and (sign_changes <= thres_0_hi):
+            start = pos - len(sample)  # window covers the start bit
+            # align sample by advancing one third of a cycle (skipping
+            # any further start bits)
+            align = int(frames_per_bit * (ALGN_FRAC + extra_start_bits))
+            _ = list(islice(bitstream, align))
+            pos += len(_)
+            # obtain eight bits (least significant first)
+            byteval = 0
+            acc_diff = 0  # accumulated window position diff
+            for mask in bitmasks:
+                # obtain sample for current bit w/window correction
+                acc_diff += frames_per_bit_d
+                corr = int(round(acc_diff))
+                acc_diff -= round(acc_diff)
+                bit_sample = list(islice(bitstream, frames_per_bit + corr))
+                pos += len(bit_sample)
+                # NOTE: use partial bit sample for better error tolerance
+                bit_sample = bit_sample[: int(len(bit_sample) * 7 / 8)]
+                if sum(bit_sample) >= thres_1_lo:
+                    byteval |= mask
+            # only emit byte if the first stop bit is detected
+            stop_sample = list(islice(bitstream, frames_per_bit + 1))
+            pos += len(stop_sample)
+            sample.extend(stop_sample)
+            sign_changes = sum(sample)
+            if sign_changes >= thres_1_lo:
+                if index is not None:
+                    index.append((start, byteval, True))
+                if state is not None:
+                    state["pos"] = pos
+                    state["window"] = "".join("1" if v else "0" for v in sample)
+                yield byteval
+            elif index is not None:
+                index.append((start, byteval, False))
+
+        prev_changes = sign_changes
+
+
+# Incremental encoder: byte chunks in, PCM out (8-bit unsigned mono unless
+# the config's out_format/out_channels say otherwise). With exact_freq, or
+# at rates where whole-sample tone cycles don't fit the profile (e.g. 4800
+# baud at 44.1 kHz), tones are synthesized exactly (needs numpy); output is
+# then phase-continuous from call to call, so leader(), encode() and
+# trailer() must be called in the order the PCM is played.
+class KCSEncoder:
+    def __init__(self, config):
+        self.config = config
+        profile = get_profile(config.speed_mode)
+        self.framerate = config.framerate
+        while self.framerate < profile.min_framerate:
+            self.framerate *= 2
+        self.exact_freq = config.exact_freq or not whole_cycles_fit(
+            profile, self.framerate
+        )
+        fmt, nchannels = config.out_format, config.out_channels
+        self.frame_size = struct.calcsize("<" + SAMPLE_CODES[fmt]) * nchannels
+        self._nco = None
+        if self.exact_freq:
+            try:
+                from kcs_dsp import NCOSynth  # numpy is only needed for exact tones
+            except ImportError:
+                tones = (profile.one_freq, profile.zero_freq, self.framerate)
+                raise ValueError(
+                    "exact tone synthesis (for %g/%g Hz at %d Hz) needs numpy" % tones
+                ) from None
+
+            words = [
+                kcs_byte_bits(b, config.cuts, profile.start_bits, profile.stop_bits)
+                for b in range(256)
+            ]
+            self._nco = NCOSynth(self.framerate, profile, fmt, nchannels, words)
+            return
+
+        self.one_pulse = (
+            make_sin_wave(profile.one_freq, self.framerate, fmt, nchannels)
+            * profile.one_cycles
+        )
+        self.zero_pulse = (
+            make_sin_wave(profile.zero_freq, self.framerate, fmt, nchannels)
+            * profile.zero_cycles
+        )
+        # all 256 byte waveforms are tiny, so render them once up front
+        self._table = [
+            kcs_encode_byte(
+                b,
+                self.one_pulse,
+                self.zero_pulse,
+                config.cuts,
+                profile.start_bits,
+                profile.stop_bits,
+            )
+            for b in range(256)
+        ]
+
+    # carrier signal (ones) lasting the given number of seconds
+    def leader(self, seconds):
+        if self._nco:
+            nbits = int(self.framerate / self._nco.bit_len) * seconds
+            return self._nco.bits([1] * nbits)
+        bit_frames = len(self.one_pulse) // self.frame_size
+        return self.one_pulse * (int(self.framerate / bit_frames) * seconds)
+
+    trailer = leader
+
+    def encode(self, chunk):
+        if self._nco:
+            return self._nco.words(memoryview(chunk).cast("B"))
+        table = self._table
+        return b"".join([table[b] for b in memoryview(chunk).cast("B")])
+
+
+# Incremental decoder: PCM chunks in, decoded bytes out
+# - same algorithm as generate_bytes, but written as an explicit state
+#   machine so decoding can stop at any sample and resume on the next feed()
+class KCSDecoder:
+    _FILL, _SEARCH, _ALIGN, _BITS, _STOP = range(5)
+
+    def __init__(self, config):
+        self.config = config
+        self._bitmasks = list(BITMASKS)
+        if config.cuts:
+            self._bitmasks[-1] = 0x0
+        params = get_speed_params(config.speed_mode, config.kcs_base_adj)
+        kcs_base_freq, fpb_mult, self._thres_0_hi, self._thres_1_lo = params
+        frames_per_bit_real = float(config.framerate) * fpb_mult / kcs_base_freq
+        self._fpb = int(round(frames_per_bit_real))
+        self._fpb_d = frames_per_bit_real - self._fpb
+        self._align = int(
+            self._fpb * (ALGN_FRAC + get_profile(config.speed_mode).start_bits - 1)
+        )
+        self._offset = config.channel * config.samplewidth + config.samplewidth - 1
+        self._stride = config.samplewidth * config.nchannels
+        self.reset()
+
+    def reset(self):
+        self._pending = b""  # trailing partial frame from the last feed
+        self._previous = 0  # sign bit of the last sample
+        self._window = deque(maxlen=self._fpb)
+        self._sign_changes = 0
+        self._prev_changes = 0
+        self._state = self._FILL
+        self._remaining = self._fpb - 1  # samples left in the current state
+        self._byteval = 0
+        self._bit = 0  # index into bitmasks
+        self._acc_diff = 0.0
+        self._bit_len = 0  # length of the current bit sample
+        self._bit_sum = 0  # sign changes within the partial bit sample
+
+    def _start_bit(self):
+        self._acc_diff += self._fpb_d
+        corr = int(round(self._acc_diff))
+        self._acc_diff -= round(self._acc_diff)
+        self._bit_len = self._remaining = self._fpb + corr
+        self._bit_sum = 0
+
+    # consume a block of PCM, return the bytes completed by it
+    def feed(self, pcm):
+        data = memoryview(pcm).cast("B")
+        head = b""  # a frame completed from the last feed's partial one
+        if self._pending:
+            need = self._stride - len(self._pending)
+            if len(data) < need:
+                self._pending += bytes(data)
+                return b""
+            head = self._pending + bytes(data[:need])
+            data = data[need:]
+        usable = len(data) - len(data) % self._stride
+        self._pending = bytes(data[usable:])
+        msbytes = chain(
+            head[self._offset : self._offset + 1],
+            data[self._offset : usable : self._stride],
+        )
+
+        out = bytearray()
+        window = self._window
+        previous = self._previous
+        for byte in msbytes:
+            signbit = byte & 0x80
+            val = 1 if (signbit ^ previous) else 0
+            previous = signbit
+
+            state = self._state
+            if state == self._SEARCH:
+                if val:
+                    self._sign_changes += 1
+                if window.popleft():
+                    self._sign_changes -= 1
+                window.append(val)
+                if (self._sign_changes < self._prev_changes) and (
+                    self._sign_changes <= self._thres_0_hi
+                ):
+                    self._byteval = 0
+                    self._bit = 0
+                    self._acc_diff = 0.0
+                    self._remaining = self._align
+                    self._state = self._ALIGN
+                    if self._remaining == 0:
+                        self._state = self._BITS
+                        self._start_bit()
+                else:
+                    self._prev_changes = self._sign_changes
+            elif state == self._FILL:
+                window.append(val)
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._sign_changes = self._prev_changes = sum(window)
+                    self._state = self._SEARCH
+            elif state == self._ALIGN:
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._state = self._BITS
+                    self._start_bit()
+            elif state == self._BITS:
+                if self._bit_len - self._remaining < int(self._bit_len * 7 / 8):
+                    self._bit_sum += val
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    if self._bit_sum >= self._thres_1_lo:
+                        self._byteval |= self._bitmasks[self._bit]
+                    self._bit += 1
+                    if self._bit < len(self._bitmasks):
+                        self._start_bit()
+                    else:
+                        self._state = self._STOP
+                        self._remaining = self._fpb + 1
+            else:  # _STOP
+                window.append(val)
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._sign_changes = sum(window)
+                    if self._sign_changes >= self._thres_1_lo:
+                        out.append(self._byteval)
+                    self._prev_changes = self._sign_changes
+                    self._state = self._SEARCH
+        self._previous = previous
+        return bytes(out)
@@ -13,26 +13,48 @@ extracts text data from it. See:
 http://en.wikipedia.org/wiki/Kansas_City_standard
 """
 
+import os
 import sys
+import json
+import struct
 import optparse
-from itertools import islice
+from itertools import chain, islice
+from queue import Queue
+from threading import Thread
 import wave
 
-from kcs_decode_live import generate_bytes
+from kcs_audio import FORMATS, RawPCMReader
+from kcs_codec import generate_bytes, get_speed_params
+from kcs_checkpoint import INTERVAL, Checkpointer, open_resumed_output
+
+INDEX_MAGIC = b"KCSIDX1\n"
+RAW_RATE = 44100  # default --rate of raw input
+
+
+# Read blocks of frames from the current file position, for at most
+# nframes if given
+def read_wav_blocks(wavefile, nframes=None, blocksize=8192):
+    framesize = wavefile.getsampwidth() * wavefile.getnchannels()
+    while nframes is None or nframes > 0:
+        frames = wavefile.readframes(
+            blocksize if nframes is None else min(blocksize, nframes)
+        )
+        if not frames:
+            break
+        if nframes is not None:
+            nframes -= len(frames) // framesize
+        yield frames
 
 
 # Generate a sequence representing sign bits
-def generate_wav_sign_change_bits(wavefile):
+def generate_wav_sign_change_bits(wavefile, channel=0, nframes=None):
     samplewidth = wavefile.getsampwidth()
     nchannels = wavefile.getnchannels()
+    offset = channel * samplewidth + samplewidth - 1
     previous = 0
-    while True:
-        frames = wavefile.readframes(8192)
-        if not frames:
-            break
-
-        # Extract most significant bytes from left-most audio channel
-        msbytes = bytearray(frames[samplewidth - 1 :: samplewidth * nchannels])
+    for frames in read_wav_blocks(wavefile, nframes):
+        # Extract most significant bytes from the selected audio channel
+        msbytes = bytearray(frames[offset :: samplewidth * nchannels])
 
         # Emit a stream of sign-change bits
         for byte in msbytes:
@@ -41,6 +63,255 @@ def generate_wav_sign_change_bits(wavefile):
             previous = signbit
 
 
+# Generate sign-change bits with automatic gain control: full sample
+# precision, running DC/envelope tracking and adaptive hysteresis, for
+# quiet, loud or DC-shifted recordings
+# - front_end: a kcs_dsp.AGCFrontEnd to run, e.g. one seeded from a
+#   checkpoint
+# - if state is a dict, "pos" (the file position of the block of frames
+#   being processed) and "agc" (the front end's get_state() going into that
+#   block) are kept in it; restarted at such a position with such a front
+#   end, the output carries on exactly as before
+# - the bits lag the audio by front_end.delay samples
+def generate_wav_agc_sign_change_bits(
+    wavefile, channel=0, nframes=None, front_end=None, state=None
+):
+    from kcs_dsp import AGCFrontEnd, pcm_to_float  # numpy is only needed for AGC
+
+    samplewidth = wavefile.getsampwidth()
+    nchannels = wavefile.getnchannels()
+    if front_end is None:
+        front_end = AGCFrontEnd(wavefile.getframerate())
+    pos = wavefile.tell()
+    for frames in read_wav_blocks(wavefile, nframes):
+        if state is not None:
+            state["pos"] = pos
+            state["agc"] = front_end.get_state()
+        pos += len(frames) // (samplewidth * nchannels)
+        samples = pcm_to_float(frames, samplewidth, nchannels, channel)
+        yield from front_end.process(samples).tolist()
+
+
+# Sign-change bits of a WAV channel from the current position, as one numpy
+# array per block of frames read: the bits of generate_wav_sign_change_bits
+# or, with agc, those of generate_wav_agc_sign_change_bits (for the cache)
+def generate_wav_sign_change_blocks(wavefile, channel=0, agc=False):
+    # numpy is only needed for caching
+    from kcs_dsp import AGCFrontEnd, msb_sign_changes, pcm_to_float
+
+    samplewidth = wavefile.getsampwidth()
+    nchannels = wavefile.getnchannels()
+    front_end = AGCFrontEnd(wavefile.getframerate()) if agc else None
+    previous = [0]
+    for frames in read_wav_blocks(wavefile, blocksize=1 << 16):
+        if front_end:
+            samples = pcm_to_float(frames, samplewidth, nchannels, channel)
+            yield front_end.process(samples)
+        else:
+            (bits,) = msb_sign_changes(
+                frames, samplewidth, nchannels, [channel], previous
+            )
+            yield bits
+
+
+# Carrier gate pass over (at most nframes of) a WAV channel from the current
+# position. Returns the region map as (start, end, name) tuples, with
+# sample positions relative to where the pass began.
+def scan_wav_regions(wavefile, channel, frames_per_bit, one_freq, nframes=None):
+    # numpy is only needed for -G
+    from kcs_dsp import CarrierGate, REGION_NAMES, pcm_to_float
+
+    samplewidth = wavefile.getsampwidth()
+    nchannels = wavefile.getnchannels()
+    gate = CarrierGate(wavefile.getframerate(), frames_per_bit, one_freq)
+    for frames in read_wav_blocks(wavefile, nframes, 1 << 16):
+        gate.classify(pcm_to_float(frames, samplewidth, nchannels, channel))
+    return [(lo, hi, REGION_NAMES[label]) for lo, hi, label in gate.flush()]
+
+
+# Number of audio frames per data bit for a given speed mode
+def get_frames_per_bit(framerate, kcs_base_adj, speed_mode):
+    kcs_base_freq, fpb_mult, _, _ = get_speed_params(speed_mode, kcs_base_adj)
+    return float(framerate) * fpb_mult / kcs_base_freq
+
+
+# Decode several channels of a WAV file concurrently from a single read.
+# The file is read once; each channel's sign-change bits are handed to its
+# own decoder thread through a bounded queue, which keeps the channels in
+# lock-step and memory use flat. Returns one list of (position, byte)
+# tuples per channel, where position is the sample offset of the start bit.
+# An error in a decoder thread stops the read and is raised here.
+def decode_wav_channels(wavefile, channels, kcs_base_adj, speed_mode, cuts):
+    from kcs_dsp import msb_sign_changes  # numpy is only needed for -c
+
+    samplewidth = wavefile.getsampwidth()
+    nchannels = wavefile.getnchannels()
+    framerate = wavefile.getframerate()
+    queues = [Queue(maxsize=16) for _ in channels]
+    results = [[] for _ in channels]
+    errors = []
+
+    def decode_channel(q, result):
+        done = False
+
+        def bits():
+            nonlocal done
+            while True:
+                block = q.get()
+                if block is None:
+                    done = True
+                    return
+                yield from block
+
+        try:
+            index = []
+            for _ in generate_bytes(
+                bits(), framerate, kcs_base_adj, speed_mode, cuts, index
+            ):
+                pass
+            result.extend((start, byteval) for start, byteval, ok in index if ok)
+        except Exception as e:
+            errors.append(e)
+            while not done and q.get() is not None:
+                pass  # keep taking blocks until the reader sees the error
+
+    threads = [
+        Thread(target=decode_channel, args=(q, result), daemon=True)
+        for q, result in zip(queues, results)
+    ]
+    for t in threads:
+        t.start()
+
+    # single reader: split each block of frames into per-channel bit blocks
+    previous = [0] * len(channels)
+    while not errors:
+        frames = wavefile.readframes(8192)
+        if not frames:
+            break
+        changes = msb_sign_changes(frames, samplewidth, nchannels, channels, previous)
+        for q, bits in zip(queues, changes):
+            q.put(bits.tobytes())
+    for q in queues:
+        q.put(None)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+# Merge the per-channel outputs of decode_wav_channels into a best-of
+# stream. Bytes decoded within `tolerance` samples of each other are taken
+# to be the same byte; their value is decided by majority vote, ties going
+# to the channel listed first. Bytes found on only one channel are kept, so
+# a dropout on one channel is filled in from the others.
+def merge_channel_bytes(results, tolerance):
+    events = sorted(
+        (position, rank, byteval)
+        for rank, result in enumerate(results)
+        for position, byteval in result
+    )
+    merged = bytearray()
+    i = 0
+    while i < len(events):
+        group = [events[i]]
+        i += 1
+        while i < len(events) and events[i][0] - group[0][0] <= tolerance:
+            if events[i][1] in (e[1] for e in group):
+                break  # a channel can only contribute once per byte
+            group.append(events[i])
+            i += 1
+        votes = {}
+        for _, rank, byteval in group:
+            count, best_rank = votes.get(byteval, (0, rank))
+            votes[byteval] = (count + 1, min(best_rank, rank))
+        merged.append(max(votes, key=lambda b: (votes[b][0], -votes[b][1])))
+    return bytes(merged)
+
+
+# Write a sidecar index for a decode of samples [start, end). index holds
+# (sample, byte, accepted) tuples as recorded by generate_bytes, with
+# sample positions made absolute (relative to the start of the file).
+# Layout: magic, one JSON header line, then little-endian arrays of
+# uint64 byte start samples, uint64 rejected frame starts, uint8 rejected
+# frame values and uint64 (start, end) gap pairs.
+def write_index(filename, index, start, end, word_frames, params):
+    starts = [pos for pos, _, ok in index if ok]
+    rejected = [(pos, byteval) for pos, byteval, ok in index if not ok]
+
+    # gaps: spans longer than two frames with nothing framed in them
+    # (no carrier, or bare leader tone between files)
+    gaps = []
+    prev_end = start
+    for pos, _, _ in index:
+        if pos - prev_end > 2 * word_frames:
+            gaps.append((prev_end, pos))
+        prev_end = pos + word_frames
+    if end - prev_end > 2 * word_frames:
+        gaps.append((prev_end, end))
+
+    header = dict(
+        params,
+        offset=start,
+        end=end,
+        bytes=len(starts),
+        rejected=len(rejected),
+        gaps=len(gaps),
+    )
+    with open(filename, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(json.dumps(header).encode("ascii") + b"\n")
+        f.write(struct.pack("<%dQ" % len(starts), *starts))
+        f.write(struct.pack("<%dQ" % len(rejected), *(p for p, _ in rejected)))
+        f.write(bytes(v for _, v in rejected))
+        f.write(struct.pack("<%dQ" % (2 * len(gaps)), *(p for g in gaps for p in g)))
+
+
+# Read a sidecar index written by write_index
+def read_index(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("%s is not a KCS index file" % filename)
+        header = json.loads(f.readline())
+        data = f.read()
+
+    def take(fmt, n):
+        nonlocal data
+        size = struct.calcsize("<%d%s" % (n, fmt))
+        values, data = struct.unpack("<%d%s" % (n, fmt), data[:size]), data[size:]
+        return list(values)
+
+    header["starts"] = take("Q", header["bytes"])
+    rejected_starts = take("Q", header["rejected"])
+    header["rejected"] = list(zip(rejected_starts, take("B", len(rejected_starts))))
+    gaps = take("Q", 2 * header["gaps"])
+    header["gaps"] = list(zip(gaps[::2], gaps[1::2]))
+    return header
+
+
+# Parse a "START:END" range option; either end may be left out. Raises
+# ValueError unless 0 <= START <= END.
+def parse_range(value, default_end):
+    start, _, end = value.partition(":")
+    start, end = int(start or 0), int(end) if end else default_end
+    if not 0 <= start <= end:
+        raise ValueError("%r is not a range START:END with 0 <= START <= END" % value)
+    return start, end
+
+
+# Parse a channel list option ("all" or comma-separated channel numbers)
+def parse_channels(value, nchannels):
+    if value == "all":
+        return list(range(nchannels))
+    channels = [int(c) for c in value.split(",")]
+    for channel in channels:
+        if not 0 <= channel < nchannels:
+            raise ValueError(
+                "channel %d out of range (0-%d)" % (channel, nchannels - 1)
+            )
+    return channels
+
+
 if __name__ == "__main__":
     parser = optparse.OptionParser()
     parser.add_option(
@@ -57,7 +328,7 @@ if __name__ == "__main__":
         type="int",
         default=0,
         dest="speed_mode",
-        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
     )
     parser.add_option(
         "-a",
@@ -67,23 +338,401 @@ if __name__ == "__main__":
         dest="cuts",
         help="ASCII only w/CUTS encoding (7 data bits, 3 stop bits)",
     )
+    parser.add_option(
+        "-g",
+        "--agc",
+        action="store_true",
+        default=False,
+        dest="agc",
+        help="automatic gain control front end for weak or DC-shifted audio",
+    )
+    parser.add_option(
+        "-G",
+        "--gate",
+        action="store_true",
+        default=False,
+        dest="gate",
+        help="skip silence and leader tone before framing (needs numpy); "
+        "the region map goes to stderr",
+    )
+    parser.add_option(
+        "-c",
+        "--channels",
+        dest="channels",
+        default="0",
+        help="channels to decode, comma-separated or 'all' (default 0)",
+    )
+    parser.add_option(
+        "-M",
+        "--merge",
+        action="store_true",
+        default=False,
+        dest="merge",
+        help="merge multiple channels into a single best-of output",
+    )
+    parser.add_option(
+        "-o",
+        "--output-file",
+        dest="output_file",
+        help="output file to write to (per-channel files get a .chN suffix)",
+    )
+    parser.add_option(
+        "-i",
+        "--write-index",
+        dest="write_index",
+        help="write a sidecar index of byte/gap/rejected frame sample offsets",
+    )
+    parser.add_option(
+        "-I",
+        "--read-index",
+        dest="read_index",
+        help="sidecar index to look up --byte-range positions in",
+    )
+    parser.add_option(
+        "-r",
+        "--sample-range",
+        dest="sample_range",
+        help="only decode samples START:END",
+    )
+    parser.add_option(
+        "-R",
+        "--byte-range",
+        dest="byte_range",
+        help="only re-decode bytes FIRST:LAST of a previous decode (needs -I)",
+    )
+    parser.add_option(
+        "--cache-dir",
+        dest="cache_dir",
+        help="cache front-end bit streams in this directory (needs numpy)",
+    )
+    parser.add_option(
+        "--cache-max-mb",
+        dest="cache_max_mb",
+        type="int",
+        default=1024,
+        help="size limit of the cache directory in MiB (default 1024)",
+    )
+    parser.add_option(
+        "--checkpoint",
+        dest="checkpoint",
+        help="save decoder state to this file as the decode goes on "
+        "(needs --output-file)",
+    )
+    parser.add_option(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        type="float",
+        default=INTERVAL,
+        help="seconds between checkpoints (default %g)" % INTERVAL,
+    )
+    parser.add_option(
+        "--resume",
+        action="store_true",
+        default=False,
+        dest="resume",
+        help="carry on from the last --checkpoint, appending to --output-file",
+    )
+    parser.add_option(
+        "--raw",
+        action="store_true",
+        default=False,
+        dest="raw",
+        help="infile is raw PCM, e.g. a FIFO (- is standard input), "
+        "decoded as it arrives",
+    )
+    parser.add_option(
+        "--rate",
+        type="int",
+        default=RAW_RATE,
+        dest="framerate",
+        help="sample rate of raw input in Hz (default %d)" % RAW_RATE,
+    )
+    parser.add_option(
+        "--format",
+        type="choice",
+        choices=list(FORMATS),
+        default="s16",
+        dest="format",
+        help="sample format of raw input: u8, s16 or float (default s16; "
+        "float needs numpy)",
+    )
+    parser.add_option(
+        "--nchannels",
+        type="int",
+        default=1,
+        dest="nchannels",
+        help="number of channels of raw input (default 1)",
+    )
 
     opts, args = parser.parse_args()
     if len(args) != 1:
         print("Usage: %s [options] infile" % sys.argv[0], file=sys.stderr)
         raise SystemExit(1)
 
-    wf = wave.open(args[0])
-    sign_changes = generate_wav_sign_change_bits(wf)
-    byte_stream = generate_bytes(
-        sign_changes, wf.getframerate(), opts.kcs_base_adj, opts.speed_mode, opts.cuts
-    )
+    if opts.raw:
+        # a stream can't be read twice or hashed up front
+        if opts.gate or opts.cache_dir:
+            print("--raw can't be used with --gate or --cache-dir", file=sys.stderr)
+            raise SystemExit(1)
+        rawf = sys.stdin.buffer if args[0] == "-" else open(args[0], "rb")
+        wf = RawPCMReader(rawf, opts.framerate, FORMATS[opts.format], opts.nchannels)
+    else:
+        wf = wave.open(args[0])
+    try:
+        channels = parse_channels(opts.channels, wf.getnchannels())
+    except ValueError as e:
+        print("Invalid --channels: %s" % e, file=sys.stderr)
+        raise SystemExit(1)
+    single_channel_opts = [
+        name
+        for name, value in [
+            ("-i", opts.write_index),
+            ("-I", opts.read_index),
+            ("-r", opts.sample_range),
+            ("-R", opts.byte_range),
+            ("-g", opts.agc),
+            ("-G", opts.gate),
+            ("--cache-dir", opts.cache_dir),
+            ("--checkpoint", opts.checkpoint),
+            ("--resume", opts.resume),
+        ]
+        if value
+    ]
+    if len(channels) > 1 and single_channel_opts:
+        print(
+            "%s can only be used with one channel" % ", ".join(single_channel_opts),
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+    if opts.resume and not opts.checkpoint:
+        print("--resume needs --checkpoint", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.checkpoint and not opts.output_file:
+        print("--checkpoint needs --output-file", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.resume and opts.write_index:
+        print("--resume can't write an index", file=sys.stderr)
+        raise SystemExit(1)
+
+    if len(channels) > 1:
+        if not (opts.merge or opts.output_file):
+            print("Multiple channels need --merge or --output-file", file=sys.stderr)
+            raise SystemExit(1)
+        results = decode_wav_channels(
+            wf, channels, opts.kcs_base_adj, opts.speed_mode, opts.cuts
+        )
+        if opts.merge:
+            frames_per_bit = get_frames_per_bit(
+                wf.getframerate(), opts.kcs_base_adj, opts.speed_mode
+            )
+            data = merge_channel_bytes(results, frames_per_bit * 11 / 2)
+            if opts.output_file:
+                with open(opts.output_file, "wb") as outf:
+                    outf.write(data)
+            else:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+        else:
+            root, ext = os.path.splitext(opts.output_file)
+            for channel, result in zip(channels, results):
+                with open("%s.ch%d%s" % (root, channel, ext), "wb") as outf:
+                    outf.write(bytes(byteval for _, byteval in result))
+        raise SystemExit(0)
+
+    # work out the region to decode, seeking straight to its start
+    framerate = wf.getframerate()
+    frames_per_bit = get_frames_per_bit(framerate, opts.kcs_base_adj, opts.speed_mode)
+    word_frames = int(frames_per_bit * 11)
+    start, end = 0, wf.getnframes()
+    if opts.sample_range:
+        try:
+            start, end = parse_range(opts.sample_range, end)
+        except ValueError as e:
+            parser.error("invalid --sample-range: %s" % e)
+        if start > wf.getnframes():
+            parser.error("--sample-range starts after the end of the input")
+    if opts.byte_range:
+        if not opts.read_index:
+            print("--byte-range needs --read-index", file=sys.stderr)
+            raise SystemExit(1)
+        idx = read_index(opts.read_index)
+        starts = idx["starts"]
+        try:
+            first, last = parse_range(opts.byte_range, len(starts))
+        except ValueError as e:
+            parser.error("invalid --byte-range: %s" % e)
+        if not 0 <= first < last <= len(starts):
+            print("Byte range outside of 0:%d" % len(starts), file=sys.stderr)
+            raise SystemExit(1)
+        # start inside the previous byte's stop bits, end after the last one's
+        start = max(0, starts[first] - int(frames_per_bit * 1.5))
+        end = starts[last - 1] + word_frames + int(frames_per_bit)
+    end = min(end, wf.getnframes())
+
+    # replay cached front-end output; the first run caches the whole file's,
+    # whatever part of it is decoded
+    if opts.agc:
+        from kcs_dsp import AGCFrontEnd  # numpy is only needed for AGC
+
+        front_end, front_end_name = generate_wav_agc_sign_change_bits, "agc"
+    else:
+        front_end, front_end_name = generate_wav_sign_change_bits, "msb"
+    cache = None
+    if opts.cache_dir:
+        # numpy is only needed for caching
+        from kcs_cache import BitCache
+        from kcs_dsp import frame_bit_blocks
+
+        cache = BitCache(opts.cache_dir, opts.cache_max_mb << 20)
+        key = cache.key(args[0], channel=channels[0], frontend=front_end_name)
+
+    # optionally skip silence and bare leader tone before framing
+    spans = [(start, end)]
+    if opts.gate:
+        kcs_base_freq = get_speed_params(opts.speed_mode, opts.kcs_base_adj)[0]
+        wf.setpos(start)
+        regions = scan_wav_regions(
+            wf, channels[0], frames_per_bit, kcs_base_freq, end - start
+        )
+        spans = []
+        for lo, hi, name in regions:
+            lo, hi = start + lo, start + hi
+            print(
+                "%10.3fs %10.3fs  %s" % (lo / framerate, hi / framerate, name),
+                file=sys.stderr,
+            )
+            if name == "data":
+                spans.append((lo, hi))
+
+    # checkpoints hold where framing got to (sample position and window),
+    # the bytes written so far and the AGC front end's block position and
+    # state
+    checkpointer = None
+    resume_pos, resume_window, calibration, written = start, None, None, 0
+    if opts.checkpoint:
+        params = dict(
+            source=os.path.basename(args[0]),
+            nframes=wf.getnframes(),
+            framerate=framerate,
+            channel=channels[0],
+            speed_mode=opts.speed_mode,
+            kcs_base_adj=opts.kcs_base_adj,
+            cuts=opts.cuts,
+            frontend=front_end_name,
+            gate=opts.gate,
+            start=start,
+            end=end,
+        )
+        checkpointer = Checkpointer(opts.checkpoint, params, opts.checkpoint_interval)
+    if opts.resume:
+        try:
+            state = checkpointer.load()
+            outf = open_resumed_output(opts.output_file, state["bytes"])
+        except (OSError, ValueError) as e:
+            print("Can't resume: %s" % e, file=sys.stderr)
+            raise SystemExit(1)
+        resume_pos, resume_window = state["pos"], state["window"]
+        calibration, written = state["agc"], state["bytes"]
+        spans = [(max(lo, resume_pos), hi) for lo, hi in spans if hi > resume_pos]
+    progress = dict(pos=resume_pos, window=resume_window, agc=calibration)
+
+    index = [] if opts.write_index else None
+
+    def decode_span(lo, hi):
+        # resuming inside this span: framing picks up with the saved window
+        window = resume_window if lo == resume_pos else None
+        agc = None
+        sign_changes = None
+        framer = generate_bytes
+        if cache:
+            sign_changes = cache.get(key, lo, hi - lo)
+            if sign_changes is None:
+                wf.setpos(0)
+                blocks = generate_wav_sign_change_blocks(wf, channels[0], opts.agc)
+                cache.put(key, blocks)
+                sign_changes = cache.get(key, lo, hi - lo)
+            framer = frame_bit_blocks
+        if sign_changes is None and opts.agc:
+            # a resumed AGC front end starts over on the block it was in,
+            # with the state it had there, so it runs just as it did
+            agc = AGCFrontEnd(framerate)
+            agc_state = {}
+            first = lo
+            if window is not None and calibration:
+                first = calibration[0]
+                agc.set_state(calibration[1:])
+            wf.setpos(first)
+            sign_changes = front_end(wf, channels[0], hi - first, agc, agc_state)
+            sign_changes = islice(sign_changes, lo - first, None)
+        elif sign_changes is None:
+            # a resumed front end starts a sample early, so that the first
+            # sign change is taken against the sample before lo
+            lookback = 1 if window is not None and lo > 0 else 0
+            wf.setpos(lo - lookback)
+            sign_changes = front_end(wf, channels[0], hi - lo + lookback)
+            sign_changes = islice(sign_changes, lookback, None)
+        span_index = [] if index is not None else None
+        span_state = {}
+        for byteval in framer(
+            sign_changes,
+            framerate,
+            opts.kcs_base_adj,
+            opts.speed_mode,
+            opts.cuts,
+            span_index,
+            window,
+            span_state,
+        ):
+            progress["pos"] = lo + span_state["pos"]
+            progress["window"] = span_state["window"]
+            if agc:
+                progress["agc"] = [agc_state["pos"]] + agc_state["agc"]
+            yield byteval
+        if index is not None:
+            index.extend((lo + pos, byteval, ok) for pos, byteval, ok in span_index)
+
+    byte_stream = chain.from_iterable(decode_span(lo, hi) for lo, hi in spans)
 
     # Output the byte stream in 80-byte chunks (optionally to file)
-    stdout = sys.stdout.buffer.raw
-    while True:
-        buffer = bytes(islice(byte_stream, 80))
-        if not buffer:
-            break
-        stdout.write(buffer)
-        stdout.flush()
+    if opts.resume:
+        pass  # opened above, after the bytes written before
+    elif opts.output_file:
+        outf = open(opts.output_file, "wb")
+    else:
+        outf = sys.stdout.buffer.raw
+    saved = dict(progress, bytes=written)  # state as of the output so far
+    try:
+        while True:
+            buffer = bytes(islice(byte_stream, 80))
+            if not buffer:
+                break
+            outf.write(buffer)
+            outf.flush()
+            written += len(buffer)
+            saved = dict(progress, bytes=written)
+            if checkpointer and checkpointer.due():
+                os.fsync(outf.fileno())
+                checkpointer.save(saved)
+    except KeyboardInterrupt:
+        if not checkpointer:
+            raise
+        os.fsync(outf.fileno())
+        checkpointer.save(saved)
+        print("Interrupted, resume with --resume", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.raw:  # the stream's length is known now it has ended
+        end = min(end, wf.tell())
+    if checkpointer:  # all done: a resumed run has nothing left to decode
+        os.fsync(outf.fileno())
+        checkpointer.save(dict(saved, pos=end, window=None))
+
+    if opts.write_index:
+        params = dict(
+            source=os.path.basename(args[0]),
+            framerate=framerate,
+            channel=channels[0],
+            speed_mode=opts.speed_mode,
+            kcs_base_adj=opts.kcs_base_adj,
+            cuts=opts.cuts,
+        )
+        write_index(opts.write_index, index, start, end, word_frames, params)
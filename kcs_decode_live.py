@@ -5,145 +5,143 @@
 # - Original code: https://github.com/gstrike/py-kcs
 # - Original-original code: http://www.dabeaz.com/py-kcs
 
+import os
 import sys
+import time
 import optparse
-from collections import deque
-from itertools import islice
 
-import pyaudio
+from kcs_audio import INT16, SAMPLE_SIZES, make_backend
+from kcs_codec import generate_bytes, get_speed_params, get_profile
+from kcs_latency import LatencyMeter
+from kcs_checkpoint import INTERVAL, Checkpointer, open_resumed_output
 
 # audio I/O settings
-FORMAT = pyaudio.paInt16  # must be signed integer type
+FORMAT = INT16  # must be signed integer type
 CHANNELS = 1
 FRAMERATE = 44100
 CHUNK = 1024  # sweetspot, don't touch
-KCS_BASE_FREQ = 2400
+LOW_LATENCY_CHUNK = 128  # capture block size in low-latency mode
+REPORT_TIME = 5  # s between latency reports
 MSB_HI_THRES = 0x7F // 8  # MSB sign-change thresholds
 MSB_LO_THRES = 0xFF - MSB_HI_THRES  # symmetric
-ALGN_FRAC = 0.45  # fraction by which to advance sample on start bit
-
-# init PyAudio
-pa = pyaudio.PyAudio()
-
-
-# Generate a sequence representing sign changes
-def generate_wav_sign_change_bits(device, monitor_device):
-    samplewidth = pa.get_sample_size(FORMAT)
-
-    # start Recording
-    stream = pa.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=FRAMERATE,
-        input=True,
-        input_device_index=device,
-        frames_per_buffer=CHUNK,
-    )
-
-    if monitor_device >= 0:
-        stream2 = pa.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=FRAMERATE,
-            output=True,
-            output_device_index=monitor_device,
-            frames_per_buffer=CHUNK,
-        )
 
-    # yield one sign-change bit for each sample
-    previous = 0  # init to low
-    while True:
-        # obtain samples
-        frames = stream.read(CHUNK, exception_on_overflow=False)
-        if not frames:
-            stream.close()
-            break
+
+# Generate the sign changes of the audio from an input device of an audio
+# backend (kcs_audio), as (start, bits) pairs: one for every stretch of
+# audio passed on without a break, where start counts the samples passed on
+# before it and bits generates one sign-change bit per sample of it
+# - with agc, use the full-precision AGC/adaptive hysteresis front end
+#   instead of the fixed thresholds on the high byte (agc may be a
+#   kcs_dsp.AGCFrontEnd to run, e.g. one seeded from a checkpoint)
+# - with a kcs_dsp.CarrierGate, only audio in (or near) data regions is
+#   passed on, and each new stretch starts after a gap; completed regions
+#   of the map are reported on stderr
+# - with a kcs_latency.LatencyMeter, the arrival of every block passed on
+#   is recorded (when it was captured, not when the gate let it through)
+def generate_wav_sign_change_regions(
+    audio,
+    device,
+    monitor_device,
+    agc=False,
+    gate=None,
+    block_size=CHUNK,
+    meter=None,
+):
+    samplewidth = SAMPLE_SIZES[FORMAT]
+
+    if agc or gate:
+        # numpy is only needed for -g/-G
+        from kcs_dsp import AGCFrontEnd, REGION_NAMES, pcm_to_float
+    if agc is True:
+        front_end = AGCFrontEnd(FRAMERATE)
+    elif agc:
+        front_end = agc
+
+    # blocks of frames passed on, each with its arrival time and whether a
+    # gap comes before it
+    def read_blocks():
+        # start Recording
+        stream = audio.open_input(device, FRAMERATE, FORMAT, CHANNELS, block_size)
+
         if monitor_device >= 0:
-            stream2.write(frames)
-
-        # Extract most significant bytes from left-most audio channel
-        msbytes = bytearray(frames[samplewidth - 1 :: samplewidth * CHANNELS])
-
-        # Emit a stream of sign-change bits
-        for byte in msbytes:
-            # error tolerance: only flip pos if over threshold (either side)
-            if previous == 0:  # flip high if sample > 0 and over thres
-                pos = 1 if ((byte < 0x80) and (byte > MSB_HI_THRES)) else 0
-            else:  # flip low if sample < 0 and under thres
-                pos = 0 if ((byte > 0x80) and (byte < MSB_LO_THRES)) else 1
-            # XOR with previous pos to get change bit
-            yield 1 if (pos ^ previous) else 0
-            previous = pos
-
-
-# Generate a sequence of data bytes by sampling the stream of sign change bits
-def generate_bytes(bitstream, framerate, kcs_base_adj, speed_mode, cuts):
-    bitmasks = [0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80]
-    if cuts:  # CUTS encoding (1-7-3), ignore the highest bit in the byte
-        bitmasks[-1] = 0x0
-
-    # calculate adjusted KCS base frequency
-    kcs_base_freq = KCS_BASE_FREQ
-    if speed_mode == 2:  # double for 2400 baud
-        kcs_base_freq *= 2
-    kcs_base_freq += kcs_base_adj
-
-    # set speed mode
-    if speed_mode > 0:  # 1200/2400 baud
-        fpb_mult = 2  # 2 cycles for a one bit
-        thres_0_hi = 2
-        thres_1_lo = 3
-    else:  # 300 baud
-        fpb_mult = 8  # 8 cycles for a one bit
-        thres_0_hi = 11
-        thres_1_lo = 13
-
-    # Compute the number of audio frames used to encode a single data bit
-    frames_per_bit_real = float(framerate) * fpb_mult / kcs_base_freq
-    frames_per_bit = int(round(frames_per_bit_real))  # rounded int
-    frames_per_bit_d = frames_per_bit_real - frames_per_bit  # abs(diff)<0.5
-
-    # Queue of sampled sign bits
-    sample = deque(maxlen=frames_per_bit)
-
-    # Fill the sample buffer with an initial set of data
-    sample.extend(islice(bitstream, frames_per_bit - 1))
-    sign_changes = sum(sample)
-
-    # Look for the start bit
-    prev_changes = sign_changes
-    for val in bitstream:
-        if val:
-            sign_changes += 1
-        if sample.popleft():
-            sign_changes -= 1
-        sample.append(val)
-
-        # If a start bit is detected, sample the next 8 data bits
-        # NOTE: enforce start bit to be 1-to-0; also re-aligns byte position
-        if (sign_changes < prev_changes) and (sign_changes <= thres_0_hi):
-            # align sample by advancing one third of a cycle
-            _ = list(islice(bitstream, int(frames_per_bit * ALGN_FRAC)))
-            # obtain eight bits (least significant first)
-            byteval = 0
-            acc_diff = 0  # accumulated window position diff
-            for mask in bitmasks:
-                # obtain sample for current bit w/window correction
-                acc_diff += frames_per_bit_d
-                corr = int(round(acc_diff))
-                acc_diff -= round(acc_diff)
-                bit_sample = list(islice(bitstream, frames_per_bit + corr))
-                # NOTE: use partial bit sample for better error tolerance
-                bit_sample = bit_sample[: int(len(bit_sample) * 7 / 8)]
-                if sum(bit_sample) >= thres_1_lo:
-                    byteval |= mask
-            # only emit byte if the first stop bit is detected
-            sample.extend(islice(bitstream, frames_per_bit + 1))
-            sign_changes = sum(sample)
-            if sign_changes >= thres_1_lo:
-                yield byteval
+            stream2 = audio.open_output(
+                monitor_device, FRAMERATE, FORMAT, CHANNELS, block_size
+            )
+        reported = 0  # regions of the gate's map reported so far
+
+        # report the completed regions (the last one may still grow)
+        def report(regions):
+            for lo, hi, label in regions:
+                print(
+                    "%10.3fs %10.3fs  %s"
+                    % (lo / FRAMERATE, hi / FRAMERATE, REGION_NAMES[label]),
+                    file=sys.stderr,
+                )
+
+        while True:
+            # obtain samples
+            frames = stream.read(block_size)
+            if not frames:
+                stream.close()
+                if monitor_device >= 0:
+                    stream2.close()
+                if gate:
+                    # the end of the input completes the rest of the map
+                    report(gate.flush()[reported:])
+                break
+            arrival = time.monotonic()
+            if monitor_device >= 0:
+                stream2.write(frames)
+
+            if not gate:
+                yield frames, arrival, False
+                continue
+            samples = pcm_to_float(frames, samplewidth, CHANNELS)
+            blocks = gate.push((frames, arrival), samples)
+            report(gate.regions[reported:-1])
+            reported = max(reported, len(gate.regions) - 1)
+            for i, (frames, arrival) in enumerate(blocks):
+                yield frames, arrival, gate.gap and i == 0
+
+    blocks = read_blocks()
+    first = next(blocks, (None, None, False))[:2]  # first block of a stretch
+    passed = 0  # samples passed on so far
 
-        prev_changes = sign_changes
+    # yield one sign-change bit for each sample, up to the next gap
+    def stretch():
+        nonlocal first, passed
+        (frames, arrival), first = first, (None, None)
+        previous = 0  # init to low
+        while frames is not None:
+            nframes = len(frames) // (samplewidth * CHANNELS)
+            passed += nframes
+            if meter:
+                meter.arrived(nframes, arrival)
+            if agc:
+                samples = pcm_to_float(frames, samplewidth, CHANNELS)
+                yield from front_end.process(samples).tolist()
+            else:
+                # Extract most significant bytes from left-most audio channel
+                msbytes = bytearray(frames[samplewidth - 1 :: samplewidth * CHANNELS])
+
+                # Emit a stream of sign-change bits
+                for byte in msbytes:
+                    # error tolerance: only flip pos if over threshold (either side)
+                    if previous == 0:  # flip high if sample > 0 and over thres
+                        pos = 1 if ((byte < 0x80) and (byte > MSB_HI_THRES)) else 0
+                    else:  # flip low if sample < 0 and under thres
+                        pos = 0 if ((byte > 0x80) and (byte < MSB_LO_THRES)) else 1
+                    # XOR with previous pos to get change bit
+                    yield 1 if (pos ^ previous) else 0
+                    previous = pos
+
+            frames, arrival, gap = next(blocks, (None, None, False))
+            if gap:
+                first = frames, arrival
+                return
+
+    while first[0] is not None:
+        yield passed, stretch()
 
 
 if __name__ == "__main__":
@@ -156,6 +154,14 @@ if __name__ == "__main__":
         dest="list_devices",
         help="list audio input devices and exit",
     )
+    parser.add_option(
+        "-B",
+        "--backend",
+        dest="backend",
+        default="pyaudio",
+        help="audio backend: pyaudio, or fake[:options] for testing without "
+        "sound hardware, e.g. fake:in=tape.wav,realtime (see kcs_audio.py)",
+    )
     parser.add_option(
         "-d",
         "--device",
@@ -186,7 +192,7 @@ if __name__ == "__main__":
         type="int",
         default=0,
         dest="speed_mode",
-        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
     )
     parser.add_option(
         "-a",
@@ -196,23 +202,93 @@ if __name__ == "__main__":
         dest="cuts",
         help="ASCII only w/CUTS encoding (7 data bits, 3 stop bits)",
     )
+    parser.add_option(
+        "-g",
+        "--agc",
+        action="store_true",
+        default=False,
+        dest="agc",
+        help="automatic gain control front end for weak or DC-shifted audio",
+    )
+    parser.add_option(
+        "-G",
+        "--gate",
+        action="store_true",
+        default=False,
+        dest="gate",
+        help="skip silence and leader tone before framing (needs numpy); "
+        "the region map goes to stderr",
+    )
+    parser.add_option(
+        "-b",
+        "--block-size",
+        dest="block_size",
+        type="int",
+        help="capture block size in frames (default %d, %d with -x)"
+        % (CHUNK, LOW_LATENCY_CHUNK),
+    )
+    parser.add_option(
+        "-x",
+        "--low-latency",
+        action="store_true",
+        default=False,
+        dest="low_latency",
+        help="low-latency mode: small capture blocks",
+    )
+    parser.add_option(
+        "-t",
+        "--latency",
+        action="store_true",
+        default=False,
+        dest="latency",
+        help="measure latency from audio arrival to byte output, reported on stderr",
+    )
     parser.add_option(
         "-o",
         "--output-file",
         dest="output_file",
         help="output file to write to",
     )
+    parser.add_option(
+        "--checkpoint",
+        dest="checkpoint",
+        help="save decoder state to this file as the decode goes on "
+        "(needs --output-file)",
+    )
+    parser.add_option(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        type="float",
+        default=INTERVAL,
+        help="seconds between checkpoints (default %g)" % INTERVAL,
+    )
+    parser.add_option(
+        "--resume",
+        action="store_true",
+        default=False,
+        dest="resume",
+        help="carry on from the last --checkpoint, appending to --output-file "
+        "and with the saved AGC calibration",
+    )
     opts, args = parser.parse_args()
+    if opts.resume and not opts.checkpoint:
+        print("--resume needs --checkpoint", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.checkpoint and not opts.output_file:
+        print("--checkpoint needs --output-file", file=sys.stderr)
+        raise SystemExit(1)
+
+    try:
+        audio = make_backend(opts.backend)
+    except ValueError as e:
+        print("Invalid --backend: %s" % e, file=sys.stderr)
+        raise SystemExit(1)
 
     # if req'd, list possible input devices
     if opts.list_devices:
-        info = pa.get_host_api_info_by_index(0)
-        numdevices = info.get("deviceCount")
-        for i in range(0, numdevices):
-            d = pa.get_device_info_by_host_api_device_index(0, i)
-            name = d["name"]
-            in_mark = "[IN]" if d["maxInputChannels"] > 0 else ""
-            out_mark = "[OUT]" if d["maxOutputChannels"] > 0 else ""
+        for i, name, has_input, has_output in audio.list_devices():
+            in_mark = "[IN]" if has_input else ""
+            out_mark = "[OUT]" if has_output else ""
             if in_mark or out_mark:
                 print(
                     f"Device id {i} - {name} {in_mark}{out_mark} ",
@@ -221,21 +297,120 @@ if __name__ == "__main__":
 
     # if device not specified, use system default
     if opts.device < 0:
-        device = pa.get_default_input_device_info()["index"]
+        device = audio.default_input()
     else:
         device = opts.device
 
-    # create generators
-    sign_changes = generate_wav_sign_change_bits(device, opts.monitor_device)
-    byte_stream = generate_bytes(
-        sign_changes, FRAMERATE, opts.kcs_base_adj, opts.speed_mode, opts.cuts
+    gate = None
+    if opts.gate:
+        from kcs_dsp import CarrierGate  # numpy is only needed for the gate
+
+        kcs_base_freq, fpb_mult, _, _ = get_speed_params(
+            opts.speed_mode, opts.kcs_base_adj
+        )
+        gate = CarrierGate(
+            FRAMERATE, FRAMERATE * fpb_mult / kcs_base_freq, kcs_base_freq
+        )
+
+    block_size = opts.block_size
+    if block_size is None:
+        block_size = LOW_LATENCY_CHUNK if opts.low_latency else CHUNK
+
+    # a byte is complete at the end of its first stop bit
+    meter = index = None
+    if opts.latency:
+        meter = LatencyMeter(FRAMERATE)
+        index = []
+        kcs_base_freq, fpb_mult, _, _ = get_speed_params(
+            opts.speed_mode, opts.kcs_base_adj
+        )
+        byte_frames = (get_profile(opts.speed_mode).start_bits + 9) * (
+            FRAMERATE * fpb_mult / kcs_base_freq
+        )
+
+    # checkpoints hold the bytes written so far and the AGC calibration;
+    # live audio can't be rewound, so resuming carries on with the output
+    checkpointer = None
+    written = 0
+    agc = False
+    if opts.agc:
+        from kcs_dsp import AGCFrontEnd  # numpy is only needed for AGC
+
+        agc = AGCFrontEnd(FRAMERATE)
+    if opts.checkpoint:
+        params = dict(
+            speed_mode=opts.speed_mode,
+            kcs_base_adj=opts.kcs_base_adj,
+            cuts=opts.cuts,
+            frontend="agc" if opts.agc else "msb",
+        )
+        checkpointer = Checkpointer(opts.checkpoint, params, opts.checkpoint_interval)
+
+    def checkpoint_state():
+        calibration = [agc.dc, agc.env] if agc else None
+        return dict(bytes=written, agc=calibration)
+
+    if opts.resume:
+        try:
+            state = checkpointer.load()
+            outf = open_resumed_output(opts.output_file, state["bytes"])
+        except (OSError, ValueError) as e:
+            print("Can't resume: %s" % e, file=sys.stderr)
+            raise SystemExit(1)
+        written = state["bytes"]
+        if agc and state["agc"]:
+            agc.dc, agc.env = state["agc"]
+
+    # create generators; framing starts over on every stretch of audio
+    regions = generate_wav_sign_change_regions(
+        audio, device, opts.monitor_device, agc, gate, block_size, meter
     )
 
+    def decode_regions():
+        for start, sign_changes in regions:
+            region_index = [] if index is not None else None
+            for byteval in generate_bytes(
+                sign_changes,
+                FRAMERATE,
+                opts.kcs_base_adj,
+                opts.speed_mode,
+                opts.cuts,
+                region_index,
+            ):
+                if index is not None:
+                    index.extend((start + pos, b, ok) for pos, b, ok in region_index)
+                    del region_index[:]
+                yield byteval
+
+    byte_stream = decode_regions()
+
     # consume audio source and write to stdout (optionally to file)
-    if opts.output_file:
+    if opts.resume:
+        pass  # opened above, after the bytes written before
+    elif opts.output_file:
         outf = open(opts.output_file, "wb")
     else:
         outf = sys.stdout.buffer.raw
-    for b in byte_stream:
-        outf.write(bytes([b]))
-        outf.flush()
+    last_report = time.monotonic()
+    try:
+        for b in byte_stream:
+            outf.write(bytes([b]))
+            outf.flush()
+            written += 1
+            if checkpointer and checkpointer.due():
+                os.fsync(outf.fileno())
+                checkpointer.save(checkpoint_state())
+            if meter:
+                meter.output(index[-1][0] + byte_frames)
+                del index[:]
+                if time.monotonic() - last_report >= REPORT_TIME:
+                    print(meter.summary(), file=sys.stderr)
+                    last_report = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if checkpointer:
+            os.fsync(outf.fileno())
+            checkpointer.save(checkpoint_state())
+        if meter:
+            print(meter.summary(), file=sys.stderr)
@@ -5,184 +5,59 @@
 # - Original code: https://github.com/gstrike/py-kcs
 # - Original-original code: http://www.dabeaz.com/py-kcs
 
+import os
 import sys
+import time
 import optparse
+import wave
 
 import numpy as np
-import matplotlib.pyplot as plt
-import pyaudio
+
+from kcs_audio import FLOAT32, FORMATS, RawPCMReader, make_backend
+from kcs_fft import generate_freqs, generate_bytes, get_fft_params, skip_items
+from kcs_fft import generate_wav_samples, BATCH_CHUNK, LOOKAHEAD, MIN_LOOKAHEAD
+from kcs_checkpoint import INTERVAL, Checkpointer, open_resumed_output
+from kcs_latency import LatencyMeter
 
 # audio I/O settings
-FORMAT = pyaudio.paFloat32  # must be signed integer type
+FORMAT = FLOAT32
 CHANNELS = 1
 FRAMERATE = 44100
 CHUNK = 1024  # sweetspot, don't touch
-KCS_BASE_FREQ = 2400
-
-# init PyAudio
-pa = pyaudio.PyAudio()
+LOW_LATENCY_CHUNK = 128  # capture block size in low-latency mode
+REPORT_TIME = 5  # s between latency reports
 
 
-# Generate a sequence representing sign changes
-def get_samples(device, monitor_device):
+# Generate blocks of samples from an input device of an audio backend
+# (kcs_audio)
+# - with a kcs_latency.LatencyMeter, the arrival of every block is recorded
+def get_samples(audio, device, monitor_device, block_size=CHUNK, meter=None):
 
     # start Recording
-    stream = pa.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=FRAMERATE,
-        input=True,
-        input_device_index=device,
-        frames_per_buffer=CHUNK,
-    )
+    stream = audio.open_input(device, FRAMERATE, FORMAT, CHANNELS, block_size)
 
     if monitor_device >= 0:
-        stream2 = pa.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=FRAMERATE,
-            output=True,
-            output_device_index=monitor_device,
-            frames_per_buffer=CHUNK,
+        stream2 = audio.open_output(
+            monitor_device, FRAMERATE, FORMAT, CHANNELS, block_size
         )
 
     # yield one sign-change bit for each sample
     while True:
         # obtain samples
-        frames = stream.read(CHUNK, exception_on_overflow=False)
+        frames = stream.read(block_size)
         if not frames:
             stream.close()
+            if monitor_device >= 0:
+                stream2.close()
             break
         if monitor_device >= 0:
             stream2.write(frames)
         samples = np.frombuffer(frames, dtype=np.float32)
+        if meter:
+            meter.arrived(len(samples))
         yield samples
 
 
-def decode_byte(bit_arr, little_endian=True):
-    mask = 0x1 if little_endian else 0x80
-    byte_val = np.uint8(0)
-    for i in range(8):
-        byte_val += bit_arr[i] * mask
-        mask = (mask << 1) if little_endian else (mask >> 1)
-    return byte_val
-
-
-def sliding_window(arr, window_size):
-    shape = (arr.size - window_size + 1, window_size)
-    strides = arr.strides * 2
-    return np.lib.stride_tricks.as_strided(arr, shape=shape, strides=strides)
-
-
-def do_fft(sample, window_len):
-    # extract dominant frequencies from sample
-    sample_w = sliding_window(sample, window_len)
-    sample_fft = np.abs(np.fft.fft(sample_w, axis=1))
-    sample_fft = sample_fft.T[: window_len // 2]  # simple filter
-    return np.argmax(sample_fft, axis=0)
-
-
-def generate_freqs(sample_it, window_len, chunk_size):
-    # take a stream of audio samples, emit a stream of dominant frequencies
-    # NOTE: output length identical to input length
-    buf_chunk_size = chunk_size + window_len - 1
-    buf = np.zeros(window_len - 1)  # init w/padding
-    while True:
-        # ensure sample length enough for output chunk
-        while len(buf) < buf_chunk_size:
-            try:  # get more samples
-                buf = np.concatenate([buf, next(sample_it)])
-            except ValueError:  # invalid sample
-                continue
-            except StopIteration:  # output shorter than chunk_size
-                # NOTE: # guaranteed at least window_len-1 samples
-                yield do_fft(buf, window_len)
-                return
-        # calculate & yield dominant frequencies on sliding windows
-        yield do_fft(buf[:buf_chunk_size], window_len)
-        # prepare for next sample batch
-        buf = buf[chunk_size:]
-
-
-def generate_bytes(freq_it, symbol_len):
-    # prepare items for matching codewords
-    word_len = symbol_len * 11  # code word = 1+8+2 symbols
-    start_kernel = -1 * np.ones(symbol_len) / symbol_len  # works on {-1,1}
-    stop_kernel = 1 * np.ones(symbol_len) / symbol_len
-    # consume dominant frequencies, output stream of bytes
-    freq_buf = np.array([])
-    while True:
-
-        # get at least two codewords' length in buffer
-        while len(freq_buf) < 2 * word_len:
-            try:
-                freq_buf = np.concatenate([freq_buf, next(freq_it)])
-            except StopIteration:
-                # TODO: handle remaining data
-                return  # not enough frequency data left
-
-        # detect signal & handle no-carrier case
-        signal_on = ((freq_buf == 1) | (freq_buf == 2)).sum() / len(freq_buf) > 0.8
-        if not signal_on:  # discard entire buffer
-            freq_buf = np.array([])
-            continue
-
-        # cleanup signals
-        freq_buf_pp = freq_buf.copy().clip(1, 2) * 2 - 3  # convert {1,2} to {-1,1}
-
-        # try to match codeword
-        # NOTE: sort-of-working self-correction on misalignment
-        start_match = np.convolve(freq_buf_pp, start_kernel, mode="valid")
-        start_offset = 1 * symbol_len  # move peak to start of start symbol
-        start_match = np.pad(
-            start_match[start_offset:],
-            (len(start_kernel) - 1, start_offset),
-            constant_values=0,
-        )
-        stop_match = np.convolve(freq_buf_pp, stop_kernel, mode="valid")
-        stop_offset = (9 + 2) * symbol_len  # move peak to start of stop symbol
-        stop_match = np.pad(
-            stop_match[stop_offset:],
-            (len(stop_kernel) - 1, stop_offset),
-            constant_values=0,
-        )
-        match = start_match + stop_match > 1.0  # TODO
-        match = np.pad(
-            match[: -symbol_len // 2], (symbol_len // 2, 0), constant_values=0
-        )
-
-        # find start position of first codeword
-        try:
-            word_start = np.nonzero(match == True)[0][0] + symbol_len
-            word_end = word_start + 8 * (symbol_len)
-        except IndexError:  # didn't find start of code word
-            freq_buf = freq_buf[-symbol_len:]  # keep last symbol
-            continue  # skip to next loop
-
-        # handle not enough samples in buffer
-        if len(freq_buf) - word_start < word_len:
-            freq_buf = freq_buf[word_start - 2 * symbol_len :]
-            continue
-
-        # plt.figure(figsize=(15,5))
-        # plt.plot(freq_buf_pp, c="red")
-        # plt.plot(start_match, c='blue')
-        # plt.plot(stop_match, c='green')
-        # plt.plot(match)
-        # plt.scatter([word_start - symbol_len, word_start, word_end], [-0.5] * 3, c='black')
-        # plt.show()
-
-        # decode bits
-        bits = (
-            (freq_buf_pp[word_start:word_end].reshape((8, symbol_len))).mean(axis=1) > 0
-        ).astype(int)
-        byte_val = decode_byte(bits)
-        yield byte_val
-
-        # truncate decoded word from buffer
-        freq_buf = freq_buf[word_end:]
-
-
 if __name__ == "__main__":
     parser = optparse.OptionParser()
     parser.add_option(
@@ -193,6 +68,14 @@ if __name__ == "__main__":
         dest="list_devices",
         help="list audio input devices and exit",
     )
+    parser.add_option(
+        "-B",
+        "--backend",
+        dest="backend",
+        default="pyaudio",
+        help="audio backend: pyaudio, or fake[:options] for testing without "
+        "sound hardware, e.g. fake:in=tape.wav,realtime (see kcs_audio.py)",
+    )
     parser.add_option(
         "-d",
         "--device",
@@ -223,7 +106,7 @@ if __name__ == "__main__":
         type="int",
         default=0,
         dest="speed_mode",
-        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
     )
     parser.add_option(
         "-a",
@@ -233,52 +116,269 @@ if __name__ == "__main__":
         dest="cuts",
         help="ASCII only w/CUTS encoding (7 data bits, 3 stop bits)",
     )
+    parser.add_option(
+        "-c",
+        "--channel",
+        dest="channel",
+        type="int",
+        default=0,
+        help="channel to decode when reading a WAV file",
+    )
+    parser.add_option(
+        "-b",
+        "--block-size",
+        dest="block_size",
+        type="int",
+        help="capture block size in frames (default %d, %d with -x)"
+        % (CHUNK, LOW_LATENCY_CHUNK),
+    )
+    parser.add_option(
+        "-k",
+        "--lookahead",
+        dest="lookahead",
+        type="int",
+        help="symbols examined beyond a codeword when matching (default %d, "
+        "%d with -x; min %d)" % (LOOKAHEAD, MIN_LOOKAHEAD, MIN_LOOKAHEAD),
+    )
+    parser.add_option(
+        "-x",
+        "--low-latency",
+        action="store_true",
+        default=False,
+        dest="low_latency",
+        help="low-latency mode: small capture blocks and minimal lookahead",
+    )
+    parser.add_option(
+        "-t",
+        "--latency",
+        action="store_true",
+        default=False,
+        dest="latency",
+        help="measure latency from audio arrival to byte output (live audio "
+        "only), reported on stderr",
+    )
+    parser.add_option(
+        "-P",
+        "--pipeline",
+        action="store_true",
+        default=False,
+        dest="pipeline",
+        help="run capture and the FFT front end in separate processes, "
+        "connected by shared memory ring buffers",
+    )
     parser.add_option(
         "-o",
         "--output-file",
         dest="output_file",
         help="output file to write to",
     )
+    parser.add_option(
+        "--checkpoint",
+        dest="checkpoint",
+        help="save decoder state to this file as the decode goes on "
+        "(needs --output-file)",
+    )
+    parser.add_option(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        type="float",
+        default=INTERVAL,
+        help="seconds between checkpoints (default %g)" % INTERVAL,
+    )
+    parser.add_option(
+        "--resume",
+        action="store_true",
+        default=False,
+        dest="resume",
+        help="carry on from the last --checkpoint, appending to --output-file "
+        "(a WAV file is decoded on from where it got to)",
+    )
+    parser.add_option(
+        "--raw",
+        action="store_true",
+        default=False,
+        dest="raw",
+        help="infile is raw PCM, e.g. a FIFO (- is standard input), "
+        "decoded as it arrives",
+    )
+    parser.add_option(
+        "--rate",
+        type="int",
+        default=FRAMERATE,
+        dest="framerate",
+        help="sample rate of raw input in Hz (default %d)" % FRAMERATE,
+    )
+    parser.add_option(
+        "--format",
+        type="choice",
+        choices=list(FORMATS),
+        default="s16",
+        dest="format",
+        help="sample format of raw input: u8, s16 or float (default s16)",
+    )
+    parser.add_option(
+        "--nchannels",
+        type="int",
+        default=1,
+        dest="nchannels",
+        help="number of channels of raw input (default 1)",
+    )
     opts, args = parser.parse_args()
 
+    if len(args) > 1:
+        print("Usage: %s [options] [infile.wav]" % sys.argv[0], file=sys.stderr)
+        raise SystemExit(1)
+    if opts.raw and not args:
+        print("--raw needs an infile (- for standard input)", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.pipeline and (args or opts.latency):
+        print("-P is for live audio, without -t", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.resume and not opts.checkpoint:
+        print("--resume needs --checkpoint", file=sys.stderr)
+        raise SystemExit(1)
+    if opts.checkpoint and not opts.output_file:
+        print("--checkpoint needs --output-file", file=sys.stderr)
+        raise SystemExit(1)
+
+    # sound devices (and their libraries) are only needed for live audio
+    if opts.list_devices or not args:
+        try:
+            audio = make_backend(opts.backend)
+        except ValueError as e:
+            print("Invalid --backend: %s" % e, file=sys.stderr)
+            raise SystemExit(1)
+
     # if req'd, list possible input devices
     if opts.list_devices:
-        info = pa.get_host_api_info_by_index(0)
-        numdevices = info.get("deviceCount")
-        for i in range(0, numdevices):
-            d = pa.get_device_info_by_host_api_device_index(0, i)
-            name = d["name"]
-            in_mark = "[IN]" if d["maxInputChannels"] > 0 else ""
-            out_mark = "[OUT]" if d["maxOutputChannels"] > 0 else ""
+        for i, name, has_input, has_output in audio.list_devices():
+            in_mark = "[IN]" if has_input else ""
+            out_mark = "[OUT]" if has_output else ""
             if in_mark or out_mark:
                 print(
                     f"Device id {i} - {name} {in_mark}{out_mark} ",
                 )
         exit(0)
 
-    # if device not specified, use system default
-    if opts.device < 0:
-        device = pa.get_default_input_device_info()["index"]
+    block_size = opts.block_size
+    if block_size is None:
+        block_size = LOW_LATENCY_CHUNK if opts.low_latency else CHUNK
+    lookahead = opts.lookahead
+    if lookahead is None:
+        lookahead = MIN_LOOKAHEAD if opts.low_latency else LOOKAHEAD
+
+    # create generators: batch decode of a WAV file, or live audio
+    meter = index = None
+    if opts.raw:
+        rawf = sys.stdin.buffer if args[0] == "-" else open(args[0], "rb")
+        wf = RawPCMReader(rawf, opts.framerate, FORMATS[opts.format], opts.nchannels)
+        framerate, chunk = wf.getframerate(), BATCH_CHUNK
+    elif args:
+        wf = wave.open(args[0])
+        framerate, chunk = wf.getframerate(), BATCH_CHUNK
     else:
-        device = opts.device
+        # if device not specified, use system default
+        if opts.device < 0:
+            device = audio.default_input()
+        else:
+            device = opts.device
+        if opts.latency:
+            meter = LatencyMeter(FRAMERATE)
+            index = []
+        framerate, chunk = FRAMERATE, block_size
+        sample_it = get_samples(audio, device, opts.monitor_device, block_size, meter)
 
     # calculate widths of base units and symbols
-    window_len = int(
-        (round(FRAMERATE / KCS_BASE_FREQ) * 2 + round(FRAMERATE / (KCS_BASE_FREQ // 2)))
-        / 2
-    )
-    symbol_len = window_len * (1 if (opts.speed_mode > 0) else 4)
-
-    # create generators
-    sample_it = get_samples(device, opts.monitor_device)
-    freq_it = generate_freqs(sample_it, window_len, CHUNK)
-    byte_stream = generate_bytes(freq_it, symbol_len)
+    window_len, symbol_len = get_fft_params(framerate, opts.speed_mode)
+
+    # checkpoints hold the stream position after the last byte written and
+    # the bytes written so far; live audio can't be rewound, so resuming it
+    # only carries on with the output
+    checkpointer = None
+    resume_pos, written = 0, 0
+    if opts.checkpoint:
+        params = dict(
+            source=os.path.basename(args[0]) if args else "live",
+            framerate=framerate,
+            channel=opts.channel,
+            speed_mode=opts.speed_mode,
+            lookahead=lookahead,
+        )
+        if args:
+            params["nframes"] = wf.getnframes()
+        checkpointer = Checkpointer(opts.checkpoint, params, opts.checkpoint_interval)
+    if opts.resume:
+        try:
+            state = checkpointer.load()
+            outf = open_resumed_output(opts.output_file, state["bytes"])
+        except (OSError, ValueError) as e:
+            print("Can't resume: %s" % e, file=sys.stderr)
+            raise SystemExit(1)
+        written = state["bytes"]
+        if args:
+            resume_pos = state["pos"]
+    if args:
+        # a resumed decode starts a window early, so the frequencies from
+        # resume_pos on come from the same samples as in an unbroken run
+        lookback = min(resume_pos, window_len - 1)
+        wf.setpos(resume_pos - lookback)
+        sample_it = generate_wav_samples(wf, opts.channel, chunk)
+    procs, rings = [], []
+    if opts.pipeline:
+        # multi-process mode
+        from kcs_pipeline import start_fft_pipeline, stop_fft_pipeline
+
+        procs, rings, freq_it = start_fft_pipeline(
+            opts.backend,
+            device,
+            opts.monitor_device,
+            FRAMERATE,
+            FORMAT,
+            block_size,
+            window_len,
+        )
+    else:
+        freq_it = generate_freqs(sample_it, window_len, chunk)
+        if args and lookback:
+            freq_it = skip_items(freq_it, lookback)
+    state = {}
+    byte_stream = generate_bytes(freq_it, symbol_len, lookahead, index, state)
+    byte_frames = 10 * symbol_len  # up to the end of the first stop bit
 
     # consume audio source and write to stdout (optionally to file)
-    if opts.output_file:
+    if opts.resume:
+        pass  # opened above, after the bytes written before
+    elif opts.output_file:
         outf = open(opts.output_file, "wb")
     else:
         outf = sys.stdout.buffer.raw
-    for b in byte_stream:
-        outf.write(bytes([b]))
-        outf.flush()
+    saved = dict(pos=resume_pos, bytes=written)  # state as of the output so far
+    last_report = time.monotonic()
+    try:
+        for b in byte_stream:
+            outf.write(bytes([b]))
+            outf.flush()
+            written += 1
+            saved = dict(pos=resume_pos + state["pos"], bytes=written)
+            if checkpointer and checkpointer.due():
+                os.fsync(outf.fileno())
+                checkpointer.save(saved)
+            if meter:
+                meter.output(index[-1][0] + byte_frames)
+                del index[:]
+                if time.monotonic() - last_report >= REPORT_TIME:
+                    print(meter.summary(), file=sys.stderr)
+                    last_report = time.monotonic()
+        if args:  # all done: a resumed run has nothing left to decode
+            saved["pos"] = wf.tell() if opts.raw else wf.getnframes()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if checkpointer:
+            os.fsync(outf.fileno())
+            checkpointer.save(saved)
+        if meter:
+            print(meter.summary(), file=sys.stderr)
+        if procs:
+            freq_it.close()  # drop its view into the ring before closing
+            stop_fft_pipeline(procs, rings)
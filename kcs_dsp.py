@@ -0,0 +1,570 @@
+#
+
+# Vectorized signal processing helpers for the codec (numpy)
+# - PCM conversion at full sample precision
+# - automatic gain control front end: running DC offset and envelope
+#   estimates drive adaptive hysteresis thresholds, producing the same
+#   sign-change bit stream the framing code (generate_bytes) expects
+# - framing of sign-change bits that come in blocks (e.g. from the cache)
+# - carrier/silence gate ahead of framing
+# - exact-frequency, phase-continuous tone synthesis for the encoder
+
+from fractions import Fraction
+
+import numpy as np
+
+from kcs_codec import ALGN_FRAC, AMPLITUDE, BITMASKS, CENTER, SAMPLE_CODES
+from kcs_codec import get_profile, get_speed_params
+
+DC_TIME = 0.05  # s, time constant of the DC offset estimate
+ENV_TIME = 0.004  # s, time constant of the envelope estimate
+HYSTERESIS = 0.3  # thresholds at this fraction of the envelope
+FLOOR = 0.002  # minimum threshold (full scale = 1.0), mutes hiss in gaps
+BLOCK_TIME = 0.002  # s, resolution of the running estimates
+FRAME_BLOCK = 1 << 16  # bits at least read ahead by frame_bit_blocks
+
+
+# Convert a block of interleaved PCM frames to float samples in [-1, 1)
+# for one channel. samplewidth 1 is unsigned 8-bit, 2-4 are signed little
+# endian integers (as in WAV files).
+def pcm_to_float(frames, samplewidth, nchannels=1, channel=0):
+    raw = np.frombuffer(frames, dtype=np.uint8)
+    raw = raw[: len(raw) - len(raw) % (samplewidth * nchannels)]
+    raw = raw.reshape(-1, nchannels, samplewidth)[:, channel, :]
+    if samplewidth == 1:
+        return (raw[:, 0].astype(np.float32) - 128) / 128
+    if samplewidth == 2:
+        return raw.copy().view("<i2")[:, 0].astype(np.float32) / (1 << 15)
+    if samplewidth == 3:  # pad to 32 bits, keeping the sign in the top byte
+        padded = np.zeros((len(raw), 4), dtype=np.uint8)
+        padded[:, 1:] = raw
+        return padded.view("<i4")[:, 0].astype(np.float32) / (1 << 31)
+    if samplewidth == 4:
+        return raw.copy().view("<i4")[:, 0].astype(np.float32) / (1 << 31)
+    raise ValueError("unsupported sample width %d" % samplewidth)
+
+
+# Convert interleaved PCM between sample formats: "uint8", "int16" (little
+# endian) or "float32" (full scale = 1.0)
+def convert_pcm(frames, src_fmt, dst_fmt):
+    x = np.frombuffer(frames, dtype=src_fmt)
+    if src_fmt == "uint8":
+        x = (x.astype(np.float32) - 128) / 128
+    elif src_fmt == "int16":
+        x = x.astype(np.float32) / (1 << 15)
+    if dst_fmt == "uint8":
+        x = (x * 128 + 128).clip(0, 255).astype(np.uint8)
+    elif dst_fmt == "int16":
+        x = (x * (1 << 15)).clip(-(1 << 15), (1 << 15) - 1).astype("<i2")
+    else:
+        x = x.astype("<f4")
+    return x.tobytes()
+
+
+# Sign-change bits from the high bytes of interleaved PCM frames, for
+# several channels at once (the plain front end of kcs_decode.py). previous
+# holds each channel's last sign bit and is updated. Returns one uint8 array
+# of bits per channel.
+def msb_sign_changes(frames, samplewidth, nchannels, channels, previous):
+    data = np.frombuffer(frames, dtype=np.uint8)
+    changes = []
+    for i, channel in enumerate(channels):
+        offset = channel * samplewidth + samplewidth - 1
+        signs = data[offset :: samplewidth * nchannels] & 0x80
+        changes.append(np.diff(signs, prepend=previous[i]) != 0)
+        previous[i] = int(signs[-1])
+    return [c.view(np.uint8) for c in changes]
+
+
+# Sign-change front end with automatic gain control. Feed successive
+# blocks of float samples to process(); state carries across blocks, so the
+# output doesn't depend on how the input is cut up.
+# - DC and envelope are estimated over blocks of block_len samples, counted
+#   from the first sample; a block's samples use the estimates from the
+#   blocks before it
+# - the Schmitt trigger only decides whether the signal really crossed
+#   over; the sign change is put where it crossed zero, so hysteresis adds
+#   no timing jitter. That takes a little lookahead: the output lags the
+#   input by delay samples (process() returns one bit per sample passed in,
+#   starting with delay zero bits)
+class AGCFrontEnd:
+    def __init__(
+        self,
+        framerate,
+        dc_time=DC_TIME,
+        env_time=ENV_TIME,
+        hysteresis=HYSTERESIS,
+        floor=FLOOR,
+    ):
+        self.block_len = max(1, int(framerate * BLOCK_TIME))
+        self.delay = self.block_len
+        self.dc_alpha = 1 - np.exp(-BLOCK_TIME / dc_time)
+        self.env_alpha = 1 - np.exp(-BLOCK_TIME / env_time)
+        self.hysteresis = hysteresis
+        self.floor = floor
+        self.dc = None  # running estimates, seeded by the first block
+        self.env = 0.0
+        self.state = 0  # Schmitt trigger output (0 low, 1 high)
+        self._block = np.zeros(0)  # samples of the current estimate block
+        self._low = self._high = -1  # last samples at or below/above zero
+        self._pending = np.zeros(self.delay, dtype=np.uint8)  # bits not output
+
+    # everything process() carries over, as a list of plain values (for
+    # checkpoints)
+    def get_state(self):
+        pending = "".join("1" if b else "0" for b in self._pending.tolist())
+        block = self._block.tolist()
+        return [self.dc, self.env, self.state, self._low, self._high, block, pending]
+
+    def set_state(self, state):
+        self.dc, self.env, self.state, self._low, self._high, block, pending = state
+        self._block = np.array(block, dtype=np.float64)
+        self._pending = np.array([c == "1" for c in pending], dtype=np.uint8)
+
+    # running DC and envelope for every sample
+    def _estimates(self, samples):
+        n = len(samples)
+        offset = len(self._block)
+        buf = np.concatenate([self._block, samples])
+        nblocks = len(buf) // self.block_len
+        blocks = buf[: nblocks * self.block_len].reshape(nblocks, self.block_len)
+        self._block = buf[nblocks * self.block_len :]
+        means = blocks.mean(axis=1)
+        # mean absolute deviation of a sine is 2/pi of its peak
+        levels = np.abs(blocks - means[:, None]).mean(axis=1) * (np.pi / 2)
+        dc = [0.0 if self.dc is None else self.dc]
+        env = [self.env]
+        for mean, level in zip(means.tolist(), levels.tolist()):
+            if self.dc is None:
+                self.dc = mean
+            self.dc += self.dc_alpha * (mean - self.dc)
+            self.env += self.env_alpha * (level - self.env)
+            dc.append(self.dc)
+            env.append(self.env)
+        block = np.arange(offset, offset + n) // self.block_len
+        return np.array(dc)[block], np.array(env)[block]
+
+    # return one sign-change bit (uint8) per input sample
+    def process(self, samples):
+        n = len(samples)
+        if not n:
+            return np.zeros(0, dtype=np.uint8)
+        dc, env = self._estimates(samples)
+        x = samples - dc
+        thres = np.maximum(env * self.hysteresis, self.floor)
+
+        # Schmitt trigger: switch on threshold crossings, otherwise hold
+        events = np.zeros(n, dtype=np.int8)
+        events[x > thres] = 1
+        events[x < -thres] = -1
+        pos = np.arange(n)
+        last = np.where(events != 0, pos, -1)
+        np.maximum.accumulate(last, out=last)
+        state = np.where(last >= 0, events[last] > 0, self.state).astype(np.uint8)
+        switches = np.flatnonzero(np.diff(state, prepend=self.state))
+
+        # put each switch just after x last was on the other side of zero
+        low = np.maximum.accumulate(np.where(x <= 0, pos, self._low))
+        high = np.maximum.accumulate(np.where(x >= 0, pos, self._high))
+        crossed = np.where(state[switches], low[switches], high[switches]) + 1
+        crossed = np.maximum(crossed, switches - self.delay)
+
+        bits = np.concatenate([self._pending, np.zeros(n, dtype=np.uint8)])
+        bits[crossed + self.delay] = 1
+        self._pending = bits[n:]
+        self.state = int(state[-1])
+        self._low = max(int(low[-1]) - n, -self.delay - 1)
+        self._high = max(int(high[-1]) - n, -self.delay - 1)
+        return bits[:n]
+
+
+# Frame bytes from sign-change bits that come as numpy arrays (of 0s and
+# 1s, any lengths) rather than one by one: the same bytes, index entries
+# and state as kcs_codec.generate_bytes (which documents the arguments)
+# - window sums are differences of a running cumulative sum, and the
+#   places where a start bit can be found (the window sum drops to the
+#   zero-bit threshold) are searched a buffer at a time, so only framed
+#   bytes cost Python work, not every sample
+# - the window holds the last frames_per_bit - 1 bits until the first
+#   byte and the last frames_per_bit after, as in generate_bytes
+def frame_bit_blocks(
+    blocks,
+    framerate,
+    kcs_base_adj,
+    speed_mode,
+    cuts,
+    index=None,
+    window=None,
+    state=None,
+):
+    bitmasks = list(BITMASKS)
+    if cuts:  # CUTS encoding (1-7-3), ignore the highest bit in the byte
+        bitmasks[-1] = 0x0
+    kcs_base_freq, fpb_mult, thres_0_hi, thres_1_lo = get_speed_params(
+        speed_mode, kcs_base_adj
+    )
+    extra_start_bits = get_profile(speed_mode).start_bits - 1
+    frames_per_bit_real = float(framerate) * fpb_mult / kcs_base_freq
+    frames_per_bit = int(round(frames_per_bit_real))
+    frames_per_bit_d = frames_per_bit_real - frames_per_bit
+    align = int(frames_per_bit * (ALGN_FRAC + extra_start_bits))
+    lengths = []  # samples taken for each data bit, with window correction
+    acc_diff = 0
+    for _ in bitmasks:
+        acc_diff += frames_per_bit_d
+        lengths.append(frames_per_bit + int(round(acc_diff)))
+        acc_diff -= round(acc_diff)
+    word = align + sum(lengths) + frames_per_bit + 1
+    # the part of each data bit sampled (its first 7/8), from the start bit
+    first = np.cumsum([align] + lengths[:-1])
+    last = first + [int(length * 7 / 8) for length in lengths]
+    masks = np.array(bitmasks)
+
+    # bits [base, end) are buffered, and csum[i] is the sum of the first i;
+    # positions count from the start of the (saved) window
+    blocks = iter(blocks)
+    buf = np.zeros(0, dtype=np.uint8)
+    base = 0
+    csum = np.zeros(1, dtype=np.int64)
+    done = False
+
+    def refill(upto, keep):
+        nonlocal buf, base, csum, done
+        parts = [buf[keep - base :]]
+        end = base + len(buf)
+        while not done and end < upto:
+            block = next(blocks, None)
+            if block is None:
+                done = True
+            else:
+                parts.append(np.asarray(block, dtype=np.uint8))
+                end += len(block)
+        buf = np.concatenate(parts)
+        base = keep
+        csum = np.concatenate([[0], np.cumsum(buf, dtype=np.int64)])
+
+    # positions k where the window sum ending there drops to thres_0_hi
+    def start_bits():
+        n = len(csum)
+        if n <= w + 1:
+            return np.zeros(0, dtype=np.int64)
+        sums = csum[w + 1 :] - csum[1 : n - w]
+        prev = csum[w:-1] - csum[: n - w - 1]
+        found = np.flatnonzero((sums < prev) & (sums <= thres_0_hi))
+        return found + (base + w + 1)
+
+    if window is not None:
+        buf = np.array([int(c) for c in window], dtype=np.uint8)
+        offset = w = len(buf)
+        refill(w + FRAME_BLOCK, 0)
+    else:
+        offset = 0
+        refill(frames_per_bit - 1 + FRAME_BLOCK, 0)
+        w = min(frames_per_bit - 1, len(buf))
+    if not w:
+        return
+    pos = w  # bits consumed so far
+    candidates = start_bits()
+
+    while True:
+        # slide the window up to the next start bit
+        i = np.searchsorted(candidates, pos + 1)
+        if i == len(candidates):
+            end = base + len(buf)
+            if done:
+                return
+            pos = end
+            refill(end + FRAME_BLOCK, pos - w)
+            candidates = start_bits()
+            continue
+        found = int(candidates[i])
+        start = found - w - offset
+        if found + word > base + len(buf) and not done:
+            refill(found + word + FRAME_BLOCK, found - w)
+            candidates = start_bits()
+        end = base + len(buf)
+
+        # skip the alignment, then sample the data bits and a stop bit
+        if found + word <= end:
+            ones = csum[found - base + last] - csum[found - base + first]
+            byteval = int(masks[ones >= thres_1_lo].sum())
+            pos = found + word - frames_per_bit - 1
+        else:  # the input ends inside the word: bits are cut short
+            pos = min(found + align, end)
+            byteval = 0
+            for mask, length in zip(bitmasks, lengths):
+                length = min(length, end - pos)
+                lo, hi = pos - base, pos - base + int(length * 7 / 8)
+                if csum[hi] - csum[lo] >= thres_1_lo:
+                    byteval |= mask
+                pos += length
+        stop = min(frames_per_bit + 1, end - pos)
+        pos += stop
+        if stop >= frames_per_bit:
+            sample = buf[pos - frames_per_bit - base : pos - base]
+        else:  # the input ended: the window keeps some of its old bits
+            old = buf[found - w - base : found - base]
+            sample = np.concatenate([old, buf[pos - stop - base : pos - base]])
+            sample = sample[-frames_per_bit:]
+        if sum(sample.tolist()) >= thres_1_lo:
+            if index is not None:
+                index.append((start, byteval, True))
+            if state is not None:
+                state["pos"] = pos - offset
+                state["window"] = (sample + ord("0")).tobytes().decode("ascii")
+            yield byteval
+        elif index is not None:
+            index.append((start, byteval, False))
+        if stop < frames_per_bit + 1:
+            return
+        if w != frames_per_bit:
+            w = frames_per_bit
+            candidates = start_bits()
+
+
+SILENCE, LEADER, DATA = 0, 1, 2
+REGION_NAMES = ("silence", "leader", "data")
+GATE_LEVEL = 0.02  # RMS (full scale = 1.0) below which a block is silence
+GATE_MARGIN_BITS = 22  # keep two words around data for framing to lock on
+NO_DATA = -(1 << 62)
+
+
+# Cheap carrier/silence gate, run ahead of bit framing. Audio is cut into
+# one-bit blocks and each is classified from its energy and the lengths of
+# its half-cycles (zero crossing intervals):
+# - silence: RMS under the gate level
+# - leader: carrier with only one-bit (short) half-cycles
+# - data: at least one zero-bit (long) half-cycle; every word has one, in
+#   its start bit, even if all data bits are ones
+# Data blocks are widened by a margin on both sides, and only those regions
+# need to go through framing. Completed regions are appended to
+# self.regions as [start sample, end sample, label] lists.
+class CarrierGate:
+    def __init__(
+        self,
+        framerate,
+        frames_per_bit,
+        one_freq,
+        level=GATE_LEVEL,
+        margin_bits=GATE_MARGIN_BITS,
+    ):
+        self.block_len = max(1, int(round(frames_per_bit)))
+        self.half_cycle = framerate / (2.0 * one_freq)  # of a one bit
+        self.level = level
+        self.margin = margin_bits  # in blocks
+        self.regions = []
+        self._rest = np.zeros(0, dtype=np.float32)  # samples of a partial block
+        self._neg = False  # sign of the last sample
+        self._since = 0  # samples since the last zero crossing
+        self._labels = np.zeros(0, dtype=np.uint8)  # blocks not yet final
+        self._ld = np.zeros(0, dtype=np.int64)  # last data block up to each
+        self._nblocks = 0  # blocks classified so far
+        self._last_data = NO_DATA  # index of the last data block
+        self._lookback = []  # payloads held back for a possible data start
+        self._lookback_len = 0
+        self._hangover = 0  # samples still to pass after data
+        self._dropped = False  # input dropped since payloads were last passed
+        self.gap = False  # whether the payloads last passed follow a gap
+
+    # classify the complete blocks in samples (remainder kept for later)
+    def classify(self, samples):
+        if len(self._rest):
+            samples = np.concatenate([self._rest, samples])
+        n = len(samples) // self.block_len * self.block_len
+        self._rest = samples[n:]
+        if not n:
+            return np.zeros(0, dtype=np.uint8)
+        x = samples[:n] - samples[:n].mean()
+        blocks = x.reshape(-1, self.block_len)
+        rms = np.sqrt((blocks * blocks).mean(axis=1))
+
+        # half-cycle lengths, each counted in the block where it ends
+        neg = x < 0
+        crossings = np.flatnonzero(neg != np.concatenate([[self._neg], neg[:-1]]))
+        intervals = np.diff(crossings, prepend=-self._since)
+        if len(crossings):
+            self._since = n - crossings[-1]
+        else:
+            self._since += n
+        self._neg = bool(neg[-1])
+        long_half = (intervals > 1.5 * self.half_cycle) & (
+            intervals < 3 * self.half_cycle
+        )
+        zero_bits = np.bincount(
+            crossings[long_half] // self.block_len, minlength=len(blocks)
+        )
+        any_cross = np.bincount(crossings // self.block_len, minlength=len(blocks))
+
+        labels = np.full(len(blocks), SILENCE, dtype=np.uint8)
+        loud = (rms >= self.level) & (any_cross > 0)
+        labels[loud] = LEADER
+        labels[loud & (zero_bits > 0)] = DATA
+        self._widen(labels)
+        return labels
+
+    # widen data by the margin on both sides; a block is final once the
+    # block margin ahead of it has been classified
+    def _widen(self, labels, final=False):
+        first = self._nblocks
+        self._nblocks += len(labels)
+        idx = np.arange(first, self._nblocks)
+        last_data = np.where(labels == DATA, idx, NO_DATA)
+        last_data = np.maximum.accumulate(np.append(self._last_data, last_data))[1:]
+        if len(last_data):
+            self._last_data = int(last_data[-1])
+        self._labels = np.concatenate([self._labels, labels])
+        self._ld = np.concatenate([self._ld, last_data])
+
+        # block i is data if the last data block up to i + margin is no
+        # further back than i - margin
+        start = self._nblocks - len(self._labels)
+        if final:
+            nfinal = len(self._labels)
+            tail = np.full(min(self.margin, nfinal), self._last_data)
+            ahead = np.concatenate([self._ld[self.margin :], tail])
+        else:
+            nfinal = max(0, len(self._labels) - self.margin)
+            ahead = self._ld[self.margin :]
+        i = np.arange(start, start + nfinal)
+        widened = np.where(ahead >= i - self.margin, DATA, self._labels[:nfinal])
+        self._add_regions(start, widened)
+        self._labels = self._labels[nfinal:]
+        self._ld = self._ld[nfinal:]
+
+    def _add_regions(self, start, labels):
+        if not len(labels):
+            return
+        bounds = np.flatnonzero(np.diff(labels)) + 1
+        for lo, hi in zip(np.append(0, bounds), np.append(bounds, len(labels))):
+            label = int(labels[lo])
+            lo, hi = int(start + lo) * self.block_len, int(start + hi) * self.block_len
+            if self.regions and self.regions[-1][2] == label:
+                self.regions[-1][1] = hi
+            else:
+                self.regions.append([lo, hi, label])
+
+    # finalize all regions at the end of the input
+    def flush(self):
+        self._widen(np.zeros(0, dtype=np.uint8), final=True)
+        if len(self._rest):
+            end = self._nblocks * self.block_len + len(self._rest)
+            if self.regions:
+                self.regions[-1][1] = end
+            else:
+                self.regions.append([0, end, SILENCE])
+            self._rest = self._rest[:0]
+        return self.regions
+
+    # (start, end) sample spans of the data regions found so far
+    def data_spans(self):
+        return [(lo, hi) for lo, hi, label in self.regions if label == DATA]
+
+    # Streaming use: pass each block of input along with the float samples
+    # it holds; returns the payloads to hand on to framing now, which is
+    # nothing while there is no data, held-back input for the margin
+    # before data when it starts, and everything while data (plus the
+    # margin after it) goes on. After a call that returns payloads, gap
+    # tells whether input was dropped between them and those passed before,
+    # i.e. whether framing has to start over.
+    def push(self, payload, samples):
+        labels = self.classify(samples)
+        self._lookback.append((payload, len(samples)))
+        self._lookback_len += len(samples)
+        if np.any(labels == DATA):
+            self._hangover = self.margin * self.block_len
+        elif self._hangover > 0:
+            self._hangover -= len(samples)
+        else:
+            # only hold back about a margin's worth of input, plus a block
+            # as data is only found once its block is complete
+            margin = (self.margin + 1) * self.block_len
+            while self._lookback_len - self._lookback[0][1] >= margin:
+                self._lookback_len -= self._lookback.pop(0)[1]
+                self._dropped = True
+            return []
+        self.gap, self._dropped = self._dropped, False
+        out = [p for p, _ in self._lookback]
+        self._lookback = []
+        self._lookback_len = 0
+        return out
+
+
+MAX_PHASES = 64  # sub-sample start phases rendered by NCOSynth
+
+
+# Exact-frequency, phase-continuous tone synthesis (a numerically
+# controlled oscillator) for the encoder, at any sample rate
+# - every bit holds whole cycles of its tone, so the oscillator's phase is
+#   zero at each bit boundary and a bit's samples only depend on where
+#   between two samples the bit starts; time is kept in 1/phases of a
+#   sample, with phases the denominator of the bit length (in samples,
+#   approximated to at most max_phases)
+# - words (bit sequences, e.g. the 256 framed bytes) are rendered once for
+#   every start phase as it's first needed, so encoding is table lookups
+# - output is PCM in a kcs_codec.SAMPLE_CODES format, at the level of
+#   kcs_codec.make_sin_wave, repeated in each of nchannels channels
+class NCOSynth:
+    def __init__(
+        self,
+        framerate,
+        profile,
+        sample_format="uint8",
+        nchannels=1,
+        words=(),
+        max_phases=MAX_PHASES,
+    ):
+        bit_len = Fraction(framerate * profile.one_cycles, profile.one_freq)
+        if bit_len != Fraction(framerate * profile.zero_cycles, profile.zero_freq):
+            raise ValueError("one and zero bits of different lengths")
+        if sample_format not in SAMPLE_CODES:
+            raise ValueError("unknown sample format %r" % (sample_format,))
+        self.bit_len = bit_len.limit_denominator(max_phases)
+        self.phases = self.bit_len.denominator
+        self.bit_units = self.bit_len.numerator  # in 1/phases of a sample
+        self.sample_format = sample_format
+        self.nchannels = nchannels
+        self.phase = 0  # next sample's time after the next bit's start
+        self._cycles = np.array([profile.zero_cycles, profile.one_cycles])
+        self._words = np.array(words, dtype=np.intp)
+        self._tables = {}  # start phase -> rendered words
+
+    # Render bit sequences (rows of a 2-d array, all of one length) starting
+    # at phase; returns the PCM of each and the phase after them
+    def _render(self, seqs, phase):
+        units = seqs.shape[1] * self.bit_units
+        n = -(-(units - phase) // self.phases)  # samples before the end
+        t = np.arange(n) * self.phases + phase  # in 1/phases of a sample
+        bit = t // self.bit_units
+        frac = (t - bit * self.bit_units) / self.bit_units  # into the bit
+        y = np.sin(2 * np.pi * self._cycles[seqs[:, bit]] * frac)
+        if self.sample_format == "uint8":
+            pcm = (CENTER + AMPLITUDE * y).astype(np.uint8)
+        elif self.sample_format == "int16":
+            pcm = (AMPLITUDE * 256 * y).astype("<i2")
+        else:
+            pcm = (AMPLITUDE / CENTER * y).astype("<f4")
+        pcm = np.repeat(pcm, self.nchannels, axis=1)
+        return [row.tobytes() for row in pcm], (phase - units) % self.phases
+
+    # PCM for a sequence of bits, continuing from the last output
+    def bits(self, bits):
+        if not len(bits):
+            return b""
+        (pcm,), self.phase = self._render(np.array([bits]), self.phase)
+        return pcm
+
+    # PCM for a sequence of words (indices into words), continuing from the
+    # last output
+    def words(self, values):
+        word_units = self._words.shape[1] * self.bit_units
+        tables = self._tables
+        out = []
+        phase = self.phase
+        for value in values:
+            table = tables.get(phase)
+            if table is None:
+                table = tables[phase] = self._render(self._words, phase)[0]
+            out.append(table[value])
+            phase = (phase - word_units) % self.phases
+        self.phase = phase
+        return b"".join(out)
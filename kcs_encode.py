@@ -15,39 +15,95 @@ cassette tape input on various vintage home computers. See
 http://en.wikipedia.org/wiki/Kansas_City_standard
 """
 
+import os
 import sys
 import optparse
-import math
 import wave
 
+from kcs_audio import FORMATS
+from kcs_codec import KCSConfig, KCSEncoder
+
 # A few global parameters related to the encoding
 
 FRAMERATE = 9600  # Hz
-ONES_FREQ = 2400  # Hz (per KCS)
-ZERO_FREQ = 1200  # Hz (per KCS)
+BLOCK_SIZE = 256  # data bytes encoded per block of output
 
 
-from kcs_encode_live import make_sin_wave, kcs_encode_byte
+# Generate blocks of PCM for data, with leader and trailer seconds of
+# carrier signal before and after it, so output can be written (and
+# played) as it is encoded
+def generate_pcm(encoder, data, leader, trailer, block_size=BLOCK_SIZE):
+    yield encoder.leader(leader)
+    data = memoryview(data)
+    for i in range(0, len(data), block_size):
+        yield encoder.encode(data[i : i + block_size])
+    yield encoder.trailer(trailer)
 
 
 # Write a WAV file with encoded data. leader and trailer specify the
 # number of seconds of carrier signal to encode before and after the data
-def kcs_write_wav(filename, data, leader, trailer, cuts):
+# (sample_format "uint8" or "int16", see kcs_codec.SAMPLE_CODES)
+def kcs_write_wav(
+    filename,
+    data,
+    leader,
+    trailer,
+    cuts,
+    speed_mode=0,
+    framerate=FRAMERATE,
+    sample_format="uint8",
+    nchannels=1,
+    exact_freq=False,
+):
+    if sample_format not in ("uint8", "int16"):
+        raise ValueError("WAV files can't hold %s samples (use --raw)" % sample_format)
+    encoder = KCSEncoder(
+        KCSConfig(
+            framerate=framerate,
+            speed_mode=speed_mode,
+            cuts=cuts,
+            out_format=sample_format,
+            out_channels=nchannels,
+            exact_freq=exact_freq,
+        )
+    )
     w = wave.open(filename, "wb")
-    w.setnchannels(1)
-    w.setsampwidth(1)
-    w.setframerate(FRAMERATE)
-
-    # Write the leader
-    w.writeframes(one_pulse * (int(FRAMERATE / len(one_pulse)) * leader))
+    w.setnchannels(nchannels)
+    w.setsampwidth(encoder.frame_size // nchannels)
+    w.setframerate(encoder.framerate)
+    for pcm in generate_pcm(encoder, data, leader, trailer):
+        w.writeframes(pcm)
+    w.close()
 
-    # Encode the actual data
-    for byteval in data:
-        w.writeframes(kcs_encode_byte(byteval, one_pulse, zero_pulse, cuts))
 
-    # Write the trailer
-    w.writeframes(one_pulse * (int(FRAMERATE / len(one_pulse)) * trailer))
-    w.close()
+# Write encoded data as raw (headerless) PCM to a binary file object, e.g.
+# standard output or a FIFO, flushing every block so that a player reading
+# the other end can start right away
+def kcs_write_raw(
+    outf,
+    data,
+    leader,
+    trailer,
+    cuts,
+    speed_mode=0,
+    framerate=FRAMERATE,
+    sample_format="uint8",
+    nchannels=1,
+    exact_freq=False,
+):
+    encoder = KCSEncoder(
+        KCSConfig(
+            framerate=framerate,
+            speed_mode=speed_mode,
+            cuts=cuts,
+            out_format=sample_format,
+            out_channels=nchannels,
+            exact_freq=exact_freq,
+        )
+    )
+    for pcm in generate_pcm(encoder, data, leader, trailer):
+        outf.write(pcm)
+        outf.flush()
 
 
 if __name__ == "__main__":
@@ -58,7 +114,7 @@ if __name__ == "__main__":
         type="int",
         default=0,
         dest="speed_mode",
-        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
     )
     parser.add_option(
         "-L",
@@ -84,24 +140,115 @@ if __name__ == "__main__":
         dest="cuts",
         help="ASCII only w/CUTS encoding (7 data bits, 3 stop bits)",
     )
+    parser.add_option(
+        "-r",
+        "--rate",
+        type="int",
+        default=FRAMERATE,
+        dest="framerate",
+        help="output sample rate in Hz (default %d; doubled up to the speed's "
+        "minimum)" % FRAMERATE,
+    )
+    parser.add_option(
+        "-F",
+        "--format",
+        type="choice",
+        choices=list(FORMATS),
+        default="u8",
+        dest="format",
+        help="sample format: u8, s16 or float (float: raw output only)",
+    )
+    parser.add_option(
+        "-c",
+        "--channels",
+        type="int",
+        default=1,
+        dest="nchannels",
+        help="number of output channels, all the same (default 1)",
+    )
+    parser.add_option(
+        "-E",
+        "--exact",
+        action="store_true",
+        default=False,
+        dest="exact_freq",
+        help="exact-frequency, phase-continuous tones at any rate (needs numpy)",
+    )
+    parser.add_option(
+        "--raw",
+        action="store_true",
+        default=False,
+        dest="raw",
+        help="write raw PCM instead of a WAV file, e.g. to a FIFO (outfile - "
+        "is standard output)",
+    )
     opts, args = parser.parse_args()
 
     if len(args) != 2:
         print("Usage : %s [options] infile outfile" % sys.argv[0], file=sys.stderr)
         raise SystemExit(1)
-
-    # Create the wave patterns that encode 1s and 0s
-    if opts.speed_mode == 2:
-        FRAMERATE *= 2
-        ONES_FREQ *= 2
-        ZERO_FREQ *= 2
-    HIGHSPEED = opts.speed_mode > 0
-    one_pulse = make_sin_wave(ONES_FREQ, FRAMERATE) * (2 if HIGHSPEED else 8)
-    zero_pulse = make_sin_wave(ZERO_FREQ, FRAMERATE) * (1 if HIGHSPEED else 4)
+    if opts.nchannels < 1:
+        parser.error("--channels must be at least 1")
+    if opts.framerate < 1:
+        parser.error("--rate must be at least 1")
 
     in_filename = args[0]
     out_filename = args[1]
     data = open(in_filename, "rb").read()
     # data = data.replace('\n','\r\n')         # Fix line endings
     rawdata = bytearray(data)
-    kcs_write_wav(out_filename, rawdata, opts.leader, opts.trailer, opts.cuts)
+    sample_format = FORMATS[opts.format]
+    if out_filename == "-" or opts.raw:
+        # raw PCM has no header, so point out a rate raised for the speed
+        config = KCSConfig(
+            framerate=opts.framerate,
+            speed_mode=opts.speed_mode,
+            exact_freq=opts.exact_freq,
+        )
+        try:
+            framerate = KCSEncoder(config).framerate
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise SystemExit(1)
+        if framerate != opts.framerate:
+            print("Output sample rate is %d Hz" % framerate, file=sys.stderr)
+        if out_filename == "-":
+            outf = sys.stdout.buffer
+        else:
+            outf = open(out_filename, "wb")
+        try:
+            kcs_write_raw(
+                outf,
+                rawdata,
+                opts.leader,
+                opts.trailer,
+                opts.cuts,
+                opts.speed_mode,
+                opts.framerate,
+                sample_format,
+                opts.nchannels,
+                opts.exact_freq,
+            )
+        except BrokenPipeError:  # the player went away
+            os.dup2(os.open(os.devnull, os.O_WRONLY), outf.fileno())
+            raise SystemExit(1)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise SystemExit(1)
+    else:
+        try:
+            kcs_write_wav(
+                out_filename,
+                rawdata,
+                opts.leader,
+                opts.trailer,
+                opts.cuts,
+                opts.speed_mode,
+                opts.framerate,
+                sample_format,
+                opts.nchannels,
+                opts.exact_freq,
+            )
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise SystemExit(1)
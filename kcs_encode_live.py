@@ -18,64 +18,113 @@ http://en.wikipedia.org/wiki/Kansas_City_standard
 from time import sleep
 import sys
 import optparse
-import math
 
-from queue import Queue
-from threading import Thread
+from collections import deque
+from threading import Condition, Thread
 
-import pyaudio
+from kcs_audio import UINT8, make_backend
+from kcs_codec import KCSConfig, KCSEncoder
 
 # A few global parameters related to the encoding
 
-FORMAT = pyaudio.paUInt8  # must be signed integer type
+FORMAT = UINT8
 CHANNELS = 1
 FRAMERATE = 44100
 CHUNK = 1024  # sweetspot, don't touch
-ONES_FREQ = 2400  # Hz (per KCS)
-ZERO_FREQ = 1200  # Hz (per KCS)
-AMPLITUDE = 120  # Amplitude of generated waves
-CENTER = 128  # Center point of generated waves
-
-# init PyAudio
-pa = pyaudio.PyAudio()
-
-
-# create a single sine wave cycle of a given frequency
-def make_sin_wave(freq, framerate):
-    n = int(round(framerate / freq))
-    y = [math.sin(2 * math.pi * e / n) for e in range(n)]
-    return bytes([int((CENTER + AMPLITUDE * e)) for e in y])
-
-
-# Take a single byte value and turn it into a bytearray representing
-# the associated waveform along with the required start and stop bits.
-def kcs_encode_byte(byteval, one_pulse, zero_pulse, cuts):
-    bitmasks = [0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80]
-    # The start bit (0)
-    encoded = bytearray(zero_pulse)
-    # 8 data bits
-    for mask in bitmasks:
-        if cuts and (mask == 0x80):
-            encoded.extend(one_pulse)  # CUTS encoding uses 3 stop bits
-        else:
-            encoded.extend(one_pulse if (byteval & mask) else zero_pulse)
-    # Two stop bits (1)
-    encoded.extend(one_pulse)
-    encoded.extend(one_pulse)
-    return bytes(encoded)
-
-
-def monitor_output(monitor_device, buffer_q):
-    monitor_stream = pa.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=FRAMERATE,
-        output=True,
-        output_device_index=monitor_device,
-        frames_per_buffer=1024,
-    )
+BUFFER_TIME = 0.5  # s of audio buffered ahead of each output device
+MAX_LAG = 5.0  # s an output device may fall behind before losing audio
+
+
+# Playback statistics of one output device
+class OutputStats:
+    def __init__(self, device, name=""):
+        self.device = device
+        self.name = name
+        self.blocks = 0  # blocks played
+        self.underflows = 0  # blocks the device ran dry before
+        self.dropped = 0  # blocks dropped as the device fell too far behind
+        self.max_queued = 0  # most frames waiting in its buffer
+
+    def summary(self):
+        return (
+            "device %d%s: %d blocks, %d underflows, %d dropped, "
+            "up to %d frames buffered"
+            % (
+                self.device,
+                " (%s)" % self.name if self.name else "",
+                self.blocks,
+                self.underflows,
+                self.dropped,
+                self.max_queued,
+            )
+        )
+
+
+# Blocks of audio queued for several output devices, each played by its
+# own thread (play_output). Queued audio is counted in frames, whatever
+# the size of the blocks.
+# - put() holds the producer back while every device has buffer_frames or
+#   more queued, so it keeps pace with the device that needs audio first
+# - a device that is slow to take audio doesn't stall the others: once it
+#   has max_lag_frames more queued than the device with the least, blocks
+#   for it are dropped (and counted) instead, so its buffer doesn't grow
+#   without bound either
+class OutputBuffers:
+    def __init__(self, stats, buffer_frames, max_lag_frames):
+        self.stats = stats
+        self.buffer_frames = max(1, buffer_frames)
+        self.max_lag_frames = max_lag_frames
+        self.blocks = [deque() for _ in stats]
+        self.queued = [0] * len(stats)  # frames queued for each device
+        self.closed = False
+        self.cond = Condition()
+
+    # queue a block of nframes frames for every device
+    def put(self, frames, nframes):
+        with self.cond:
+            while min(self.queued) >= self.buffer_frames:
+                self.cond.wait()
+            least = min(self.queued)
+            for i, device_stats in enumerate(self.stats):
+                if self.queued[i] - least > self.max_lag_frames:
+                    device_stats.dropped += 1
+                    continue
+                self.blocks[i].append((frames, nframes))
+                self.queued[i] += nframes
+                device_stats.max_queued = max(device_stats.max_queued, self.queued[i])
+            self.cond.notify_all()
+
+    # the next block for device i, or None once closed and played out
+    def get(self, i):
+        with self.cond:
+            while not self.blocks[i] and not self.closed:
+                self.cond.wait()
+            if not self.blocks[i]:
+                return None
+            frames, nframes = self.blocks[i].popleft()
+            self.queued[i] -= nframes
+            self.cond.notify_all()
+            return frames
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# Play the blocks for device i of buffers on an output stream until they
+# are closed and played out
+def play_output(stream, buffers, i):
+    stats = buffers.stats[i]
     while True:
-        monitor_stream.write(buffer_q.get())
+        frames = buffers.get(i)
+        if frames is None:
+            break
+        try:
+            stream.write(frames)
+        except IOError:  # the device ran dry before this block
+            stats.underflows += 1
+        stats.blocks += 1
 
 
 if __name__ == "__main__":
@@ -88,13 +137,20 @@ if __name__ == "__main__":
         dest="list_devices",
         help="list audio input devices and exit",
     )
+    parser.add_option(
+        "-B",
+        "--backend",
+        dest="backend",
+        default="pyaudio",
+        help="audio backend: pyaudio, or fake[:options] for testing without "
+        "sound hardware, e.g. fake:out=tape.wav (see kcs_audio.py)",
+    )
     parser.add_option(
         "-d",
         "--device",
         dest="device",
-        type="int",
-        default=-1,
-        help="audio input device id (system default if none)",
+        help="audio output device id, or comma-separated ids to play to "
+        "several devices at once (system default if none)",
     )
     parser.add_option(
         "-m",
@@ -110,7 +166,7 @@ if __name__ == "__main__":
         type="int",
         default=0,
         dest="speed_mode",
-        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud",
+        help="0 for 300 baud, 1 for 1200 baud, 2 for 2400 baud, 3 for 4800 baud",
     )
     parser.add_option(
         "-L",
@@ -144,17 +200,43 @@ if __name__ == "__main__":
         dest="echo",
         help="echo source file to stdout",
     )
+    parser.add_option(
+        "-E",
+        "--exact",
+        action="store_true",
+        default=False,
+        dest="exact_freq",
+        help="exact-frequency, phase-continuous tones at any rate (needs numpy)",
+    )
+    parser.add_option(
+        "--buffer-time",
+        dest="buffer_time",
+        type="float",
+        default=BUFFER_TIME,
+        help="seconds of audio buffered for each output device (default %g)"
+        % BUFFER_TIME,
+    )
+    parser.add_option(
+        "--max-lag",
+        dest="max_lag",
+        type="float",
+        default=MAX_LAG,
+        help="seconds an output device may fall behind the others before "
+        "audio for it is dropped (default %g)" % MAX_LAG,
+    )
     opts, args = parser.parse_args()
 
+    try:
+        audio = make_backend(opts.backend)
+    except ValueError as e:
+        print("Invalid --backend: %s" % e, file=sys.stderr)
+        raise SystemExit(1)
+
     # if req'd, list possible input devices
     if opts.list_devices:
-        info = pa.get_host_api_info_by_index(0)
-        numdevices = info.get("deviceCount")
-        for i in range(0, numdevices):
-            d = pa.get_device_info_by_host_api_device_index(0, i)
-            name = d["name"]
-            in_mark = "[IN]" if d["maxInputChannels"] > 0 else ""
-            out_mark = "[OUT]" if d["maxOutputChannels"] > 0 else ""
+        for i, name, has_input, has_output in audio.list_devices():
+            in_mark = "[IN]" if has_input else ""
+            out_mark = "[OUT]" if has_output else ""
             if in_mark or out_mark:
                 print(
                     f"Device id {i} - {name} {in_mark}{out_mark} ",
@@ -168,57 +250,74 @@ if __name__ == "__main__":
         input_f = open(args[0], "rb")
 
     # if device not specified, use system default
-    if opts.device < 0:
-        device = pa.get_default_input_device_info()["index"]
+    if opts.device is None:
+        devices = [audio.default_output()]
     else:
-        device = opts.device
-
-    # Create the wave patterns that encode 1s and 0s
-    if opts.speed_mode == 2:
-        FRAMERATE *= 2
-        ONES_FREQ *= 2
-        ZERO_FREQ *= 2
-    HIGHSPEED = opts.speed_mode > 0
-    one_pulse = make_sin_wave(ONES_FREQ, FRAMERATE) * (2 if HIGHSPEED else 8)
-    zero_pulse = make_sin_wave(ZERO_FREQ, FRAMERATE) * (1 if HIGHSPEED else 4)
-
-    # start outputting
-    stream = pa.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=FRAMERATE,
-        output=True,
-        output_device_index=device,
-        frames_per_buffer=CHUNK,
-    )
-    stdout = sys.stdout.buffer.raw
+        try:
+            devices = [int(d) for d in opts.device.split(",")]
+        except ValueError:
+            print("Invalid --device: %s" % opts.device, file=sys.stderr)
+            raise SystemExit(1)
 
-    if opts.monitor_device >= 0:
-        buffer_q = Queue()
-        monitor_thread = Thread(
-            target=monitor_output,
-            kwargs=dict(monitor_device=opts.monitor_device, buffer_q=buffer_q),
+    # Create the encoder (wave patterns that encode 1s and 0s)
+    try:
+        encoder = KCSEncoder(
+            KCSConfig(
+                framerate=FRAMERATE,
+                speed_mode=opts.speed_mode,
+                cuts=opts.cuts,
+                exact_freq=opts.exact_freq,
+            )
         )
-        monitor_thread.daemon = True
-        monitor_thread.start()
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        raise SystemExit(1)
+    framerate = encoder.framerate
 
-    leader = one_pulse * int(FRAMERATE / len(one_pulse)) * opts.leader
+    # start outputting: each block is rendered once and queued for every
+    # output device (the monitor is just one more); long stretches of audio
+    # (leader, trailer) are queued in blocks of CHUNK frames
+    outputs = [(device, "") for device in devices]
     if opts.monitor_device >= 0:
-        buffer_q.put(leader)
-    stream.write(leader, exception_on_underflow=True)
+        outputs.append((opts.monitor_device, "monitor"))
+    stats = [OutputStats(device, name) for device, name in outputs]
+    buffers = OutputBuffers(
+        stats, int(opts.buffer_time * framerate), int(opts.max_lag * framerate)
+    )
+    streams, threads = [], []
+    for i, (device, name) in enumerate(outputs):
+        stream = audio.open_output(
+            device, framerate, FORMAT, CHANNELS, CHUNK, raise_underflow=True
+        )
+        thread = Thread(target=play_output, args=(stream, buffers, i))
+        thread.daemon = True
+        thread.start()
+        streams.append(stream)
+        threads.append(thread)
+    stdout = sys.stdout.buffer.raw
+
+    def play(frames):
+        block_size = CHUNK * encoder.frame_size
+        for i in range(0, len(frames), block_size):
+            block = frames[i : i + block_size]
+            buffers.put(block, len(block) // encoder.frame_size)
+
+    play(encoder.leader(opts.leader))
 
     for byteval in input_f.read():
-        encoded_data = kcs_encode_byte(byteval, one_pulse, zero_pulse, opts.cuts)
-        if opts.monitor_device >= 0:
-            buffer_q.put(encoded_data)
-        stream.write(encoded_data, exception_on_underflow=True)
+        play(encoder.encode(bytes([byteval])))
         if opts.echo:
             stdout.write(bytes([byteval]))
             stdout.flush()
 
-    trailer = one_pulse * int(FRAMERATE / len(one_pulse)) * opts.trailer
-    if opts.monitor_device >= 0:
-        buffer_q.put(trailer)
-    stream.write(trailer, exception_on_underflow=True)
+    play(encoder.trailer(opts.trailer))
 
+    buffers.close()
+    for thread in threads:
+        thread.join()
     sleep(1)
+    for stream in streams:
+        stream.close()
+    if len(outputs) > 1 or any(st.underflows or st.dropped for st in stats):
+        for device_stats in stats:
+            print(device_stats.summary(), file=sys.stderr)
@@ -0,0 +1,207 @@
+#
+
+# FFT-based KCS decoding core, shared by kcs_decode_live_fft.py and tools
+# - no audio device access, so it can be used headless
+# - dominant frequency per sample (via sliding-window FFT), then codeword
+#   matching on the resulting stream
+
+import numpy as np
+
+from kcs_codec import get_profile
+from kcs_dsp import pcm_to_float
+
+BATCH_CHUNK = 1 << 15  # samples per FFT block when decoding files
+LOOKAHEAD = 11  # symbols examined beyond one codeword (a second codeword)
+MIN_LOOKAHEAD = 3  # codeword plus start/stop symbols and some slack to match
+
+
+# Generate blocks of float samples for one channel of a WAV file of any
+# sample width, for batch decoding
+def generate_wav_samples(wavefile, channel=0, blocksize=BATCH_CHUNK):
+    samplewidth = wavefile.getsampwidth()
+    nchannels = wavefile.getnchannels()
+    while True:
+        frames = wavefile.readframes(blocksize)
+        if not frames:
+            break
+        yield pcm_to_float(frames, samplewidth, nchannels, channel)
+
+
+# widths (in samples) of the FFT window and of one symbol (data bit);
+# the window spans about one cycle of the zero frequency, so FFT bins 1 and
+# 2 correspond to zero and one bits
+# NOTE: this needs a profile with the one frequency twice the zero
+# frequency, and codewords of 1 start and 2 stop bits (as matched below)
+def get_fft_params(framerate, speed_mode):
+    profile = get_profile(speed_mode)
+    if profile.one_freq != 2 * profile.zero_freq or (
+        (profile.start_bits, profile.stop_bits) != (1, 2)
+    ):
+        raise ValueError("profile not supported by the FFT decoder")
+    one_len = round(framerate / profile.one_freq)
+    zero_len = round(framerate / profile.zero_freq)
+    window_len = int((one_len * 2 + zero_len) / 2)
+    symbol_len = window_len * profile.zero_cycles
+    return window_len, symbol_len
+
+
+def decode_byte(bit_arr, little_endian=True):
+    mask = 0x1 if little_endian else 0x80
+    byte_val = np.uint8(0)
+    for i in range(8):
+        byte_val += bit_arr[i] * mask
+        mask = (mask << 1) if little_endian else (mask >> 1)
+    return byte_val
+
+
+def sliding_window(arr, window_size):
+    shape = (arr.size - window_size + 1, window_size)
+    strides = arr.strides * 2
+    return np.lib.stride_tricks.as_strided(arr, shape=shape, strides=strides)
+
+
+def do_fft(sample, window_len):
+    # extract dominant frequencies from sample
+    sample_w = sliding_window(sample, window_len)
+    sample_fft = np.abs(np.fft.fft(sample_w, axis=1))
+    sample_fft = sample_fft.T[: window_len // 2]  # simple filter
+    return np.argmax(sample_fft, axis=0)
+
+
+def generate_freqs(sample_it, window_len, chunk_size):
+    # take a stream of audio samples, emit a stream of dominant frequencies
+    # NOTE: output length identical to input length
+    buf_chunk_size = chunk_size + window_len - 1
+    buf = np.zeros(window_len - 1)  # init w/padding
+    while True:
+        # ensure sample length enough for output chunk
+        while len(buf) < buf_chunk_size:
+            try:  # get more samples
+                buf = np.concatenate([buf, next(sample_it)])
+            except ValueError:  # invalid sample
+                continue
+            except StopIteration:  # output shorter than chunk_size
+                # NOTE: # guaranteed at least window_len-1 samples
+                yield do_fft(buf, window_len)
+                return
+        # calculate & yield dominant frequencies on sliding windows
+        yield do_fft(buf[:buf_chunk_size], window_len)
+        # prepare for next sample batch
+        buf = buf[chunk_size:]
+
+
+# Drop the first n items of a stream of blocks (numpy arrays)
+def skip_items(block_it, n):
+    for block in block_it:
+        if n >= len(block):
+            n -= len(block)
+            continue
+        yield block[n:]
+        n = 0
+
+
+# Generate decoded bytes from a stream of dominant frequencies
+# - lookahead: symbols examined beyond one codeword; fewer means bytes come
+#   out sooner (lower latency) but a misaligned codeword is recovered later
+# - if index is a list, a (start sample, byte value) tuple is appended to it
+#   for every byte, the start counting from the start of the stream
+# - if state is a dict, its "pos" is set to the stream position just after
+#   every byte as it is emitted; decoding the stream from there on gives the
+#   rest of the bytes, so that is all a checkpoint needs
+def generate_bytes(freq_it, symbol_len, lookahead=LOOKAHEAD, index=None, state=None):
+    # prepare items for matching codewords
+    word_len = symbol_len * 11  # code word = 1+8+2 symbols
+    work_len = word_len + max(lookahead, MIN_LOOKAHEAD) * symbol_len
+    start_kernel = -1 * np.ones(symbol_len) / symbol_len  # works on {-1,1}
+    stop_kernel = 1 * np.ones(symbol_len) / symbol_len
+    # consume dominant frequencies, output stream of bytes
+    # NOTE: only the first work_len of the buffer is examined at a time, so
+    # large input blocks (batch decoding) work the same way as live-sized
+    # chunks
+    freq_buf = np.array([])
+    pos = 0  # stream position of freq_buf[0]
+    eof = False
+    while True:
+
+        # get at least work_len in buffer
+        while not eof and len(freq_buf) < work_len:
+            try:
+                freq_buf = np.concatenate([freq_buf, next(freq_it)])
+            except StopIteration:
+                # pad the tail with carrier (as a trailer would), so a
+                # final codeword right at the end can still be matched
+                eof = True
+                freq_buf = np.concatenate([freq_buf, np.full(word_len, 2)])
+        if eof and len(freq_buf) <= word_len + symbol_len:
+            return  # no complete codeword left
+        work = freq_buf[:work_len]
+
+        # detect signal & handle no-carrier case
+        signal_on = ((work == 1) | (work == 2)).sum() / len(work) > 0.8
+        if not signal_on:  # slide on by a codeword, keeping any data ahead
+            freq_buf = freq_buf[word_len:]
+            pos += word_len
+            continue
+
+        # cleanup signals
+        freq_buf_pp = work.clip(1, 2) * 2 - 3  # convert {1,2} to {-1,1}
+
+        # try to match codeword
+        # NOTE: sort-of-working self-correction on misalignment
+        start_match = np.convolve(freq_buf_pp, start_kernel, mode="valid")
+        start_offset = 1 * symbol_len  # move peak to start of start symbol
+        start_match = np.pad(
+            start_match[start_offset:],
+            (len(start_kernel) - 1, start_offset),
+            constant_values=0,
+        )
+        stop_match = np.convolve(freq_buf_pp, stop_kernel, mode="valid")
+        stop_offset = (9 + 2) * symbol_len  # move peak to start of stop symbol
+        stop_match = np.pad(
+            stop_match[stop_offset:],
+            (len(stop_kernel) - 1, stop_offset),
+            constant_values=0,
+        )
+        match = start_match + stop_match > 1.0  # TODO
+        match = np.pad(
+            match[: -symbol_len // 2], (symbol_len // 2, 0), constant_values=0
+        )
+
+        # find start position of first codeword
+        try:
+            word_start = np.nonzero(match == True)[0][0] + symbol_len
+            word_end = word_start + 8 * (symbol_len)
+        except IndexError:  # didn't find start of code word
+            if eof and len(work) == len(freq_buf):
+                return
+            # keep the last word (and a symbol): a codeword starting there
+            # can't be matched until its stop bits are in view
+            keep = len(work) - word_len - symbol_len
+            freq_buf = freq_buf[keep:]
+            pos += keep
+            continue  # skip to next loop
+
+        # handle not enough samples in buffer
+        if len(work) - word_start < word_len:
+            if eof and len(work) == len(freq_buf):
+                return  # partial codeword at the end
+            # go back far enough that the codeword's start symbol isn't in
+            # the first symbol of the buffer, where it can't be matched
+            freq_buf = freq_buf[word_start - 3 * symbol_len :]
+            pos += word_start - 3 * symbol_len
+            continue
+
+        # decode bits
+        bits = (
+            (freq_buf_pp[word_start:word_end].reshape((8, symbol_len))).mean(axis=1) > 0
+        ).astype(int)
+        byte_val = decode_byte(bits)
+        if index is not None:
+            index.append((pos + word_start - symbol_len, byte_val))
+        if state is not None:
+            state["pos"] = int(pos + word_end)
+        yield byte_val
+
+        # truncate decoded word from buffer
+        freq_buf = freq_buf[word_end:]
+        pos += word_end
@@ -0,0 +1,72 @@
+#
+
+# Latency instrumentation for the live decoders
+# - the capture loop records when each block of audio arrived
+# - the output loop reports the sample position at which each decoded byte
+#   ends; its latency is the time from when that sample was captured (the
+#   arrival of its block, less the duration of the samples after it in the
+#   block) to the byte being written out
+# - this covers capture block waiting, decoder lookahead and processing,
+#   but not the sound card's own buffering
+
+import time
+from collections import deque
+
+HISTORY = 10000  # latencies kept for percentiles
+
+
+class LatencyMeter:
+    def __init__(self, framerate, history=HISTORY):
+        self.framerate = framerate
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=history)
+        self._arrivals = deque()  # (end sample, arrival time) per block
+        self._captured = 0  # samples captured so far
+
+    # call as a block of nframes samples arrives
+    def arrived(self, nframes, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._captured += nframes
+        self._arrivals.append((self._captured, now))
+
+    # call as a byte ending at sample position end is output; returns its
+    # latency in seconds
+    def output(self, end, now=None):
+        arrivals = self._arrivals
+        while len(arrivals) > 1 and arrivals[0][0] <= end:
+            arrivals.popleft()  # blocks wholly before the byte's end
+        if not arrivals:
+            return None
+        if now is None:
+            now = time.monotonic()
+        block_end, arrival = arrivals[0]
+        captured = arrival - max(block_end - 1 - end, 0) / float(self.framerate)
+        latency = now - captured
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self._recent.append(latency)
+        return latency
+
+    def percentile(self, p):
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+    def summary(self):
+        if not self.count:
+            return "latency: no bytes yet"
+        return (
+            "latency: %d bytes, mean %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms"
+            % (
+                self.count,
+                1000 * self.total / self.count,
+                1000 * self.percentile(50),
+                1000 * self.percentile(95),
+                1000 * self.max,
+            )
+        )
@@ -0,0 +1,265 @@
+#
+
+# Multi-process live decoding pipeline
+# - audio capture, the FFT front end and framing run in separate processes,
+#   so a slow stage doesn't stall capture under the GIL
+# - stages are connected by single-producer single-consumer ring buffers in
+#   multiprocessing.shared_memory: blocks are written into the ring and read
+#   in place as numpy views, never pickled or sent through a pipe (the FFT
+#   stage does copy each block it reads, to join it to the window overlap)
+#
+# Used by kcs_decode_live_fft.py -P; the framing stage is the calling
+# process, which reads the front end's ring with iter_ring().
+
+import signal
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from kcs_audio import make_backend
+from kcs_fft import do_fft
+
+RING_TIME = 2.0  # s of audio each ring holds
+WAIT_TIME = 0.1  # s at most between checks of a ring while waiting
+JOIN_TIME = 5.0  # s to wait for each stage to stop
+HEADER = 64  # bytes ahead of the data: the fields below, as int64
+WRITE_POS, READ_POS, WRITER_CLOSED, READER_CLOSED = range(4)
+
+
+# Wait until ready() returns something true, and return that. The event is
+# cleared before each check, so a set() by the other side after it changed
+# the ring always ends the wait that follows; the timeout only bounds the
+# wait for a side that died. Events never count up, unlike semaphores,
+# which would overflow after SEM_VALUE_MAX unmatched releases.
+def wait_for(event, ready):
+    while True:
+        event.clear()
+        result = ready()
+        if result:
+            return result
+        event.wait(WAIT_TIME)
+
+
+# Ring buffer of numpy items in shared memory, for one writer and one
+# reader. Create it with create() in the parent and attach with
+# ShmRing(*ring.handle()) in the other process.
+# - the header is only read or updated with the lock held, which also
+#   orders the data written into the ring before the position that
+#   publishes it
+# - either side can close its end: the reader sees the end of the stream
+#   once the writer's is closed and all is read, and the writer's writes
+#   are dropped once the reader's is (a stop flag for the stage writing)
+class ShmRing:
+    def __init__(self, name, dtype, capacity, lock, items, space, owner=False):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self._lock = lock  # guards the header
+        self._items = items  # set by the writer after each change
+        self._space = space  # set by the reader after each change
+        self._owner = owner
+        if owner:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=HEADER + capacity * self.dtype.itemsize
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self._header = np.ndarray(4, dtype=np.int64, buffer=self.shm.buf)
+        self._data = np.ndarray(
+            capacity, dtype=self.dtype, buffer=self.shm.buf, offset=HEADER
+        )
+        if owner:
+            self._header[:] = 0
+
+    @classmethod
+    def create(cls, ctx, dtype, capacity):
+        return cls(None, dtype, capacity, ctx.Lock(), ctx.Event(), ctx.Event(), True)
+
+    # arguments to attach to this ring from another process
+    def handle(self):
+        return (
+            self.shm.name,
+            self.dtype.str,
+            self.capacity,
+            self._lock,
+            self._items,
+            self._space,
+        )
+
+    def _get(self, field):
+        with self._lock:
+            return int(self._header[field])
+
+    # set a header field and wake the other side
+    def _set(self, field, value, event):
+        with self._lock:
+            self._header[field] = value
+        event.set()
+
+    # Append items, waiting for the reader to make room. Returns False (and
+    # drops the items) if the reader has closed its end.
+    def write(self, items):
+        items = np.asarray(items, dtype=self.dtype)
+        step = self.capacity // 2
+        for i in range(0, len(items), step):
+            block = items[i : i + step]
+
+            def room():
+                with self._lock:
+                    written, read, _, reader_closed = self._header.tolist()
+                if reader_closed or written - read <= self.capacity - len(block):
+                    return written, bool(reader_closed)
+
+            written, reader_closed = wait_for(self._space, room)
+            if reader_closed:
+                return False
+            start = written % self.capacity
+            first = min(len(block), self.capacity - start)
+            self._data[start : start + first] = block[:first]
+            self._data[: len(block) - first] = block[first:]
+            self._set(WRITE_POS, written + len(block), self._items)
+        return True
+
+    # mark the end of the stream
+    def close_writer(self):
+        self._set(WRITER_CLOSED, 1, self._items)
+
+    # Return a view of up to max_items unread items (without copying), or
+    # None at the end of the stream. The items stay valid until advance().
+    def read(self, max_items):
+        def unread():
+            with self._lock:
+                written, read, writer_closed, _ = self._header.tolist()
+            if written > read or writer_closed:
+                return written, read
+
+        written, read = wait_for(self._items, unread)
+        if written == read:
+            return None
+        start = read % self.capacity
+        n = min(written - read, self.capacity - start, max_items)
+        return self._data[start : start + n]
+
+    # release items returned by read()
+    def advance(self, n):
+        self._set(READ_POS, self._get(READ_POS) + n, self._space)
+
+    # stop reading: the writer's writes are dropped from now on
+    def close_reader(self):
+        self._set(READER_CLOSED, 1, self._space)
+
+    def close(self):
+        del self._header, self._data  # views must go before the mapping
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+# Generate blocks of items from a ring, each valid until the next is asked for
+def iter_ring(ring, block_size):
+    while True:
+        block = ring.read(block_size)
+        if block is None:
+            return
+        yield block
+        ring.advance(len(block))
+
+
+# capture process: audio from an input device (and monitor) into a ring
+def capture_stage(
+    backend, device, monitor_device, rate, fmt, channels, block_size, out_handle
+):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops us
+    audio = make_backend(backend)
+    out = ShmRing(*out_handle)
+    streams = []
+    try:  # the ring is closed even if a device fails to open
+        stream = audio.open_input(device, rate, fmt, channels, block_size)
+        streams.append(stream)
+        if monitor_device >= 0:
+            monitor = audio.open_output(monitor_device, rate, fmt, channels, block_size)
+            streams.append(monitor)
+        while True:
+            frames = stream.read(block_size)
+            if not frames:
+                break
+            if monitor_device >= 0:
+                monitor.write(frames)
+            if not out.write(np.frombuffer(frames, dtype=out.dtype)):
+                break  # stopped
+    finally:
+        out.close_writer()
+        for s in streams:
+            s.close()
+        out.close()
+
+
+# front end process: dominant FFT frequency of every sample, ring to ring
+# (same output as kcs_fft.generate_freqs)
+def fft_stage(in_handle, out_handle, window_len, chunk_size):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops us
+    ring_in = ShmRing(*in_handle)
+    out = ShmRing(*out_handle)
+    try:
+        buf = np.zeros(window_len - 1, dtype=np.float32)  # init w/padding
+        for block in iter_ring(ring_in, chunk_size):
+            buf = np.concatenate([buf, block])
+            if len(buf) >= chunk_size + window_len - 1:
+                if not out.write(do_fft(buf, window_len)):
+                    return  # stopped
+                buf = buf[len(buf) - window_len + 1 :]
+        out.write(do_fft(buf, window_len))
+    finally:
+        out.close_writer()
+        ring_in.close_reader()  # stops the capture stage in turn
+        ring_in.close()
+        out.close()
+
+
+# Start capture and FFT front end processes for live decoding; returns the
+# processes and the rings (for stop_fft_pipeline) and a generator of
+# frequency blocks for kcs_fft.generate_bytes
+def start_fft_pipeline(
+    backend, device, monitor_device, rate, fmt, block_size, window_len
+):
+    ctx = multiprocessing.get_context("spawn")
+    capacity = int(rate * RING_TIME)
+    samples = ShmRing.create(ctx, np.float32, capacity)
+    freqs = ShmRing.create(ctx, np.int16, capacity)
+    procs = [
+        ctx.Process(
+            target=capture_stage,
+            args=(
+                backend,
+                device,
+                monitor_device,
+                rate,
+                fmt,
+                1,
+                block_size,
+                samples.handle(),
+            ),
+            daemon=True,
+        ),
+        ctx.Process(
+            target=fft_stage,
+            args=(samples.handle(), freqs.handle(), window_len, block_size),
+            daemon=True,
+        ),
+    ]
+    for proc in procs:
+        proc.start()
+    return procs, [samples, freqs], iter_ring(freqs, block_size)
+
+
+# Stop the processes of start_fft_pipeline and close its rings (the caller
+# must drop its views into the last ring first, e.g. by closing the
+# generator). Closing the reading end of the last ring stops the stage
+# writing to it, which closes the reading end of its own input, and so on
+# back to capture, so every stage finishes its loop and cleans up.
+def stop_fft_pipeline(procs, rings):
+    rings[-1].close_reader()
+    for proc in procs:
+        proc.join(JOIN_TIME)
+    for ring in rings:
+        ring.close()
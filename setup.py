@@ -9,6 +9,9 @@ setup(name="py-kcs",
       url="http://www.dabeaz.com/py-kcs/index.html",
       description="Encode and Decode Kansas City Standard Cassette Audio Data",
       scripts = ['kcs_encode.py','kcs_decode.py'],
+      py_modules = ['kcs_codec','kcs_async','kcs_cache','kcs_fft',
+                    'kcs_dsp','kcs_latency','kcs_audio',
+                    'kcs_pipeline','kcs_checkpoint','kcs_channel_sim'],
       classifiers = ['Programming Language :: Python :: 3',
                      'Topic :: Multimedia :: Sound/Audio :: Conversion'])
 
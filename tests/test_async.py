@@ -0,0 +1,94 @@
+import asyncio
+import optparse
+import os
+import random
+import socket
+
+from kcs_async import KCSStreamWriter, decode_stream, serve
+from kcs_codec import KCSConfig
+
+CONFIG = KCSConfig(44100, 1, samplewidth=2, out_format="int16")
+DATA = [bytes(random.Random(i).choices(range(256), k=500)) for i in range(3)]
+
+
+async def send(writer, data):
+    out = KCSStreamWriter(writer, CONFIG, chunk_size=37)
+    await out.leader(1)
+    await out.write(data)
+    await out.trailer(1)
+    await out.close()
+
+
+async def receive(reader):
+    chunks = []
+    async for data in decode_stream(reader, CONFIG, chunk_size=1000):
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+# encode -> socket -> decode, for several streams at once
+def test_round_trip():
+    async def round_trip(data):
+        a, b = socket.socketpair()
+        _, writer = await asyncio.open_connection(sock=a)
+        reader, _ = await asyncio.open_connection(sock=b)
+        _, decoded = await asyncio.gather(send(writer, data), receive(reader))
+        return decoded
+
+    async def main():
+        return await asyncio.gather(*(round_trip(data) for data in DATA))
+
+    assert asyncio.run(main()) == DATA
+
+
+# the server decodes each connection into its own file, and closes the
+# connection when the stream ends
+def test_serve(tmp_path):
+    path = str(tmp_path / "kcs.sock")
+    prefix = str(tmp_path / "out-")
+    opts = optparse.Values(dict(unix_socket=path, output_prefix=prefix))
+
+    async def client(data):
+        reader, writer = await asyncio.open_unix_connection(path)
+        out = KCSStreamWriter(writer, CONFIG)
+        await out.leader(1)
+        await out.write(data)
+        await out.trailer(1)
+        writer.write_eof()
+        assert await reader.read() == b""  # closed by the server
+        writer.close()
+        await writer.wait_closed()
+
+    async def main():
+        server = asyncio.ensure_future(serve(opts, CONFIG))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*(client(data) for data in DATA))
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+    asyncio.run(main())
+    outputs = []
+    for i in range(len(DATA)):
+        with open("%s%d.bin" % (prefix, i + 1), "rb") as f:
+            outputs.append(f.read())
+    assert sorted(outputs) == sorted(DATA)
+
+
+# a connection is closed even if its output file can't be opened
+def test_serve_closes_on_error(tmp_path):
+    path = str(tmp_path / "kcs.sock")
+    prefix = str(tmp_path / "missing" / "out-")
+    opts = optparse.Values(dict(unix_socket=path, output_prefix=prefix))
+
+    async def main():
+        server = asyncio.ensure_future(serve(opts, CONFIG))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(path)
+        assert await asyncio.wait_for(reader.read(), 5) == b""
+        writer.close()
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+    asyncio.run(main())
@@ -0,0 +1,200 @@
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import wave
+from array import array
+
+import pytest
+
+from kcs_audio import FLOAT32, INT16, UINT8, FakeBackend, RawPCMReader, make_backend
+from kcs_codec import KCSConfig, KCSEncoder, generate_bytes
+from kcs_decode import generate_wav_sign_change_bits
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(5).choices(range(256), k=300))
+
+
+# a RawPCMReader on the read end of a pipe; a thread writes data into the
+# other end in pieces of the given sizes, pausing after each
+def pipe_reader(data, sizes, fmt=INT16, nchannels=1, pause=0.001):
+    r, w = os.pipe()
+
+    def writer():
+        with os.fdopen(w, "wb", buffering=0) as f:
+            pos = 0
+            for size in sizes:
+                f.write(data[pos : pos + size])
+                pos += size
+                time.sleep(pause)
+            f.write(data[pos:])
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    return RawPCMReader(os.fdopen(r, "rb"), 44100, fmt, nchannels), thread
+
+
+# reads wait for whole requests, and a partial frame at the end is dropped
+def test_blocking_reads():
+    data = bytes(range(200)) + b"\x01"  # 50 stereo frames, plus a stray byte
+    wf, thread = pipe_reader(data, [1, 2, 3, 5, 7, 11, 13, 17], nchannels=2)
+    assert wf.getnframes() == sys.maxsize
+    assert wf.getsampwidth() == 2
+    assert wf.readframes(10) == data[:40]
+    assert wf.tell() == 10
+    assert wf.readframes(100) == data[40:200]
+    assert wf.readframes(100) == b""
+    assert wf.tell() == 50
+    wf.close()
+    thread.join()
+
+
+def test_setpos_forward_only():
+    data = bytes(range(100))
+    wf, thread = pipe_reader(data, [9, 9, 9], fmt=UINT8)
+    wf.setpos(30)
+    assert wf.tell() == 30
+    with pytest.raises(ValueError):
+        wf.setpos(10)
+    assert wf.readframes(5) == data[30:35]
+    wf.setpos(1000)  # past the end: stops there
+    assert wf.tell() == 100
+    wf.close()
+    thread.join()
+
+
+def test_float_to_int16():
+    pytest.importorskip("numpy")
+    samples = array("f", [0.0, 0.5, -0.5, 2.0, -2.0])
+    wf, thread = pipe_reader(samples.tobytes(), [3, 6], fmt=FLOAT32)
+    assert wf.getsampwidth() == 2
+    assert array("h", wf.readframes(5)).tolist() == [0, 16384, -16384, 32767, -32768]
+    wf.close()
+    thread.join()
+
+
+# a slowly written stream decodes the same as a file
+def test_decode_from_pipe():
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    pcm = enc.leader(1) + enc.encode(DATA) + enc.trailer(1)
+    wf, thread = pipe_reader(pcm, [4097] * 20)
+    bits = generate_wav_sign_change_bits(wf)
+    assert bytes(generate_bytes(bits, 44100, 0, 1, False)) == DATA
+    wf.close()
+    thread.join()
+
+
+# the decoders read --raw input from a pipe, without any sound library
+@pytest.mark.parametrize("script", ["kcs_decode.py", "kcs_decode_live_fft.py"])
+def test_decode_raw_cli(tmp_path, script):
+    pytest.importorskip("numpy")
+    enc = KCSEncoder(KCSConfig(48000, 1, out_format="float32"))
+    pcm = enc.leader(1) + enc.encode(DATA) + enc.trailer(1)
+    out = str(tmp_path / "out")
+    cmd = [sys.executable, os.path.join(ROOT, script), "-s", "1", "--raw"]
+    cmd += ["--rate", "48000", "--format", "float", "-o", out, "-"]
+    subprocess.run(cmd, input=pcm, check=True)
+    with open(out, "rb") as f:
+        assert f.read() == DATA
+
+
+# a mono 16-bit WAV file of 10000 frames counting up from 0
+def write_ramp(path):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(array("h", range(10000)).tobytes())
+
+
+def read_all(stream, block_size):
+    blocks = []
+    for frames in iter(lambda: stream.read(block_size), b""):
+        blocks.append(array("h", frames).tolist())
+    stream.close()
+    return blocks
+
+
+# every nth read loses the block ahead of it, and is counted
+def test_fake_overflow(tmp_path):
+    path = str(tmp_path / "ramp.wav")
+    write_ramp(path)
+    audio = make_backend("fake:in=%s,overflow=3" % path)
+    stream = audio.open_input(audio.default_input(), 44100, INT16, 1, 100)
+    blocks = read_all(stream, 100)
+    # 3rd read: frames 200-299 lost, 300-399 read; 6th: 600-699 lost, ...
+    starts = [block[0] for block in blocks]
+    assert starts[:6] == [0, 100, 300, 400, 500, 700]
+    assert all(block == list(range(block[0], block[0] + 100)) for block in blocks)
+    assert (len(blocks), audio.overflows) == (75, 25)
+
+
+# every nth write is preceded by a block of silence; each output device
+# gets its own file
+def test_fake_underflow(tmp_path):
+    out = str(tmp_path / "out%d.wav")
+    audio = FakeBackend(outfile=out, underflow_every=2, noutputs=2)
+    for device in (1, 2):
+        stream = audio.open_output(device, 44100, INT16, 1, 100, device == 2)
+        for i in range(5):
+            block = array("h", [device * 100 + i] * 10).tobytes()
+            if device == 2 and i % 2:
+                with pytest.raises(IOError):
+                    stream.write(block)
+            else:
+                stream.write(block)
+        stream.close()
+    assert audio.underflows == 4
+    for device in (1, 2):
+        with wave.open(out % device) as wf:
+            samples = array("h", wf.readframes(wf.getnframes())).tolist()
+        values = [device * 100 + i for i in range(5)]
+        expected = values[:1] + [0] + values[1:3] + [0] + values[3:]
+        assert samples == [v for v in expected for _ in range(10)]
+
+
+# in loopback mode, input reads what output writes (converted), and ends
+# once the output is closed
+def test_fake_loopback():
+    audio = make_backend("fake:loopback")
+    data = bytes(range(256)) * 10
+
+    def play():
+        stream = audio.open_output(1, 44100, UINT8, 1, 100)
+        for i in range(0, len(data), 333):
+            stream.write(data[i : i + 333])
+            time.sleep(0.001)
+        stream.close()
+
+    stream = audio.open_input(audio.default_input(), 44100, UINT8, 1, 100)
+    thread = threading.Thread(target=play)
+    thread.start()
+    received = b"".join(iter(lambda: stream.read(100), b""))
+    thread.join()
+    assert received == data
+
+
+# in real time mode, streams take as long as the audio would play
+def test_fake_realtime(tmp_path):
+    path = str(tmp_path / "ramp.wav")
+    write_ramp(path)  # 0.23 s
+    for spec, paced in ("fake:in=%s", False), ("fake:in=%s,realtime", True):
+        audio = make_backend(spec % path)
+        t = time.monotonic()
+        stream = audio.open_input(audio.default_input(), 44100, INT16, 1, 1000)
+        read_all(stream, 1000)
+        elapsed = time.monotonic() - t
+        assert (elapsed >= 10000 / 44100) == paced
+
+
+def test_make_backend():
+    audio = make_backend("fake:in=a.wav,out=b%d.wav,underflow=7,outputs=2")
+    assert (audio.infile, audio.outfile) == ("a.wav", "b%d.wav")
+    assert (audio.underflow_every, audio.overflow_every) == (7, 0)
+    assert [d[0] for d in audio.list_devices()] == [0, 1, 2]
+    assert make_backend("fake:realtime=no").realtime is False
+    for spec in "fake:speed=2", "alsa":
+        with pytest.raises(ValueError):
+            make_backend(spec)
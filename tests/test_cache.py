@@ -0,0 +1,121 @@
+import os
+import random
+import subprocess
+import sys
+import wave
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from kcs_cache import BitCache
+from kcs_codec import KCSConfig, KCSEncoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BITS = random.Random(2).choices([0, 1], k=200003)  # not a whole block
+DATA = bytes(random.Random(11).choices(range(256), k=300))
+
+
+# BITS in blocks of random lengths
+def blocks(bits=BITS):
+    rng = random.Random(3)
+    pos = 0
+    while pos < len(bits):
+        n = rng.choice([1, 5, 8, 100, 70000])
+        yield np.array(bits[pos : pos + n], dtype=np.uint8)
+        pos += n
+
+
+def cached(cache, *args):
+    return np.concatenate(list(cache.get(*args))).tolist()
+
+
+def test_miss(tmp_path):
+    cache = BitCache(str(tmp_path))
+    assert cache.get("nothing") is None
+
+
+def test_hit(tmp_path):
+    cache = BitCache(str(tmp_path))
+    cache.put("k", blocks())
+    assert cached(cache, "k") == BITS
+    assert cached(cache, "k", 70001, 100000) == BITS[70001:170001]
+    assert cached(cache, "k", 199990, 100) == BITS[199990:]
+
+
+def test_partial_put_not_cached(tmp_path):
+    cache = BitCache(str(tmp_path))
+
+    def interrupted():
+        yield np.ones(10, dtype=np.uint8)
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.put("k", interrupted())
+    assert cache.get("k") is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_key_depends_on_file_and_params(tmp_path):
+    cache = BitCache(str(tmp_path / "cache"))
+    wav = tmp_path / "a.wav"
+    wav.write_bytes(b"one")
+    key = cache.key(str(wav), channel=0)
+    assert key == cache.key(str(wav), channel=0)
+    assert key != cache.key(str(wav), channel=1)
+    wav.write_bytes(b"two")
+    os.utime(str(wav), ns=(0, 0))
+    key = cache.key(str(wav), channel=0)
+    wav.write_bytes(b"six")  # same size
+    os.utime(str(wav), ns=(0, 0))
+    assert key != cache.key(str(wav), channel=0)  # by the hash
+    wav.write_bytes(b"x" * (5 << 20))
+    key = cache.key(str(wav), channel=0)
+    os.utime(str(wav), ns=(0, 0))
+    assert key != cache.key(str(wav), channel=0)  # by the time
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BitCache(str(tmp_path), max_bytes=12000)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, blocks(BITS[:40000]))  # 5000 bytes each
+        os.utime(cache.path(key), (i, i))
+    list(cache.get("a", 0, 1))  # a is now the most recently used
+    cache.put("c", blocks(BITS[:40000]))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def decode(tmp_path, *args):
+    out = str(tmp_path / "out.bin")
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1"]
+    cmd += ["-o", out] + list(args)
+    subprocess.run(cmd, check=True, stderr=subprocess.DEVNULL)
+    with open(out, "rb") as f:
+        return f.read()
+
+
+# cached runs decode what uncached ones do, for whole files, sample ranges,
+# gated spans and the AGC front end, with the entry made by any of them
+@pytest.mark.parametrize("first", [[], ["-r", "50000:"], ["-G"]])
+def test_cli(tmp_path, first):
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    silence = bytes(2 * 44100)
+    path = str(tmp_path / "tape.wav")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(silence + enc.leader(1) + enc.encode(DATA) + silence)
+    cache_dir = str(tmp_path / "cache")
+    decode(tmp_path, "--cache-dir", cache_dir, path, *first)
+    assert len(os.listdir(cache_dir)) == 1
+    for opts in ["-a"], ["-r", "100000:"], ["-G"], []:
+        plain = decode(tmp_path, path, *opts)
+        assert decode(tmp_path, "--cache-dir", cache_dir, path, *opts) == plain
+    assert plain == DATA
+    assert len(os.listdir(cache_dir)) == 1
+    plain = decode(tmp_path, "-g", path)
+    assert decode(tmp_path, "-g", "--cache-dir", cache_dir, path) == plain == DATA
+    assert len(os.listdir(cache_dir)) == 2
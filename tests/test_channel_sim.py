@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from kcs_channel_sim import DECODERS, count_bit_errors, make_signal, parse_grid
+from kcs_channel_sim import simulate_channel
+
+DATA = np.random.default_rng(1).integers(0, 256, 100, dtype=np.uint8).tobytes()
+
+
+# with no impairments the channel passes the signal through untouched
+def test_clean_channel():
+    signal, rate = make_signal(DATA, 1, 44100)
+    assert np.array_equal(simulate_channel(signal, rate), signal)
+    for name, decode in DECODERS.items():
+        assert count_bit_errors(DATA, decode(signal, rate, 1)) == 0, name
+
+
+def test_count_bit_errors():
+    flipped = bytearray(DATA)
+    flipped[10] ^= 0x21
+    assert count_bit_errors(DATA, bytes(flipped)) == 2
+    assert count_bit_errors(DATA, DATA[:50] + DATA[51:]) == 8  # a lost byte
+    assert count_bit_errors(DATA, DATA[:50] + b"\0" + DATA[50:]) == 8  # a spurious one
+    assert count_bit_errors(DATA, b"") == 8 * len(DATA)
+
+
+def test_impairments():
+    signal, rate = make_signal(DATA, 1, 44100)
+    assert np.array_equal(simulate_channel(signal, rate, invert=1), -signal)
+    assert np.allclose(simulate_channel(signal, rate, dc=0.05), signal + 0.05)
+    assert simulate_channel(signal, rate, clip=0.5).max() == 0.5
+    noisy = simulate_channel(signal, rate, noise=0.1)
+    assert abs((noisy - signal).std() - 0.1) < 0.01
+    assert np.array_equal(noisy, simulate_channel(signal, rate, noise=0.1))  # seeded
+
+
+def test_parse_grid():
+    assert parse_grid("noise=0,0.1; wow=0.01;") == dict(noise=[0, 0.1], wow=[0.01])
+    with pytest.raises(ValueError):
+        parse_grid("hiss=1")
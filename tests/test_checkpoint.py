@@ -0,0 +1,96 @@
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from array import array
+
+import pytest
+
+from kcs_checkpoint import Checkpointer, open_resumed_output
+from kcs_codec import KCSConfig, KCSEncoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(3).choices(range(256), k=1500))
+
+
+# a quiet recording with a drifting level and a wandering DC offset
+def recording():
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    clean = array("h", enc.leader(1) + enc.encode(DATA) + enc.trailer(1))
+    rng = random.Random(4)
+    pcm = array("h", bytes(2 * len(clean)))
+    for i, v in enumerate(clean):
+        level = 0.1 + 0.05 * math.sin(i / 20000)
+        pcm[i] = int(v * level + 300 * math.sin(i / 5000) + rng.gauss(0, 20))
+    return pcm.tobytes()
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "ckpt")
+    Checkpointer(path, dict(speed_mode=1)).save(dict(pos=123, bytes=4))
+    assert Checkpointer(path, dict(speed_mode=1)).load() == dict(pos=123, bytes=4)
+    with pytest.raises(ValueError, match="speed_mode"):
+        Checkpointer(path, dict(speed_mode=2)).load()
+
+
+def test_open_resumed_output(tmp_path):
+    path = str(tmp_path / "out")
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+    with open_resumed_output(path, 4) as f:
+        f.write(b"ab")
+    with open(path, "rb") as f:
+        assert f.read() == b"0123ab"
+    with pytest.raises(ValueError):
+        open_resumed_output(path, 100)
+
+
+def decode(args, pcm, tmp_path, stop_after_checkpoint=False):
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1", "--raw"]
+    proc = subprocess.Popen(
+        cmd + args + ["-"], stdin=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    if not stop_after_checkpoint:
+        proc.communicate(pcm)
+        return proc.returncode
+    # stall the input half way, once some output has been checkpointed
+    proc.stdin.write(pcm[: len(pcm) // 2])
+    proc.stdin.flush()
+    checkpoint = str(tmp_path / "ckpt")
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with open(checkpoint) as f:
+                if json.load(f)["state"]["bytes"]:
+                    break
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.05)
+    proc.send_signal(signal.SIGINT)
+    proc.stdin.close()
+    return proc.wait()
+
+
+# an interrupted and resumed decode writes just what an unbroken one does
+@pytest.mark.parametrize("agc", [False, True])
+def test_resume_matches_uninterrupted(tmp_path, agc):
+    if agc:
+        pytest.importorskip("numpy")
+    pcm = recording()
+    opts = ["-g"] if agc else []
+    full, part = str(tmp_path / "full"), str(tmp_path / "part")
+    assert decode(opts + ["-o", full], pcm, tmp_path) == 0
+
+    ckpt = ["--checkpoint", str(tmp_path / "ckpt"), "--checkpoint-interval", "0"]
+    assert decode(opts + ckpt + ["-o", part], pcm, tmp_path, True) == 1
+    with open(part, "rb") as f:
+        assert 0 < len(f.read()) < len(DATA)
+    assert decode(opts + ckpt + ["--resume", "-o", part], pcm, tmp_path) == 0
+    with open(full, "rb") as f, open(part, "rb") as g:
+        out = f.read()
+        assert g.read() == out
+    assert out == DATA
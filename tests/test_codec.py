@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from kcs_codec import KCSConfig, KCSDecoder, KCSEncoder, generate_bytes
+
+DATA = bytes(random.Random(1).choices(range(256), k=200))
+
+
+# sign-change bits of one channel of PCM, as the WAV front end makes them
+def sign_change_bits(pcm, samplewidth, nchannels, channel=0):
+    offset = channel * samplewidth + samplewidth - 1
+    previous = 0
+    for byte in pcm[offset :: samplewidth * nchannels]:
+        signbit = byte & 0x80
+        yield 1 if (signbit ^ previous) else 0
+        previous = signbit
+
+
+def encode(speed_mode, framerate=48000, **kwargs):
+    enc = KCSEncoder(KCSConfig(framerate, speed_mode, **kwargs))
+    return enc, enc.leader(1) + enc.encode(DATA) + enc.trailer(1)
+
+
+@pytest.mark.parametrize("speed_mode", [0, 1, 2])
+@pytest.mark.parametrize("out_format, samplewidth", [("uint8", 1), ("int16", 2)])
+def test_chunked_feed_matches_generate_bytes(speed_mode, out_format, samplewidth):
+    enc, pcm = encode(speed_mode, out_format=out_format, out_channels=2)
+    expected = bytes(
+        generate_bytes(
+            sign_change_bits(pcm, samplewidth, 2, 1),
+            enc.framerate,
+            0,
+            speed_mode,
+            False,
+        )
+    )
+    assert expected == DATA
+
+    dec = KCSDecoder(
+        KCSConfig(
+            framerate=enc.framerate,
+            speed_mode=speed_mode,
+            samplewidth=samplewidth,
+            nchannels=2,
+            channel=1,
+        )
+    )
+    # chunks of odd sizes split frames and samples anywhere
+    rng = random.Random(speed_mode)
+    out = bytearray()
+    pos = 0
+    while pos < len(pcm):
+        size = rng.choice([1, 2, 3, 5, 7, 1000, 4099])
+        out += dec.feed(pcm[pos : pos + size])
+        pos += size
+    assert bytes(out) == expected
+
+
+def test_feed_accepts_buffers():
+    enc, pcm = encode(1)
+    dec = KCSDecoder(KCSConfig(framerate=enc.framerate, speed_mode=1))
+    assert dec.feed(memoryview(bytearray(pcm))) == DATA
+
+
+# 4800 baud tones don't come out in whole samples at 44.1 kHz, so they
+# are synthesized exactly there
+@pytest.mark.parametrize("framerate", [44100, 48000])
+def test_4800_baud_round_trip(framerate):
+    if framerate == 44100:
+        pytest.importorskip("numpy")
+    enc, pcm = encode(3, framerate)
+    assert enc.framerate == framerate
+    assert enc.exact_freq == (framerate == 44100)
+    bits = sign_change_bits(pcm, 1, 1)
+    assert bytes(generate_bytes(bits, framerate, 0, 3, False)) == DATA
+    dec = KCSDecoder(KCSConfig(framerate, 3))
+    assert dec.feed(pcm) == DATA
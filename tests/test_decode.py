@@ -0,0 +1,151 @@
+import os
+import random
+import subprocess
+import sys
+import wave
+from array import array
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from kcs_codec import KCSConfig, KCSEncoder
+from kcs_decode import decode_wav_channels, merge_channel_bytes, scan_wav_regions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(7).choices(range(256), k=400))
+
+
+# a 16-bit WAV file at 44.1 kHz, 1200 baud: channel 0 is clean, channel 1
+# has a dropout and channel 2 (if any) a noise burst, in another place
+def write_tape(path, nchannels=3):
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    clean = array("h", enc.leader(1) + enc.encode(DATA) + enc.trailer(1))
+    n = len(clean)
+    dropout = array("h", clean)
+    dropout[n // 3 : n // 3 + 4000] = array("h", bytes(8000))
+    rng = random.Random(8)
+    burst = array("h", clean)
+    for i in range(n // 2, n // 2 + 4000):
+        burst[i] = rng.randint(-32768, 32767)
+    frames = array("h", bytes(2 * nchannels * n))
+    for channel, samples in enumerate([clean, dropout, burst][:nchannels]):
+        frames[channel::nchannels] = samples
+    with wave.open(path, "wb") as w:
+        w.setnchannels(nchannels)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(frames.tobytes())
+
+
+def test_decode_channels(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    write_tape(path)
+    with wave.open(path) as wf:
+        results = decode_wav_channels(wf, [0, 1, 2], 0, 1, False)
+    decoded = [bytes(b for _, b in result) for result in results]
+    assert decoded[0] == DATA
+    assert decoded[1] != DATA and decoded[2] != DATA
+    # outside the dropout, channel 1 finds the same bytes at the same samples
+    positions = dict(results[0])
+    assert all(positions.get(pos) == b for pos, b in results[1][:100])
+
+    # the clean channel is outvoted nowhere: the merge recovers the data
+    assert merge_channel_bytes(results, 36.75 * 11 / 2) == DATA
+
+
+def test_merge_votes():
+    a = [(100, 1), (500, 2), (900, 3)]
+    b = [(102, 1), (498, 7), (1300, 4)]
+    c = [(99, 1), (501, 7)]
+    assert merge_channel_bytes([a, b, c], 10) == bytes([1, 7, 3, 4])
+    assert merge_channel_bytes([a, b], 10) == bytes([1, 2, 3, 4])  # tie: a wins
+    assert merge_channel_bytes([b, a], 10) == bytes([1, 7, 3, 4])  # tie: b wins
+    # bytes further apart than the tolerance are different bytes
+    assert merge_channel_bytes([a, [(200, 9)]], 10) == bytes([1, 9, 2, 3])
+
+
+def decode(*args):
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1"]
+    subprocess.run(cmd + list(args), check=True)
+
+
+def test_cli_per_channel_files(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    write_tape(path)
+    decode("-c", "all", "-o", str(tmp_path / "out.bin"), path)
+    for channel in range(3):
+        with open(str(tmp_path / ("out.ch%d.bin" % channel)), "rb") as f:
+            assert (f.read() == DATA) == (channel == 0)
+
+
+# a stereo tape with a dropout on one channel
+@pytest.mark.parametrize("channels", ["0,1", "1,0"])
+def test_cli_merge(tmp_path, channels):
+    path = str(tmp_path / "tape.wav")
+    write_tape(path, 2)
+    out = str(tmp_path / "out.bin")
+    decode("-c", channels, "-M", "-o", out, path)
+    with open(out, "rb") as f:
+        assert f.read() == DATA
+
+
+# a stereo WAV file with one second of silence, a leader, data and another
+# second of silence on channel 1, and silence on channel 0
+def write_gate_tape(path):
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    silence = bytes(2 * 44100)
+    tape = array("h", silence + enc.leader(1) + enc.encode(DATA[:100]) + silence)
+    frames = array("h", bytes(4 * len(tape)))
+    frames[1::2] = tape
+    with wave.open(path, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(frames.tobytes())
+    return len(tape)
+
+
+def test_scan_regions(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    n = write_gate_tape(path)
+    with wave.open(path) as wf:
+        regions = scan_wav_regions(wf, 1, 36.75, 2400)
+        assert [name for _, _, name in regions] == [
+            "silence",
+            "leader",
+            "data",
+            "silence",
+        ]
+        assert regions[0][0] == 0 and regions[-1][1] == n
+        assert all(a[1] == b[0] for a, b in zip(regions, regions[1:]))
+        assert wf.tell() == n
+        wf.setpos(0)
+        assert scan_wav_regions(wf, 0, 36.75, 2400) == [(0, n, "silence")]
+
+        # positions are from where the pass starts, and it stops at nframes
+        wf.setpos(20000)
+        part = scan_wav_regions(wf, 1, 36.75, 2400, regions[2][1] - 20000)
+        assert [name for _, _, name in part] == ["silence", "leader", "data"]
+        assert part[-1][1] == regions[2][1] - 20000
+        assert abs(part[1][0] + 20000 - regions[1][0]) < 37
+
+
+# -G only frames the data region, and reports the map
+def test_cli_gate(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    n = write_gate_tape(path)
+    out = str(tmp_path / "out.bin")
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1", "-G"]
+    cmd += ["-c", "1", "-o", out, path]
+    result = subprocess.run(cmd, check=True, stderr=subprocess.PIPE)
+    lines = result.stderr.decode().splitlines()
+    assert [line.split()[-1] for line in lines] == [
+        "silence",
+        "leader",
+        "data",
+        "silence",
+    ]
+    assert float(lines[-1].split()[1][:-1]) == round(n / 44100, 3)
+    with open(out, "rb") as f:
+        assert f.read() == DATA[:100]
@@ -0,0 +1,112 @@
+import os
+import random
+import subprocess
+import sys
+import threading
+import wave
+
+import pytest
+
+from kcs_audio import UINT8, FakeBackend
+from kcs_codec import KCSConfig, KCSEncoder, generate_bytes
+from kcs_decode_live import generate_wav_sign_change_regions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(10).choices(range(256), k=100))
+
+
+# a mono 16-bit WAV file at 44.1 kHz, 1200 baud, with a second of silence
+# before and after the recording
+def write_tape(path):
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    silence = bytes(2 * 44100)
+    pcm = silence + enc.leader(1) + enc.encode(DATA) + enc.trailer(1) + silence
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(pcm)
+    return len(pcm) // 2
+
+
+def decode_live(backend, *args):
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode_live.py"), "-s", "1"]
+    cmd += ["-B", backend] + list(args)
+    return subprocess.run(cmd, check=True, stderr=subprocess.PIPE)
+
+
+# the region map is complete at the end of the input, the last region too
+def test_gate_map(tmp_path):
+    pytest.importorskip("numpy")
+    path = str(tmp_path / "tape.wav")
+    n = write_tape(path)
+    out = str(tmp_path / "out.bin")
+    result = decode_live("fake:in=" + path, "-G", "-o", out)
+    lines = result.stderr.decode().splitlines()
+    names = [line.split()[-1] for line in lines]
+    assert names == ["silence", "leader", "data", "leader", "silence"]
+    assert float(lines[-1].split()[1][:-1]) == round(n / 44100, 3)
+    with open(out, "rb") as f:
+        assert f.read() == DATA
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# decoding from the fake input device, with the front ends and block sizes
+@pytest.mark.parametrize("opts", [[], ["-g"], ["-x"], ["-b", "5000"]])
+def test_decode(tmp_path, opts):
+    if "-g" in opts:
+        pytest.importorskip("numpy")
+    path = str(tmp_path / "tape.wav")
+    write_tape(path)
+    out = str(tmp_path / "out.bin")
+    decode_live("fake:in=" + path, "-o", out, *opts)
+    assert read(out) == DATA
+
+
+# the monitor device plays the input as it is read
+def test_monitor(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    write_tape(path)
+    monitor = str(tmp_path / "monitor%d.wav")
+    out = str(tmp_path / "out.bin")
+    decode_live("fake:in=%s,out=%s" % (path, monitor), "-m", "2", "-o", out)
+    with wave.open(path) as a, wave.open(monitor % 2) as b:
+        assert a.readframes(a.getnframes()) == b.readframes(b.getnframes())
+
+
+# input lost to overflows loses the bytes in it
+def test_overflow(tmp_path):
+    path = str(tmp_path / "tape.wav")
+    write_tape(path)
+    out = str(tmp_path / "out.bin")
+    decode_live("fake:in=%s,overflow=40" % path, "-o", out)
+    decoded = read(out)
+    assert 0 < len(decoded) < len(DATA)
+
+
+# what is played to the loopback is decoded from its input; the input ends
+# when the output is closed
+def test_loopback():
+    pytest.importorskip("numpy")  # the output is 8-bit, the input 16-bit
+    audio = FakeBackend(loopback=True)
+    enc = KCSEncoder(KCSConfig(44100, 1))
+    pcm = enc.leader(1) + enc.encode(DATA) + enc.trailer(1)
+
+    def play():
+        stream = audio.open_output(audio.default_output(), 44100, UINT8, 1, 1024)
+        for i in range(0, len(pcm), 1000):
+            stream.write(pcm[i : i + 1000])
+        stream.close()
+
+    thread = threading.Thread(target=play)
+    thread.start()
+    decoded = b""
+    regions = generate_wav_sign_change_regions(audio, audio.default_input(), -1)
+    for _, sign_changes in regions:
+        decoded += bytes(generate_bytes(sign_changes, 44100, 0, 1, False))
+    thread.join()
+    assert decoded == DATA
@@ -0,0 +1,242 @@
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from kcs_codec import AMPLITUDE, CENTER, KCSConfig, KCSEncoder
+from kcs_codec import generate_bytes, get_profile, kcs_byte_bits
+from kcs_dsp import AGCFrontEnd, CarrierGate, NCOSynth, frame_bit_blocks
+from kcs_dsp import DATA as DATA_REGION, LEADER, SILENCE
+
+BITS = random.Random(3).choices([0, 1], k=2000)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(6).choices(range(256), k=400))
+
+
+def synth(speed_mode=3, framerate=44100, **kwargs):
+    return NCOSynth(framerate, get_profile(speed_mode), "float32", **kwargs)
+
+
+def samples(pcm):
+    return np.frombuffer(pcm, "<f4") * (CENTER / AMPLITUDE)
+
+
+# zero crossings of a steady tone over a whole number of bits
+@pytest.mark.parametrize("framerate", [44100, 48000])
+@pytest.mark.parametrize("bit", [0, 1])
+def test_frequency(framerate, bit):
+    profile = get_profile(3)
+    nco = synth(framerate=framerate)
+    y = samples(nco.bits([bit] * 9600))  # two seconds
+    crossings = np.count_nonzero(np.diff(np.signbit(y)))
+    freq = profile.one_freq if bit else profile.zero_freq
+    assert abs(crossings / 2 / 2 - freq) <= 1
+
+
+# the tone follows the ideal sine, with no phase drift or reset per bit
+def test_exact_phase():
+    profile = get_profile(3)
+    nco = synth()
+    y = samples(nco.bits([1] * 4800))
+    t = np.arange(len(y)) / 44100
+    assert np.allclose(y, np.sin(2 * np.pi * profile.one_freq * t), atol=1e-5)
+
+
+# no jumps at bit boundaries: no step exceeds the fastest tone's slope
+def test_phase_continuity():
+    profile = get_profile(3)
+    y = samples(synth().bits(BITS))
+    step = 2 * math.pi * profile.one_freq / 44100
+    assert np.abs(np.diff(y)).max() <= step * 1.001
+
+
+# rendering piecewise continues where the last call left off
+def test_chunked():
+    whole = synth().bits(BITS)
+    nco = synth()
+    pcm = b"".join(nco.bits(BITS[i : i + 7]) for i in range(0, len(BITS), 7))
+    assert pcm == whole
+
+
+def test_words():
+    words = [kcs_byte_bits(b, False) for b in range(256)]
+    data = random.Random(4).choices(range(256), k=500)
+    bits = [bit for b in data for bit in words[b]]
+    nco = synth(words=words, nchannels=2)
+    pcm = nco.words(data[:123]) + nco.bits([]) + nco.words(data[123:])
+    stereo = samples(pcm).reshape(-1, 2)
+    assert np.array_equal(stereo[:, 0], stereo[:, 1])
+    assert stereo[:, 0].tobytes() == samples(synth().bits(bits)).tobytes()
+
+
+# a weak recording with a drifting level and a wandering DC offset
+def weak_recording(framerate=44100):
+    enc = KCSEncoder(KCSConfig(framerate, 1, out_format="float32"))
+    clean = np.frombuffer(enc.leader(1) + enc.encode(DATA) + enc.trailer(1), "<f4")
+    t = np.arange(len(clean)) / framerate
+    level = 0.05 + 0.03 * np.sin(2 * np.pi * 0.3 * t)
+    dc = 0.08 * np.sin(2 * np.pi * 0.1 * t)
+    noise = np.random.default_rng(5).normal(0, 0.002, len(clean))
+    return (clean * level + dc + noise).astype(np.float32)
+
+
+def agc_bits(samples, chunk):
+    front_end = AGCFrontEnd(44100)
+    parts = [
+        front_end.process(samples[i : i + chunk]) for i in range(0, len(samples), chunk)
+    ]
+    return np.concatenate(parts)
+
+
+# kcs_decode.py needs -g for it
+def test_agc_decodes_weak_recording(tmp_path):
+    out = str(tmp_path / "out")
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1", "--raw"]
+    cmd += ["--format", "float", "-o", out, "-"]
+    pcm = weak_recording().tobytes()
+    for opts, decoded in ([], False), (["-g"], True):
+        subprocess.run(cmd + opts, input=pcm, check=True)
+        with open(out, "rb") as f:
+            assert (f.read() == DATA) == decoded
+
+
+# the output doesn't depend on how the input is cut up
+def test_agc_chunking():
+    samples = weak_recording()[:100000]
+    whole = AGCFrontEnd(44100).process(samples)
+    for chunk in (7, 87, 1000, 8192):
+        assert np.array_equal(agc_bits(samples, chunk), whole)
+
+
+# a front end restored from get_state() carries on exactly
+def test_agc_state():
+    samples = weak_recording()[:100000]
+    whole = AGCFrontEnd(44100).process(samples)
+    front_end = AGCFrontEnd(44100)
+    first = front_end.process(samples[:54321])
+    state = json.loads(json.dumps(front_end.get_state()))
+    front_end = AGCFrontEnd(44100)
+    front_end.set_state(state)
+    rest = front_end.process(samples[54321:])
+    assert np.array_equal(np.concatenate([first, rest]), whole)
+
+
+# a tape as the gate sees it: one second of (noise) silence, a leader,
+# data and another second of silence, at 1200 baud
+def gate_tape():
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="float32"))
+    silence = np.zeros(44100, dtype=np.float32)
+    parts = [silence, enc.leader(1), enc.encode(DATA[:100]), silence]
+    x = np.concatenate([np.frombuffer(p, "<f4") for p in parts])
+    noise = np.random.default_rng(9).normal(0, 0.001, len(x))
+    return (x + noise).astype(np.float32)
+
+
+def gate(**kwargs):
+    return CarrierGate(44100, 36.75, 2400, **kwargs)
+
+
+def test_gate_regions():
+    x = gate_tape()
+    g = gate()
+    g.classify(x)
+    regions = g.flush()
+    assert [label for _, _, label in regions] == [SILENCE, LEADER, DATA_REGION, SILENCE]
+    assert regions[-1][1] == len(x)
+    # boundaries are on blocks (37 samples), within a block of the tape's
+    (_, leader, _), (_, data, _), (_, end, _), _ = regions
+    assert leader % 37 == 0 and abs(leader - 44100) < 37
+    # the first long half-cycle is in the first start bit; data ends with
+    # the last word's start bit (the stop bits are ones)
+    assert 88200 - 22 * 37 - 37 < data <= 88200 - 22 * 37 + 37
+    assert data == 88208 - 22 * 37 and end == 128242 + 22 * 37
+
+
+# data is widened by the margin on both sides (taking it from the leader
+# and the silence after it)
+@pytest.mark.parametrize("margin", [5, 22, 100])
+def test_gate_margin(margin):
+    x = gate_tape()
+    g = gate(margin_bits=0)
+    g.classify(x)
+    spans = g.flush() and g.data_spans()
+    g = gate(margin_bits=margin)
+    g.classify(x)
+    g.flush()
+    widened = g.data_spans()
+    first, last = spans[0][0] - margin * 37, spans[-1][1] + margin * 37
+    assert widened == [(first, last)]
+
+
+# pushing the tape block by block maps it as classify() does in one go,
+# and hands on the input from the margin before data to the margin after
+@pytest.mark.parametrize("chunk", [1, 100, 1024, 44100])
+def test_gate_push(chunk):
+    x = gate_tape()
+    g = gate()
+    g.classify(x)
+    whole = g.flush()
+    g = gate()
+    passed = []
+    for i in range(0, len(x), chunk):
+        passed += g.push(i, x[i : i + chunk])
+    assert g.flush() == whole
+    assert not g.gap  # one stretch of input
+    lo, hi = g.data_spans()[0]
+    assert passed[0] <= lo and passed[0] + 2 * 22 * 37 + chunk > lo
+    assert passed[-1] + chunk >= hi and passed[-1] < hi + 22 * 37 + chunk
+    assert passed == list(range(passed[0], passed[-1] + 1, chunk))
+
+
+# sign-change bits of a noisy recording, cut off at the end
+def noisy_bits(speed_mode, framerate, cuts, noise):
+    enc = KCSEncoder(KCSConfig(framerate, speed_mode, cuts, out_format="float32"))
+    pcm = enc.leader(1)[: 20000 * 4] + enc.encode(DATA[:50]) + enc.trailer(1)
+    x = np.frombuffer(pcm, "<f4")
+    x = x + np.random.default_rng(speed_mode).normal(0, noise, len(x))
+    signs = np.signbit(x[: len(x) * 9 // 10]).astype(np.uint8)
+    return np.diff(signs, prepend=0).astype(bool).astype(np.uint8)
+
+
+def framed(framer, bits, *args, **kwargs):
+    index, state, states = [], {}, []
+    out = []
+    for byteval in framer(bits, *args, index=index, state=state, **kwargs):
+        out.append(byteval)
+        states.append(dict(state))
+    return out, index, states
+
+
+# bits in blocks of random lengths
+def bit_blocks(bits):
+    rng = random.Random(len(bits))
+    pos = 0
+    while pos < len(bits):
+        n = rng.choice([1, 9, 300, 5000, 70000])
+        yield bits[pos : pos + n]
+        pos += n
+
+
+# the block framer frames the bytes generate_bytes does, with the same
+# index entries and states, and resumes from those states just as well
+@pytest.mark.parametrize("speed_mode", [0, 1, 2, 3])
+@pytest.mark.parametrize("framerate", [44100, 48000])
+@pytest.mark.parametrize("noise", [0.0, 0.2])
+def test_frame_bit_blocks(speed_mode, framerate, noise):
+    cuts = speed_mode == 0
+    bits = noisy_bits(speed_mode, framerate, cuts, noise)
+    args = (framerate, 0, speed_mode, cuts)
+    expected = framed(generate_bytes, iter(bits.tolist()), *args)
+    assert framed(frame_bit_blocks, bit_blocks(bits), *args) == expected
+    assert len(expected[1]) > 30
+    for state in expected[2][::9]:
+        rest = bits[state["pos"] :]
+        kwargs = dict(window=state["window"])
+        resumed = framed(generate_bytes, iter(rest.tolist()), *args, **kwargs)
+        assert framed(frame_bit_blocks, bit_blocks(rest), *args, **kwargs) == resumed
@@ -0,0 +1,107 @@
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from kcs_encode_live import OutputBuffers, OutputStats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = bytes(random.Random(12).choices(range(256), k=200))
+
+
+def encode_live(tmp_path, backend, *args):
+    infile = str(tmp_path / "in.bin")
+    with open(infile, "wb") as f:
+        f.write(DATA)
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_encode_live.py"), "-s", "1"]
+    cmd += ["-B", backend] + list(args) + [infile]
+    return subprocess.run(cmd, check=True, stderr=subprocess.PIPE)
+
+
+def decode(tmp_path, path):
+    out = str(tmp_path / "out.bin")
+    cmd = [sys.executable, os.path.join(ROOT, "kcs_decode.py"), "-s", "1"]
+    subprocess.run(cmd + ["-o", out, path], check=True)
+    with open(out, "rb") as f:
+        return f.read()
+
+
+# what is played to the fake output device decodes to the input
+def test_encode(tmp_path):
+    tape = str(tmp_path / "tape.wav")
+    encode_live(tmp_path, "fake:out=" + tape)
+    assert decode(tmp_path, tape) == DATA
+
+
+# underflows are counted and reported per device
+def test_underflow(tmp_path):
+    tape = str(tmp_path / "tape.wav")
+    result = encode_live(tmp_path, "fake:out=%s,underflow=10" % tape)
+    summary = r"device 1: (\d+) blocks, (\d+) underflows"
+    blocks, underflows = re.match(summary, result.stderr.decode()).groups()
+    assert int(underflows) == int(blocks) // 10 > 0
+
+
+def summaries(result):
+    pattern = r"device (\d+).*: (\d+) blocks, (\d+) underflows, (\d+) dropped, "
+    pattern += r"up to (\d+) frames buffered"
+    stats = {}
+    for line in result.stderr.decode().splitlines():
+        numbers = [int(n) for n in re.match(pattern, line).groups()]
+        stats[numbers[0]] = numbers[1:]
+    return stats
+
+
+# every device, the monitor too, plays all of the audio
+def test_devices(tmp_path):
+    out = str(tmp_path / "out%d.wav")
+    result = encode_live(tmp_path, "fake:out=" + out, "-d", "1,2", "-m", "3")
+    stats = summaries(result)
+    assert sorted(stats) == [1, 2, 3]
+    for device, (blocks, underflows, dropped, queued) in stats.items():
+        assert decode(tmp_path, out % device) == DATA
+        assert underflows == dropped == 0
+
+
+# a slow device falls behind and loses audio, without holding up the rest
+def test_slow_device(tmp_path):
+    out = str(tmp_path / "out%d.wav")
+    backend = "fake:out=%s,realtime,slow=2" % out
+    t = time.monotonic()
+    result = encode_live(tmp_path, backend, "-d", "1,2", "--max-lag", "0.5")
+    elapsed = time.monotonic() - t
+    stats = summaries(result)
+    assert decode(tmp_path, out % 1) == DATA
+    assert stats[1][2] == 0 and stats[2][2] > 0
+    # half a second (--buffer-time) plus a block, the leader included
+    assert stats[1][3] <= 22050 + 1024
+    # the audio is 1 + 1.83 + 1 s long: at the slow device's pace, it would
+    # take twice that
+    assert elapsed < 2 * 3.83
+
+
+# buffering is counted in frames: the producer waits while every device
+# has the buffer's worth queued, and a device with more than the lag limit
+# queued beyond the device with the least loses blocks
+def test_output_buffers():
+    stats = [OutputStats(1), OutputStats(2)]
+    buffers = OutputBuffers(stats, 1000, 3000)
+    for _ in range(10):  # device 1 plays along, device 2 doesn't
+        buffers.put(b"x" * 400, 400)
+        assert buffers.get(0) == b"x" * 400
+    assert buffers.queued == [0, 3200] and stats[1].dropped == 2
+    for _ in range(3):
+        buffers.put(b"y" * 400, 400)
+    assert buffers.queued == [1200, 4000] and stats[1].dropped == 3
+    producer = threading.Thread(target=buffers.put, args=(b"z" * 400, 400))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()  # both devices have a buffer's worth
+    buffers.get(0)
+    producer.join()
+    assert buffers.queued == [1200, 4000] and stats[1].dropped == 4
+    buffers.close()
+    assert [buffers.get(0) for _ in range(4)] == [b"y" * 400] * 2 + [b"z" * 400, None]
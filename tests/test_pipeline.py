@@ -0,0 +1,107 @@
+import itertools
+import multiprocessing
+import threading
+import time
+import wave
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import kcs_pipeline
+from kcs_codec import KCSConfig, KCSEncoder
+from kcs_pipeline import ShmRing, iter_ring, start_fft_pipeline, stop_fft_pipeline
+
+CTX = multiprocessing.get_context("spawn")
+ITEMS = np.arange(100000, dtype=np.int32)
+
+
+# write ITEMS to a ring in blocks of uneven sizes
+def write_items(handle):
+    ring = ShmRing(*handle)
+    sizes = itertools.cycle([1, 7, 333, 499, 500, 1000])
+    pos = 0
+    while pos < len(ITEMS):
+        n = next(sizes)
+        ring.write(ITEMS[pos : pos + n])
+        pos += n
+    ring.close_writer()
+    ring.close()
+
+
+def read_items(ring, block_size):
+    blocks = [block.copy() for block in iter_ring(ring, block_size)]
+    return np.concatenate(blocks)
+
+
+# items come out in order across many wrap-arounds of a small ring, and
+# reads stop at the end of the ring's memory
+def test_wrap_around():
+    ring = ShmRing.create(CTX, np.int32, 1000)
+    writer = threading.Thread(target=write_items, args=(ring.handle(),))
+    writer.start()
+    sizes = set()
+    out = []
+    while True:
+        block = ring.read(777)
+        if block is None:
+            break
+        sizes.add(len(block))
+        out.append(block.copy())
+        ring.advance(len(block))
+    writer.join()
+    assert np.array_equal(np.concatenate(out), ITEMS)
+    assert max(sizes) == 777 and min(sizes) < 777
+    ring.close()
+
+
+# between processes, through shared memory
+def test_round_trip():
+    ring = ShmRing.create(CTX, np.int32, 4096)
+    writer = CTX.Process(target=write_items, args=(ring.handle(),))
+    writer.start()
+    assert np.array_equal(read_items(ring, 1000), ITEMS)
+    writer.join()
+    assert writer.exitcode == 0
+    ring.close()
+
+
+# every change wakes the other side: nothing waits for a timeout
+def test_no_lost_wake_ups(monkeypatch):
+    monkeypatch.setattr(kcs_pipeline, "WAIT_TIME", 60)
+    ring = ShmRing.create(CTX, np.int32, 64)
+    t = time.monotonic()
+    writer = threading.Thread(target=write_items, args=(ring.handle(),))
+    writer.start()
+    assert np.array_equal(read_items(ring, 50), ITEMS)
+    writer.join()
+    assert time.monotonic() - t < 30
+    ring.close()
+
+
+# once the reader is closed, writes are dropped instead of waiting
+def test_close_reader():
+    ring = ShmRing.create(CTX, np.int32, 100)
+    assert ring.write(ITEMS[:100])
+    ring.close_reader()
+    assert not ring.write(ITEMS[:1000])
+    ring.close()
+
+
+# stopping the pipeline stops every stage, which exits by itself
+def test_stop_pipeline(tmp_path):
+    enc = KCSEncoder(KCSConfig(44100, 1, out_format="int16"))
+    path = str(tmp_path / "tape.wav")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(enc.leader(30))
+    backend = "fake:in=%s,realtime" % path
+    procs, rings, freqs = start_fft_pipeline(backend, 0, -1, 44100, "float32", 1024, 37)
+    next(freqs)
+    t = time.monotonic()
+    freqs.close()
+    stop_fft_pipeline(procs, rings)
+    assert time.monotonic() - t < 30
+    assert [proc.exitcode for proc in procs] == [0, 0]